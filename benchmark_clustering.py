@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the clustering algorithms used by K2P2 to find masks.
+
+The benchmark creates synthetic sum-images with the size of the stamps used for
+bright stars, crowded with fainter stars, and compares clustering the pixels with
+significant flux using DBSCAN and using connected-component labelling. It also
+runs the full K2P2 mask creation with both, and checks that the masks are the same.
+
+Example:
+	To run the benchmark on stamps with 500 stars each:
+
+	>>> python benchmark_clustering.py --stars=500
+"""
+
+from __future__ import with_statement, print_function, division
+import argparse
+import logging
+import numpy as np
+from timeit import default_timer
+from photometry.AperturePhotometry import k2p2v2 as k2p2
+from photometry.utilities import default_stamp_size
+
+#------------------------------------------------------------------------------
+def create_sumimage(Nrows, Ncolumns, stars, seed=42):
+	"""
+	Create synthetic sum-image of a bright star surrounded by fainter stars.
+
+	Parameters:
+		Nrows (integer): Number of rows in image.
+		Ncolumns (integer): Number of columns in image.
+		stars (integer): Number of fainter stars.
+		seed (integer, optional): Seed for random number generator.
+
+	Returns:
+		tuple: Sum-image and catalog with columns (column, row, magnitude) of the stars.
+	"""
+	rng = np.random.RandomState(seed)
+	rows, cols = np.mgrid[:Nrows, :Ncolumns]
+	img = rng.normal(100, 10, size=(Nrows, Ncolumns))
+
+	# Bright star in the middle, with an overflow column along the rows:
+	img += 1e6 * np.exp(-0.5*((rows - Nrows/2)**2/(Nrows/6)**2 + (cols - Ncolumns/2)**2/1.5**2))
+	catalog = [(Ncolumns/2, Nrows/2, 2.0)]
+
+	# Fainter stars spread around the stamp:
+	for k in range(stars):
+		row = rng.uniform(0, Nrows)
+		col = rng.uniform(0, Ncolumns)
+		tmag = rng.uniform(8, 15)
+		img += 10**(-0.4*(tmag - 20.44)) / (2*np.pi) * np.exp(-0.5*((rows - row)**2 + (cols - col)**2))
+		catalog.append((col, row, tmag))
+
+	return img, np.array(catalog)
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Benchmark clustering algorithms in K2P2.')
+	parser.add_argument('--stars', type=int, help='Number of fainter stars in each stamp.', default=300)
+	parser.add_argument('--repeat', type=int, help='Number of times to repeat clustering.', default=3)
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.WARNING)
+
+	cluster_radius = np.sqrt(2) + np.finfo(np.float64).eps
+	print("%-8s %12s %8s %12s %12s %12s %12s" % ('tmag', 'stamp', 'pixels', 'DBSCAN', 'label', 'K2P2 DBSCAN', 'K2P2 label'))
+	for tmag in (1.0, 3.0, 5.0):
+		Nrows, Ncolumns = default_stamp_size(tmag)
+		Nrows, Ncolumns = int(Nrows), int(Ncolumns)
+		img, catalog = create_sumimage(Nrows, Ncolumns, args.stars * Nrows * Ncolumns // 50000 + 1)
+
+		# Pixels with significant flux:
+		Y, X = np.mgrid[:Nrows, :Ncolumns]
+		idx = (img > np.median(img) + 0.8*np.std(img[img < np.percentile(img, 50)]))
+		X2, Y2 = X[idx], Y[idx]
+
+		timings = {}
+		results = {}
+		for name, func in (('dbscan', k2p2.run_DBSCAN), ('label', k2p2.run_label)):
+			tic = default_timer()
+			for k in range(args.repeat):
+				results[name] = func(X2, Y2, cluster_radius, 4)
+			timings[name] = (default_timer() - tic) / args.repeat
+
+		for a, b in zip(results['dbscan'], results['label']):
+			if not np.array_equal(a, b):
+				raise Exception("Clustering algorithms did not give the same result")
+
+		masks = {}
+		for name in ('dbscan', 'label'):
+			tic = default_timer()
+			masks[name], _ = k2p2.k2p2FixFromSum(img, show_plot=False, catalog=catalog, thresh=0.8, min_no_pixels_in_mask=4,
+				cluster_radius=cluster_radius, ws_thres=0, clustering=name)
+			timings['k2p2_' + name] = default_timer() - tic
+
+		if not np.array_equal(masks['dbscan'], masks['label']):
+			raise Exception("K2P2 did not give the same masks")
+
+		print("%-8.1f %12s %8d %10.3f s %10.3f s %10.3f s %10.3f s" % (tmag, '%dx%d' % (Nrows, Ncolumns), len(X2),
+			timings['dbscan'], timings['label'], timings['k2p2_dbscan'], timings['k2p2_label']))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the message rate of the master in the MPI scheduler.
+
+The master, sub-masters and workers from the MPI scheduler are run as threads
+in a single process, talking to each other through a mock of the MPI
+communicators, and the workers only pretend to process the tasks. This
+measures the number of messages the master has to handle, and the number of
+tasks per second it is able to hand out, with a single master and with a
+sub-master on each node.
+
+Example:
+	To compare a single master with sub-masters for 8 nodes with 16 workers each:
+
+	>>> python benchmark_scheduler.py --nodes=8 --workers-per-node=16 --numtasks=20000
+"""
+
+from __future__ import with_statement, print_function, division
+import os
+import argparse
+import logging
+import tempfile
+import shutil
+import threading
+import time
+from six.moves import queue, cPickle as pickle
+from timeit import default_timer
+from photometry import STATUS
+from mpi_scheduler import master, submaster, worker, DatabaseThread
+from benchmark_taskmanager import create_todo_file
+
+#------------------------------------------------------------------------------
+class MockMessage(object):
+	"""Mock of a matched MPI message."""
+	def __init__(self, data):
+		self.data = data
+
+	def recv(self):
+		return pickle.loads(self.data)
+
+class MockRequest(object):
+	"""Mock of a MPI request, which is always complete."""
+	def Test(self):
+		return True
+
+	def wait(self):
+		return None
+
+class MockComm(object):
+	"""
+	Mock of a MPI communicator between threads.
+
+	Messages are pickled like in :py:mod:`mpi4py`, and put in the inbox of the receiver.
+	Only the parts of the communicator used by the MPI scheduler are implemented, and
+	messages are always received in the order they were sent, no matter the source or tag.
+	"""
+	def __init__(self, inboxes, rank, received):
+		self.inboxes = inboxes
+		self.rank = rank
+		self.size = len(inboxes)
+		self.received = received
+
+	@classmethod
+	def create(cls, size):
+		"""Create communicators for all ranks."""
+		inboxes = [queue.Queue() for k in range(size)]
+		received = [0] * size
+		return [cls(inboxes, rank, received) for rank in range(size)]
+
+	def _receive(self, item, status):
+		source, tag, data = item
+		self.received[self.rank] += 1
+		if status is not None:
+			status.Set_source(source)
+			status.Set_tag(tag)
+		return data
+
+	def send(self, obj, dest, tag):
+		self.inboxes[dest].put((self.rank, int(tag), pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)))
+
+	def isend(self, obj, dest, tag):
+		self.send(obj, dest, tag)
+		return MockRequest()
+
+	def recv(self, source=None, tag=None, status=None):
+		return pickle.loads(self._receive(self.inboxes[self.rank].get(), status))
+
+	def improbe(self, source=None, tag=None, status=None):
+		try:
+			item = self.inboxes[self.rank].get_nowait()
+		except queue.Empty:
+			return None
+		return MockMessage(self._receive(item, status))
+
+#------------------------------------------------------------------------------
+def run_scheduler(todo_file, nodes, workers_per_node, sub_masters=False, task_time=0.01, batch_time=0.5, max_batch=50):
+	"""
+	Run the MPI scheduler with mock communicators and workers.
+
+	Parameters:
+		todo_file (string): Path to TODO-file.
+		nodes (integer): Number of nodes.
+		workers_per_node (integer): Number of workers on each node.
+		sub_masters (boolean): Use a sub-master on each node.
+		task_time (float): Time in seconds each worker spends on a task.
+		batch_time (float): Target run time in seconds of each batch of tasks sent to a worker.
+		max_batch (int): Maximum number of tasks sent to a worker at once.
+
+	Returns:
+		tuple: Number of tasks processed, number of messages received by the master and elapsed time in seconds.
+	"""
+	def process(task):
+		time.sleep(task_time)
+		result = task.copy()
+		result.update({'status': STATUS.OK, 'time': task_time, 'details': {}})
+		return result
+
+	# All the threads share the memory of the same machine,
+	# so the memory of the tasks is not taken into account:
+	threads = []
+	if sub_masters:
+		upper = MockComm.create(nodes + 1)
+		for node in range(nodes):
+			lower = MockComm.create(workers_per_node + 1)
+			threads.append(threading.Thread(target=submaster, args=(upper[node+1], lower[0]), kwargs={'batch_time': batch_time, 'max_batch': max_batch, 'memory_budget': float('inf')}))
+			threads += [threading.Thread(target=worker, args=(comm, process)) for comm in lower[1:]]
+	else:
+		upper = MockComm.create(nodes*workers_per_node + 1)
+		threads += [threading.Thread(target=worker, args=(comm, process)) for comm in upper[1:]]
+
+	db = DatabaseThread(todo_file, overwrite=True, write_behind=True, in_memory_queue=True)
+	db.start()
+	try:
+		tm = db.wait_ready()
+		tm.logger.setLevel(logging.WARNING)
+		tic = default_timer()
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		master(upper[0], db, batch_time=batch_time, max_batch=max_batch)
+		toc = default_timer()
+	finally:
+		db.stop()
+	numtasks = tm.summary['tasks_run']
+
+	for thread in threads:
+		thread.join()
+	return numtasks, upper[0].received[0], toc - tic
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Benchmark message rate of master in MPI scheduler.')
+	parser.add_argument('--numtasks', type=int, help='Number of tasks in synthetic TODO-file.', default=5000)
+	parser.add_argument('--nodes', type=int, help='Number of nodes.', default=4)
+	parser.add_argument('--workers-per-node', type=int, help='Number of workers on each node.', default=16)
+	parser.add_argument('--task-time', type=float, help='Time in seconds spent on each task.', default=0.01)
+	parser.add_argument('--batch-time', type=float, help='Target run time in seconds of each batch of tasks.', default=0.5)
+	args = parser.parse_args()
+
+	logging.getLogger('photometry').setLevel(logging.WARNING)
+
+	tmpdir = tempfile.mkdtemp()
+	try:
+		todo_file = os.path.join(tmpdir, 'todo.sqlite')
+		create_todo_file(todo_file, args.numtasks)
+
+		for name, sub_masters in (('master', False), ('sub-masters', True)):
+			numtasks, messages, elapsed = run_scheduler(todo_file, args.nodes, args.workers_per_node,
+				sub_masters=sub_masters, task_time=args.task_time, batch_time=args.batch_time)
+			print("%-12s %8d tasks in %8.3f s: %10.1f tasks/s, %8d messages to master (%.1f messages/s)" % (
+				name, numtasks, elapsed, numtasks/elapsed, messages, messages/elapsed))
+	finally:
+		shutil.rmtree(tmpdir)
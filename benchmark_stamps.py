@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the number of stamp resizes in aperture photometry.
+
+Every time the mask of a target touches the edge of the stamp, the stamp is
+resized and K2P2 is run again on the larger stamp. The benchmark runs the
+aperture photometry on FFI targets from the TODO-file, with and without
+predicting the size of the stamp from the full sum-image, and compares the
+number of stamp resizes (the ``stamp_resizes`` reported in the diagnostics),
+the number of calls to K2P2 and the time spent in K2P2.
+
+Example:
+	To run the benchmark on the 50 first FFI targets in the TODO-file in the
+	directory defined in the ``TESSPHOT_INPUT`` environment variable:
+
+	>>> python benchmark_stamps.py --numtargets=50
+"""
+
+from __future__ import with_statement, print_function, division
+import os
+import argparse
+import sqlite3
+import contextlib
+import logging
+import tempfile
+import shutil
+import numpy as np
+from timeit import default_timer
+from photometry import AperturePhotometry, STATUS
+from photometry.AperturePhotometry import k2p2v2 as k2p2
+
+#------------------------------------------------------------------------------
+class K2P2Timer(object):
+	"""Count the calls to K2P2 and the time spent in them."""
+
+	def __init__(self):
+		self.calls = 0
+		self.elapsed = 0.0
+		self._func = None
+
+	def __enter__(self):
+		self._func = k2p2.k2p2FixFromSum
+		def timed(*args, **kwargs):
+			tic = default_timer()
+			try:
+				return self._func(*args, **kwargs)
+			finally:
+				self.calls += 1
+				self.elapsed += default_timer() - tic
+		k2p2.k2p2FixFromSum = timed
+		return self
+
+	def __exit__(self, *args):
+		k2p2.k2p2FixFromSum = self._func
+
+#------------------------------------------------------------------------------
+def run_targets(tasks, input_folder, output_folder, predict_stamp):
+	"""
+	Run aperture photometry on targets.
+
+	Parameters:
+		tasks (list): Tasks from the TODO-file.
+		input_folder (string): Input folder.
+		output_folder (string): Output folder.
+		predict_stamp (boolean): Predict the size of the stamps from the full sum-image.
+
+	Returns:
+		dict: Total number of stamp resizes, targets needing any resizes, calls to K2P2,
+		time spent in K2P2 and total time spent.
+	"""
+	stats = {'resizes': 0, 'resized': 0, 'failed': 0, 'k2p2_calls': 0, 'k2p2_time': 0.0, 'time': 0.0}
+	for task in tasks:
+		with K2P2Timer() as timer:
+			tic = default_timer()
+			with AperturePhotometry(task['starid'], input_folder, output_folder, datasource='ffi',
+				sector=task['sector'], camera=task['camera'], ccd=task['ccd'], predict_stamp=predict_stamp) as pho:
+				pho.photometry()
+				status = pho.status
+				resizes = pho._details.get('stamp_resizes', 0)
+			stats['time'] += default_timer() - tic
+
+		stats['resizes'] += resizes
+		stats['resized'] += int(resizes > 0)
+		stats['failed'] += int(status not in (STATUS.OK, STATUS.WARNING))
+		stats['k2p2_calls'] += timer.calls
+		stats['k2p2_time'] += timer.elapsed
+	return stats
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Benchmark stamp resizes in aperture photometry.')
+	parser.add_argument('--numtargets', type=int, help='Number of FFI targets to run, taken in order of priority.', default=20)
+	parser.add_argument('--tmag', type=float, help='Only run targets brighter than this magnitude.', default=None)
+	parser.add_argument('input_folder', type=str, help='Input directory containing the TODO-file.', nargs='?', default=None)
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.WARNING)
+
+	input_folder = args.input_folder
+	if input_folder is None:
+		input_folder = os.environ.get('TESSPHOT_INPUT', os.path.abspath(os.path.join(os.path.dirname(__file__), 'tests', 'input')))
+
+	constraints = ''
+	if args.tmag is not None:
+		constraints = ' AND tmag < %f' % args.tmag
+	with contextlib.closing(sqlite3.connect(os.path.join(input_folder, 'todo.sqlite'))) as conn:
+		conn.row_factory = sqlite3.Row
+		cursor = conn.cursor()
+		cursor.execute("SELECT starid,sector,camera,ccd,tmag FROM todolist WHERE datasource='ffi'" + constraints + " ORDER BY priority LIMIT ?;", (args.numtargets, ))
+		tasks = [dict(row) for row in cursor.fetchall()]
+	print("Running %d targets with median Tmag %.2f" % (len(tasks), np.median([task['tmag'] for task in tasks])))
+
+	output_folder = tempfile.mkdtemp()
+	try:
+		print("%-10s %8s %8s %8s %10s %12s %10s" % ('stamp', 'resizes', 'resized', 'failed', 'k2p2 calls', 'k2p2 time', 'time'))
+		for name, predict_stamp in (('default', False), ('predicted', True)):
+			stats = run_targets(tasks, input_folder, output_folder, predict_stamp)
+			print("%-10s %8d %8d %8d %10d %10.2f s %8.2f s" % (name, stats['resizes'], stats['resized'], stats['failed'],
+				stats['k2p2_calls'], stats['k2p2_time'], stats['time']))
+	finally:
+		shutil.rmtree(output_folder)
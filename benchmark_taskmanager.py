@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the throughput of the TaskManager.
+
+The benchmark runs the same loop as the master process in the MPI scheduler
+(get task, mark it as started and save the result), but without any workers,
+on a synthetic TODO-file. This measures the number of tasks per second the
+master is able to hand out, which is an upper limit of the throughput of a
+full run.
+
+Example:
+	To compare the normal, the write-behind and the in-memory queue modes of the TaskManager:
+
+	>>> python benchmark_taskmanager.py --numtasks=20000
+"""
+
+from __future__ import with_statement, print_function, division
+import os
+import argparse
+import sqlite3
+import contextlib
+import tempfile
+import shutil
+import numpy as np
+from timeit import default_timer
+from photometry import TaskManager, STATUS
+
+#------------------------------------------------------------------------------
+def create_todo_file(todo_file, numtasks, seed=42):
+	"""
+	Create synthetic TODO-file with random targets.
+
+	Parameters:
+		todo_file (string): Path to TODO-file to create.
+		numtasks (integer): Number of targets in TODO-file.
+		seed (integer, optional): Seed for random number generator.
+	"""
+	rng = np.random.RandomState(seed)
+	with contextlib.closing(sqlite3.connect(todo_file)) as conn:
+		cursor = conn.cursor()
+		cursor.execute("""CREATE TABLE todolist (
+			priority BIGINT NOT NULL,
+			starid BIGINT NOT NULL,
+			sector INT NOT NULL,
+			datasource TEXT NOT NULL DEFAULT 'ffi',
+			camera INT NOT NULL,
+			ccd INT NOT NULL,
+			method TEXT DEFAULT NULL,
+			tmag REAL,
+			status INT DEFAULT NULL,
+			cbv_area INT NOT NULL
+		);""")
+		for k in range(numtasks):
+			camera = rng.randint(1, 5)
+			ccd = rng.randint(1, 5)
+			cursor.execute("INSERT INTO todolist (priority,starid,sector,datasource,camera,ccd,tmag,cbv_area) VALUES (?,?,?,?,?,?,?,?);", (
+				k+1,
+				k+1,
+				1,
+				'ffi',
+				camera,
+				ccd,
+				rng.uniform(2, 15),
+				camera*100 + ccd*10 + rng.randint(1, 5)
+			))
+		cursor.execute("CREATE UNIQUE INDEX priority_idx ON todolist (priority);")
+		cursor.execute("CREATE INDEX starid_datasource_idx ON todolist (starid, datasource);")
+		cursor.execute("CREATE INDEX status_idx ON todolist (status);")
+		cursor.execute("CREATE INDEX starid_idx ON todolist (starid);")
+		conn.commit()
+		cursor.close()
+
+#------------------------------------------------------------------------------
+def run_master(todo_file, **kwargs):
+	"""
+	Run master loop of MPI scheduler without any workers.
+
+	Parameters:
+		todo_file (string): Path to TODO-file.
+		**kwargs: Additional keywords are passed to :py:class:`TaskManager`.
+
+	Returns:
+		tuple: Number of tasks processed and elapsed time in seconds.
+	"""
+	numtasks = 0
+	tic = default_timer()
+	with TaskManager(todo_file, overwrite=True, **kwargs) as tm:
+		while True:
+			task = tm.get_task()
+			if task is None: break
+			tm.start_task(task['priority'])
+
+			result = task.copy()
+			result.update({
+				'status': STATUS.OK,
+				'time': 1.0,
+				'details': {
+					'pos_centroid': (1024.0, 1024.0),
+					'mean_flux': 1e4,
+					'variance': 1.0,
+					'rms_hour': 1.0,
+					'ptp': 1.0,
+					'mask_size': 20,
+					'contamination': 0.1,
+					'stamp': (1000, 1020, 1000, 1020)
+				}
+			})
+			tm.save_result(result)
+			numtasks += 1
+	toc = default_timer()
+	return numtasks, toc - tic
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Benchmark throughput of TaskManager.')
+	parser.add_argument('--numtasks', type=int, help='Number of tasks in synthetic TODO-file.', default=5000)
+	parser.add_argument('--commit-interval', type=int, help='Number of results between commits in write-behind mode.', default=100)
+	args = parser.parse_args()
+
+	tmpdir = tempfile.mkdtemp()
+	try:
+		todo_file = os.path.join(tmpdir, 'todo.sqlite')
+		create_todo_file(todo_file, args.numtasks)
+
+		for name, kwargs in (
+			('default', {}),
+			('write-behind', {'write_behind': True, 'commit_interval': args.commit_interval}),
+			('in-memory', {'write_behind': True, 'commit_interval': args.commit_interval, 'in_memory_queue': True})):
+			numtasks, elapsed = run_master(todo_file, **kwargs)
+			print("%-14s %8d tasks in %8.3f s: %10.1f tasks/s" % (name, numtasks, elapsed, numtasks/elapsed))
+	finally:
+		shutil.rmtree(tmpdir)
@@ -19,6 +19,17 @@ execute the following command:
 
 >>> mpiexec -n 4 python mpi_scheduler.py
 
+For runs with a very large number of processes, the master can be relieved by
+using a sub-master on each node, which takes blocks of tasks from the master
+and hands them out to the other processes on the node:
+
+>>> mpiexec -n 1024 python mpi_scheduler.py --sub-masters
+
+To avoid all workers reading the input files from a shared filesystem, the files
+of each CCD can be copied to storage local to each node before they are used:
+
+>>> mpiexec -n 1024 python mpi_scheduler.py --stage-folder='$TMPDIR/tessphot'
+
 .. codeauthor:: Rasmus Handberg <rasmush@phys.au.dk>
 """
 
@@ -28,7 +39,770 @@ import argparse
 import logging
 import traceback
 import os
+import sys
+import time
+import signal
+import threading
 import enum
+from collections import defaultdict
+from timeit import default_timer
+from six.moves import queue
+
+#------------------------------------------------------------------------------
+class BatchSize(object):
+	"""
+	Adaptive size of batches of tasks sent to workers.
+
+	The size of the batches is chosen such that each batch is expected to take
+	roughly ``batch_time`` seconds, based on a running average of the time
+	taken by the tasks completed so far. Towards the end of the run, the batches
+	are made smaller to avoid some workers sitting idle while others are
+	finishing large batches.
+	"""
+
+	def __init__(self, batch_time=60.0, max_size=50, num_workers=1, alpha=0.1):
+		"""
+		Parameters:
+			batch_time (float): Target run time of each batch in seconds.
+			max_size (int): Maximum number of tasks in a batch.
+			num_workers (int): Number of workers sharing the remaining tasks.
+			alpha (float): Weight of new task times in the running average.
+		"""
+		self.batch_time = batch_time
+		self.max_size = max(int(max_size), 1)
+		self.num_workers = max(int(num_workers), 1)
+		self.alpha = alpha
+		self.mean_time = None
+
+	def update(self, elaptime):
+		"""Update the running average with the time taken by a completed task."""
+		if self.mean_time is None:
+			self.mean_time = elaptime
+		else:
+			self.mean_time += self.alpha * (elaptime - self.mean_time)
+
+	def __call__(self, remaining):
+		"""
+		Number of tasks to put in the next batch.
+
+		Parameters:
+			remaining (int): Number of tasks still waiting to be processed.
+
+		Returns:
+			int: Number of tasks, at least one.
+		"""
+		# Until we know how long the tasks take, only send one at a time:
+		if self.mean_time is None:
+			return 1
+		size = int(self.batch_time / max(self.mean_time, 1e-3))
+		# Leave enough tasks for all workers to get a share:
+		size = min(size, self.max_size, remaining // (2*self.num_workers))
+		return max(size, 1)
+
+#------------------------------------------------------------------------------
+def affects_remaining(result, tasks):
+	"""
+	Check if a result may cause any of the given tasks to be SKIPPED.
+
+	Parameters:
+		result (dict): Result of a task.
+		tasks (list): Tasks still to be processed.
+
+	Returns:
+		bool: True if any of the tasks are among the targets flagged in the
+		``skip_targets`` of the result, for the same sector and datasource.
+	"""
+	skip_targets = set(result.get('details', {}).get('skip_targets', []))
+	if not skip_targets:
+		return False
+	for task in tasks:
+		if task['starid'] in skip_targets and task['datasource'] == result['datasource'] and task['sector'] == result['sector']:
+			return True
+	return False
+
+#------------------------------------------------------------------------------
+def node_info():
+	"""
+	Information about the node the current process is running on.
+
+	Returns:
+		dict: Name of the node (``node``) and the memory currently available on the
+		node in bytes (``mem_available``). The latter is ``None`` if it could not be determined.
+	"""
+	mem_available = None
+	try:
+		with open('/proc/meminfo', 'r') as fid:
+			for line in fid:
+				if line.startswith('MemAvailable:'):
+					mem_available = int(line.split()[1]) * 1024
+					break
+	except (IOError, OSError, ValueError):
+		pass
+	return {'node': MPI.Get_processor_name(), 'mem_available': mem_available}
+
+#------------------------------------------------------------------------------
+class MemoryBudget(object):
+	"""
+	Keep track of the memory used by tasks running on each node.
+
+	Each worker holds on to the memory of the most memory-hungry task in the
+	batch it is currently processing. New tasks are only given to a worker if they
+	fit within what is left of the budget of its node, unless nothing else is running
+	on the node, in which case any task is allowed to run.
+	"""
+
+	def __init__(self, budget=None, fraction=0.9):
+		"""
+		Parameters:
+			budget (float, optional): Memory budget of each node in bytes. If not provided,
+				the budget of a node is set from the memory available on the node the first
+				time a worker on the node reports in.
+			fraction (float, optional): Fraction of the available memory to use
+				when ``budget`` is not provided. Default=0.9.
+		"""
+		self.budget = budget
+		self.fraction = fraction
+		self.nodes = {}
+		self.workers = {}
+
+	def register(self, worker, info):
+		"""
+		Register information reported by a worker.
+
+		Parameters:
+			worker (int): Rank of worker.
+			info (dict): Information about the node of the worker, as returned by :py:func:`node_info`.
+		"""
+		if worker in self.workers or not info:
+			return
+		node = info['node']
+		if node not in self.nodes:
+			if self.budget is not None:
+				budget = self.budget
+			elif info.get('mem_available') is not None:
+				budget = self.fraction * info['mem_available']
+			else:
+				budget = float('inf')
+			self.nodes[node] = {'budget': budget, 'committed': 0.0}
+		self.workers[worker] = {'node': node, 'memory': 0.0}
+
+	def release(self, worker):
+		"""Release the memory held by a worker."""
+		w = self.workers.get(worker)
+		if w is not None:
+			self.nodes[w['node']]['committed'] -= w['memory']
+			w['memory'] = 0.0
+
+	def available(self, worker):
+		"""
+		Memory available for new tasks for a worker.
+
+		Returns:
+			float: Memory in bytes. Infinite if the node of the worker is idle or unknown.
+		"""
+		w = self.workers.get(worker)
+		if w is None:
+			return float('inf')
+		node = self.nodes[w['node']]
+		if node['committed'] <= 0:
+			return float('inf')
+		return node['budget'] - node['committed']
+
+	def assign(self, worker, memory):
+		"""Reserve memory for a batch of tasks given to a worker."""
+		w = self.workers.get(worker)
+		if w is not None:
+			w['memory'] = memory
+			self.nodes[w['node']]['committed'] += memory
+
+#------------------------------------------------------------------------------
+class DatabaseThread(threading.Thread):
+	"""
+	Thread which owns the TaskManager and carries out all changes to the TODO-file.
+
+	The master loop hands out tasks directly from the in-memory queue of the
+	TaskManager, and only puts the corresponding changes to the TODO-file on
+	a queue, which this thread carries out in order. The delay between an
+	operation being queued and carried out is kept in the summary.
+	"""
+
+	def __init__(self, todo_file, **kwargs):
+		"""
+		Parameters:
+			todo_file (string): Path to the TODO-file, or the directory containing it (or its shards).
+			**kwargs: Additional keywords are passed to :py:class:`photometry.TaskManager`.
+		"""
+		threading.Thread.__init__(self, name='DatabaseThread')
+		self.daemon = True
+		self.todo_file = todo_file
+		self.kwargs = kwargs
+		self.tm = None
+		self.error = None
+		self.unresolved = 0
+		self._operations = queue.Queue()
+		self._ready = threading.Event()
+		self._lock = threading.Lock()
+		self._delays = {}
+
+	def run(self):
+		from photometry.shards import open_task_manager
+		try:
+			with open_task_manager(self.todo_file, **self.kwargs) as tm:
+				for key in ('master_delay', 'db_delay'):
+					self._delays[key] = [0, 0.0, 0.0]
+					tm.summary[key + '_mean'] = 0.0
+					tm.summary[key + '_max'] = 0.0
+				tm.summary['db_queue_size'] = 0
+				self.tm = tm
+				self._ready.set()
+
+				while True:
+					operation, args, queued = self._operations.get()
+					if operation == 'stop':
+						break
+
+					self.add_delays('db_delay', [default_timer() - queued])
+					tm.summary['db_queue_size'] = self._operations.qsize()
+
+					if operation == 'start':
+						for taskid in args:
+							tm.start_task(taskid)
+
+					elif operation == 'save':
+						results, returned = args
+						for result in results:
+							tm.save_result(result)
+						for task in returned:
+							tm.requeue_task(task['priority'])
+						with self._lock:
+							self.unresolved -= len(returned)
+		except:
+			self.error = traceback.format_exc().strip()
+		finally:
+			self._ready.set()
+
+	def wait_ready(self):
+		"""
+		Wait for the TaskManager to be ready.
+
+		Returns:
+			:py:class:`photometry.TaskManager`: The TaskManager owned by the thread.
+
+		Raises:
+			Exception: If the TaskManager could not be started.
+		"""
+		self._ready.wait()
+		if self.error:
+			raise Exception("Database thread failed: " + self.error)
+		return self.tm
+
+	def add_delays(self, key, delays):
+		"""Add queueing delays, in seconds, to the statistics in the summary."""
+		with self._lock:
+			stats = self._delays[key]
+			stats[0] += len(delays)
+			stats[1] += sum(delays)
+			stats[2] = max(stats[2], max(delays))
+			self.tm.summary[key + '_mean'] = stats[1] / stats[0]
+			self.tm.summary[key + '_max'] = stats[2]
+
+	def start_tasks(self, taskids):
+		"""Mark tasks as STARTED in the TODO-file."""
+		self._operations.put(('start', taskids, default_timer()))
+
+	def save_results(self, results, returned=[]):
+		"""
+		Save results in the TODO-file.
+
+		Parameters:
+			results (list): Results of tasks.
+			returned (list): Tasks marked as STARTED, which were not processed. After the results
+				have been saved, the ones not SKIPPED by the results are put back in the queue.
+		"""
+		with self._lock:
+			self.unresolved += len(returned)
+		self._operations.put(('save', (results, returned), default_timer()))
+
+	def stop(self):
+		"""Carry out all remaining operations, close the TaskManager and stop the thread."""
+		self._operations.put(('stop', None, default_timer()))
+		self.join()
+
+#------------------------------------------------------------------------------
+# MPI message tags:
+tags = enum.IntEnum('tags', ('READY', 'DONE', 'EXIT', 'START', 'EVICT'))
+
+#------------------------------------------------------------------------------
+def master(comm, db, batch_time=60.0, max_batch=50, memory=None, max_cores=1, staging=False):
+	"""
+	Master loop which hands out tasks to workers.
+
+	The workers are either single workers processing tasks themselves (see :py:func:`worker`),
+	or sub-masters handing out the tasks to a number of workers (see :py:func:`submaster`).
+	Sub-masters are given blocks of tasks, with room for all their workers, taken from the
+	same sector, camera and CCD as far as possible.
+
+	At the end of the run, when there are fewer tasks left than workers, the surplus workers
+	are stopped when they ask for more tasks, and their cores are given to the following
+	tasks started on the same node, which the photometry may then use (see the ``cores``
+	parameter of :py:class:`photometry.BasePhotometry`).
+
+	When the workers stage the input files of each CCD on their node, workers are given tasks
+	from CCDs which are already staged on their node as far as possible, and the staged files
+	are removed from the nodes once all tasks of the CCD are done.
+
+	Parameters:
+		comm (:py:class:`mpi4py.MPI.Comm`): Communicator with the master as rank 0.
+		db (:py:class:`DatabaseThread`): Running thread which owns the TaskManager.
+		batch_time (float): Target run time in seconds of each batch of tasks sent to a worker.
+		max_batch (int): Maximum number of tasks sent to a worker at once.
+		memory (:py:class:`MemoryBudget`, optional): Memory budget of the nodes. If not provided,
+			the memory used by the tasks is not taken into account.
+		max_cores (int): Maximum number of cores given to a single task at the end of the run.
+		staging (bool): Workers stage the input files on their node (see :py:mod:`photometry.staging`).
+			Removing the staged files is only done by workers talking directly to the master.
+	"""
+	from photometry.taskmanager import TaskQueue
+	from photometry.costmodel import estimate_memory
+
+	tm = db.tm
+	status = MPI.Status()
+
+	# Start the master loop that will assign tasks
+	# to the workers:
+	num_workers = comm.size - 1
+	closed_workers = 0
+	batch_size = BatchSize(batch_time=batch_time, max_size=max_batch, num_workers=num_workers)
+	slots = {} # Number of workers served by each worker or sub-master
+	busy = {} # Sub-masters which still have tasks running
+	waiting = [] # Workers waiting for tasks, and when they asked for them
+	nodes = {} # Node each worker is running on
+	active = set() # Workers (not sub-masters) which are still running
+	free_cores = defaultdict(int) # Cores of stopped workers, which tasks on each node may use
+	extra_cores = {} # Cores of stopped workers used by each worker
+	staged = defaultdict(set) # CCDs with input files staged on each node
+	running = defaultdict(int) # Number of tasks running from each CCD
+	assigned = defaultdict(dict) # Tasks handed out to each worker and not returned yet
+	requests = [] # Messages being sent to workers
+	delays = [] # Queueing delays of messages from workers
+	last_state = None # State of queue when tasks were last handed out
+	evict_state = None # State of queue when staged files were last checked
+	tm.logger.info("Master starting with %d workers", num_workers)
+	while closed_workers < num_workers:
+		if db.error:
+			raise Exception("Database thread failed: " + db.error)
+
+		# Check for information from workers:
+		message = comm.improbe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+		if message is not None:
+			arrival = default_timer()
+			data = message.recv()
+			source = status.Get_source()
+			tag = status.Get_tag()
+
+			if tag == tags.READY and data.get('workers', 1) > 1:
+				# A sub-master, which is asking for tasks on behalf of several workers:
+				slots[source] = data['workers']
+				batch_size.num_workers = num_workers - len(slots) + sum(slots.values())
+				tm.logger.info("Sub-master %d on node %s serving %d workers", source, data['node']['node'], data['workers'])
+
+			if tag in (tags.DONE, tags.READY):
+				nodes[source] = data['node']['node']
+				free_cores[nodes[source]] += extra_cores.pop(source, 0)
+				if tag == tags.READY and data.get('workers', 1) == 1:
+					active.add(source)
+
+			if tag in (tags.DONE, tags.READY) and memory is not None:
+				# Keep track of the node the worker is running on,
+				# and the memory it is no longer using:
+				memory.register(source, data['node'])
+				memory.release(source)
+
+			if tag == tags.DONE:
+				# The worker is done with a batch of tasks
+				tm.logger.info("Got %d results from worker %d", len(data['results']), source)
+				busy[source] = data.get('busy', False)
+				for task in data['results'] + data['unprocessed']:
+					running[TaskQueue.partition(task)] -= 1
+					assigned[source].pop(task['priority'], None)
+				for result in data['results']:
+					batch_size.update(result['time'])
+
+				# Targets still in the queue which may be marked as SKIPPED
+				# by these results are held back until the results are saved:
+				held = {}
+				for result in data['results']:
+					skip_targets = result.get('details', {}).get('skip_targets')
+					if skip_targets:
+						for task in tm.queue.find(skip_targets, result['datasource'], result['sector']):
+							held[task['priority']] = task
+				for taskid in held:
+					tm.queue.remove(taskid)
+				if held:
+					db.start_tasks(list(held.keys()))
+
+				# The worker may also have stopped before finishing the batch, because
+				# some of the remaining targets may have been SKIPPED.
+				# Any targets which were not, are put back in the queue:
+				db.save_results(data['results'], data['unprocessed'] + list(held.values()))
+
+			if tag == tags.READY or (tag == tags.DONE and data.get('request', True)):
+				# Worker is ready for more tasks
+				waiting.append((source, arrival))
+
+			elif tag == tags.EXIT:
+				# The worker has exited
+				tm.logger.info("Worker %d exited.", source)
+				closed_workers += 1
+				active.discard(source)
+				waiting = [w for w in waiting if w[0] != source]
+
+				# Release what the worker was holding, in case it stopped because something failed.
+				# Tasks it never returned are put back in the queue:
+				if memory is not None:
+					memory.release(source)
+				if source in nodes:
+					free_cores[nodes[source]] += extra_cores.pop(source, 0)
+				lost = list(assigned.pop(source, {}).values())
+				if lost:
+					tm.logger.warning("Worker %d exited without returning %d tasks", source, len(lost))
+					for task in lost:
+						running[TaskQueue.partition(task)] -= 1
+					db.save_results([], lost)
+
+			elif tag != tags.DONE:
+				# This should never happen, but just to
+				# make sure we don't run into an infinite loop:
+				raise Exception("Master received an unknown tag: '{0}'".format(tag))
+
+		# Send batches of tasks to the workers waiting for them.
+		# This is only needed if something has changed since last time:
+		state = (tm.get_number_tasks(), db.unresolved)
+
+		# Remove the staged input files of CCDs without any tasks left from the nodes,
+		# by asking one of the workers on each node to do it:
+		if staging and (message is not None or state != evict_state) and db.unresolved == 0:
+			remaining = set(tm.queue.partitions())
+			for node, partitions in staged.items():
+				drained = [p for p in partitions if running[p] <= 0 and p not in remaining]
+				if not drained: continue
+				for w in active:
+					if nodes.get(w) == node:
+						tm.logger.info("Removing staged files of %s from node %s", drained, node)
+						requests.append(comm.isend(drained, dest=w, tag=tags.EVICT))
+						break
+				partitions.difference_update(drained)
+			evict_state = state
+
+		if waiting and (message is not None or state != last_state):
+			still_waiting = []
+			for source, arrival in waiting:
+				# At the end of the run, workers which are not needed to run the remaining tasks
+				# are stopped, so the cores they were using can be given to other tasks:
+				if max_cores > 1 and source in active and db.unresolved == 0 and not any(busy.values()) \
+					and 0 < tm.get_number_tasks() < len(active):
+					tm.logger.info("Stopping worker %d to free its core for other tasks", source)
+					active.discard(source)
+					free_cores[nodes[source]] += 1
+					requests.append(comm.isend(None, dest=source, tag=tags.EXIT))
+					delays.append(default_timer() - arrival)
+					continue
+
+				# Only tasks which fit within the memory left on the node of the worker are sent:
+				accept = None
+				if memory is not None:
+					available = memory.available(source)
+					accept = lambda task: estimate_memory(task) <= available
+
+				# Sub-masters get tasks for all their workers, and as far as possible
+				# from the same CCD as the first task:
+				tasks = []
+				partition = None
+				if staging and source in active:
+					# Prefer tasks from CCDs which already have their files staged on the node:
+					for p in staged[nodes[source]]:
+						if tm.queue.peek(partition=p) is not None:
+							partition = p
+							break
+				for k in range(batch_size(tm.get_number_tasks()) * slots.get(source, 1)):
+					task = tm.queue.pop(partition=partition, accept=accept)
+					if not task and partition is not None:
+						task = tm.queue.pop(accept=accept)
+					if not task: break
+					tasks.append(task)
+					if source in slots:
+						partition = TaskQueue.partition(task)
+
+				# Give the tasks the cores of stopped workers on the same node:
+				if tasks and source in active and free_cores[nodes[source]] > 0:
+					extra_cores[source] = min(free_cores[nodes[source]], max_cores - 1)
+					free_cores[nodes[source]] -= extra_cores[source]
+					for task in tasks:
+						task['cores'] = 1 + extra_cores[source]
+					tm.logger.info("Giving %d cores to worker %d", 1 + extra_cores[source], source)
+
+				if tasks:
+					for task in tasks:
+						running[TaskQueue.partition(task)] += 1
+						assigned[source][task['priority']] = task
+						if staging and source in active:
+							staged[nodes[source]].add(TaskQueue.partition(task))
+					if memory is not None:
+						memory.assign(source, max([estimate_memory(task) for task in tasks]))
+					db.start_tasks([task['priority'] for task in tasks])
+					requests.append(comm.isend(tasks, dest=source, tag=tags.START))
+					tm.logger.info("Sending %d tasks to worker %d: %s", len(tasks), source, [task['priority'] for task in tasks])
+				elif tm.get_number_tasks() > 0 or db.unresolved > 0 or busy.get(source):
+					# Either no tasks fit in memory right now, tasks are deferred until
+					# other tasks are done, tasks may still be put back in the queue,
+					# or the sub-master is still running tasks which may do so,
+					# so let the worker wait:
+					still_waiting.append((source, arrival))
+					continue
+				else:
+					active.discard(source)
+					requests.append(comm.isend(None, dest=source, tag=tags.EXIT))
+
+				delays.append(default_timer() - arrival)
+			waiting = still_waiting
+			last_state = (tm.get_number_tasks(), db.unresolved)
+
+		# Clean up messages which have been delivered:
+		requests = [req for req in requests if not req.Test()]
+
+		# Update statistics on the queueing delay in the master:
+		if delays:
+			db.add_delays('master_delay', delays)
+			delays = []
+
+		# Avoid spinning at full speed while waiting for workers:
+		if message is None:
+			time.sleep(0.001)
+
+	for req in requests:
+		req.wait()
+	tm.logger.info("Master finishing")
+
+#------------------------------------------------------------------------------
+def submaster(upper, lower, batch_time=60.0, max_batch=50, memory_budget=None, flush_interval=30.0):
+	"""
+	Sub-master loop which hands out tasks to the workers on a single node.
+
+	Towards the master, the sub-master behaves like a single worker serving several
+	workers: It asks for blocks of tasks for all the workers on the node, and sends the
+	results back in bulk. A new block is asked for before the workers run out of tasks,
+	and results are sent back at least every ``flush_interval`` seconds, so the TODO-file
+	and summary are kept up to date. Results are otherwise handled as in the master,
+	including holding back targets which may be SKIPPED by results from other targets.
+
+	Parameters:
+		upper (:py:class:`mpi4py.MPI.Comm`): Communicator with the master as rank 0.
+		lower (:py:class:`mpi4py.MPI.Comm`): Communicator with the sub-master as rank 0
+			and the workers on the node.
+		batch_time (float): Target run time in seconds of each batch of tasks sent to a worker.
+		max_batch (int): Maximum number of tasks sent to a worker at once.
+		memory_budget (float, optional): Memory budget of the node in bytes.
+		flush_interval (float): Maximum time in seconds between sending results to the master.
+	"""
+	from photometry.taskmanager import TaskQueue
+	from photometry.costmodel import estimate_memory
+
+	logger = logging.getLogger('photometry')
+	status = MPI.Status()
+	num_workers = lower.size - 1
+	local = TaskQueue()
+	batch_size = BatchSize(batch_time=batch_time, max_size=max_batch, num_workers=num_workers)
+	memory = MemoryBudget(budget=memory_budget)
+	waiting = [] # Workers waiting for tasks
+	running = 0 # Workers processing tasks
+	closed_workers = 0
+	requests = [] # Messages being sent
+	results = [] # Results not yet sent to the master
+	unprocessed = [] # Tasks to give back to the master
+	exiting = False
+	last_flush = default_timer()
+
+	upper.send({'node': node_info(), 'workers': num_workers}, dest=0, tag=tags.READY)
+	requested = True
+	while closed_workers < num_workers:
+		# Check for tasks from the master:
+		message_upper = upper.improbe(source=0, tag=MPI.ANY_TAG, status=status)
+		if message_upper is not None:
+			data = message_upper.recv()
+			tag = status.Get_tag()
+			requested = False
+			if tag == tags.START:
+				for task in data:
+					local.push(task)
+			elif tag == tags.EXIT:
+				# Nothing more to do, and nothing is running on the node:
+				exiting = True
+			else:
+				raise Exception("Sub-master received an unknown tag: '{0}'".format(tag))
+
+		# Check for information from the workers:
+		message = lower.improbe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+		if message is not None:
+			data = message.recv()
+			source = status.Get_source()
+			tag = status.Get_tag()
+
+			if tag in (tags.DONE, tags.READY):
+				memory.register(source, data['node'])
+				memory.release(source)
+				if tag == tags.READY or data.get('request', True):
+					waiting.append(source)
+
+			if tag == tags.DONE:
+				running -= 1
+				for result in data['results']:
+					batch_size.update(result['time'])
+					# Targets in the local queue which may be marked as SKIPPED by this
+					# result are given back to the master along with the result:
+					skip_targets = result.get('details', {}).get('skip_targets')
+					if skip_targets:
+						for task in local.find(skip_targets, result['datasource'], result['sector']):
+							local.remove(task['priority'])
+							unprocessed.append(task)
+				results += data['results']
+				unprocessed += data['unprocessed']
+
+			elif tag == tags.EXIT:
+				closed_workers += 1
+				memory.release(source)
+
+			elif tag != tags.READY:
+				raise Exception("Sub-master received an unknown tag: '{0}'".format(tag))
+
+		# Send batches of tasks to the workers waiting for them:
+		if waiting and (len(local) > 0 or exiting):
+			still_waiting = []
+			for source in waiting:
+				available = memory.available(source)
+				accept = lambda task: estimate_memory(task) <= available
+				tasks = []
+				for k in range(batch_size(len(local))):
+					task = local.pop(accept=accept)
+					if not task: break
+					tasks.append(task)
+
+				if tasks:
+					memory.assign(source, max([estimate_memory(task) for task in tasks]))
+					requests.append(lower.isend(tasks, dest=source, tag=tags.START))
+					running += 1
+				elif exiting:
+					requests.append(lower.isend(None, dest=source, tag=tags.EXIT))
+				else:
+					still_waiting.append(source)
+			waiting = still_waiting
+
+		# Ask the master for more tasks before the workers run out,
+		# or send results back if the node has run out of tasks or it has been a while:
+		busy = running > 0 or len(local) > 0
+		if not exiting:
+			request = not requested and len(local) < num_workers
+			if request or ((results or unprocessed) and (not busy or default_timer() - last_flush > flush_interval)):
+				requests.append(upper.isend({
+					'results': results,
+					'unprocessed': unprocessed,
+					'node': node_info(),
+					'request': request,
+					'busy': busy
+				}, dest=0, tag=tags.DONE))
+				requested = requested or request
+				results = []
+				unprocessed = []
+				last_flush = default_timer()
+
+		# Clean up messages which have been delivered:
+		requests = [req for req in requests if not req.Test()]
+
+		# Avoid spinning at full speed while waiting:
+		if message is None and message_upper is None:
+			time.sleep(0.001)
+
+	for req in requests:
+		req.wait()
+	logger.info("Sub-master finishing")
+	upper.send(None, dest=0, tag=tags.EXIT)
+
+#------------------------------------------------------------------------------
+def worker(comm, process, evict=None):
+	"""
+	Worker loop which processes the tasks it is given.
+
+	Parameters:
+		comm (:py:class:`mpi4py.MPI.Comm`): Communicator with the master (or sub-master) as rank 0.
+		process (callable): Function processing a single task, returning the result.
+		evict (callable, optional): Function removing the staged input files of a list
+			of (sector, camera, ccd) from the node.
+	"""
+	logger = logging.getLogger('photometry')
+	status = MPI.Status()
+	results = None # Results of the batch being processed
+	unprocessed = None # Tasks of the batch not processed yet
+
+	try:
+		# Send signal that we are ready for task:
+		comm.send({'node': node_info()}, dest=0, tag=tags.READY)
+
+		while True:
+			# Receive a task from the master:
+			task = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+			tag = status.Get_tag()
+
+			if tag == tags.START:
+				# Do the work here
+				results = []
+				unprocessed = list(task)
+				while unprocessed:
+					task = unprocessed[0]
+					result = process(task)
+					unprocessed.pop(0)
+					results.append(result)
+
+					# If this target may cause some of the remaining targets in the batch
+					# to be SKIPPED, stop here and return the rest of the batch to the master,
+					# which will decide which of them still need to be processed:
+					if affects_remaining(result, unprocessed):
+						break
+
+					# Attempt some cleanup:
+					# TODO: Is this even needed?
+					del task, result
+
+				# Send the results back to the master:
+				comm.send({'results': results, 'unprocessed': unprocessed, 'node': node_info()}, dest=0, tag=tags.DONE)
+				results = unprocessed = None
+
+			elif tag == tags.EVICT:
+				# The tasks of these CCDs are all done, so the staged files can be removed:
+				if evict is not None:
+					evict(task)
+
+			elif tag == tags.EXIT:
+				# We were told to EXIT, so lets do that
+				break
+
+			else:
+				# This should never happen, but just to
+				# make sure we don't run into an infinite loop:
+				raise Exception("Worker received an unknown tag: '{0}'".format(tag))
+
+	except:
+		logger.exception("Something failed in worker")
+
+		# Send back the results of the batch we were in the middle of, and the tasks
+		# which were not processed, so the master can save them and put the rest back
+		# in the queue. We are not asking for more tasks, since we are about to exit:
+		if results is not None:
+			try:
+				comm.send({'results': results, 'unprocessed': unprocessed, 'node': node_info(), 'request': False}, dest=0, tag=tags.DONE)
+			except:
+				logger.exception("Could not send results back")
+
+	finally:
+		comm.send(None, dest=0, tag=tags.EXIT)
 
 #------------------------------------------------------------------------------
 def main():
@@ -38,70 +812,66 @@ def main():
 	#parser.add_argument('-q', '--quiet', help='Only report warnings and errors.', action='store_true')
 	parser.add_argument('-o', '--overwrite', help='Overwrite existing results.', action='store_true')
 	parser.add_argument('-p', '--plot', help='Save plots when running.', action='store_true')
+	parser.add_argument('--write-behind', help='Commit results to the TODO-file in batches instead of after every task.', action='store_true')
+	parser.add_argument('--order', help='Order in which to process tasks. "cost" runs the tasks expected to take the longest first.', choices=('priority', 'cost'), default='priority')
+	parser.add_argument('--batch-time', type=float, help='Target run time in seconds of each batch of tasks sent to a worker.', default=60.0)
+	parser.add_argument('--max-batch', type=int, help='Maximum number of tasks sent to a worker at once. Setting this to 1 disables batching.', default=50)
+	parser.add_argument('--predicted-skips', help='How to handle targets predicted to be skipped because of a brighter target. "defer" waits for the brighter target to finish, "skip" skips them up front.', choices=('defer', 'skip'), default=None)
+	parser.add_argument('--memory-budget', type=float, help='Memory budget of each node in GB. By default 90%% of the memory available on the node is used.', default=None)
+	parser.add_argument('--sub-masters', help='Use a sub-master on each node, which hands out tasks to the workers on the node.', action='store_true')
+	parser.add_argument('--flush-interval', type=float, help='Maximum time in seconds between sub-masters sending results to the master.', default=30.0)
+	parser.add_argument('--stage-folder', type=str, help='Folder on storage local to each node, where the HDF5 and catalog files of each CCD are copied to before they are used. Environment variables are expanded on each node. Default is taken from the TESSPHOT_STAGE environment variable.', default=os.environ.get('TESSPHOT_STAGE'))
+	parser.add_argument('--secondary-targets', help='Also extract lightcurves of the other targets in the stamp of each target using aperture photometry.', action='store_true')
+	parser.add_argument('--tail-cores', type=int, help='Maximum number of cores given to each of the last tasks of the run, using the cores of workers with nothing left to do. Not used with sub-masters.', default=1)
 	args = parser.parse_args()
 
 	# Get paths to input and output files from environment variables:
 	input_folder = os.environ.get('TESSPHOT_INPUT', os.path.join(os.path.dirname(__file__), 'tests', 'input'))
 	output_folder = os.environ.get('TESSPHOT_OUTPUT', os.path.abspath('.'))
-	todo_file = os.path.join(input_folder, 'todo.sqlite')
-
-	# Define MPI message tags
-	tags = enum.IntEnum('tags', ('READY', 'DONE', 'EXIT', 'START'))
 
 	# Initializations and preliminaries
 	comm = MPI.COMM_WORLD   # get MPI communicator object
-	size = comm.size        # total number of processes
 	rank = comm.rank        # rank of this process
-	status = MPI.Status()   # get MPI status object
+	memory_budget = None if args.memory_budget is None else args.memory_budget * 1024**3
+
+	# When using sub-masters, the lowest rank on each node (apart from the master)
+	# is the sub-master of the node. The master only talks to the sub-masters,
+	# which in turn talk to the workers on their node:
+	upper = comm
+	lower = None
+	if args.sub_masters:
+		node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED, key=rank)
+		node_ranks = [r for r in node_comm.allgather(rank) if r != 0]
+		is_submaster = bool(node_ranks) and rank == min(node_ranks)
+		upper = comm.Split(0 if rank == 0 or is_submaster else MPI.UNDEFINED, key=rank)
+		lower = node_comm.Split(0 if rank != 0 else MPI.UNDEFINED, key=rank)
+		node_comm.Free()
+		if rank != 0 and not is_submaster:
+			upper = lower
 
 	if rank == 0:
 		# Master process executes code below
-		from photometry import TaskManager
-
 		try:
-			with TaskManager(todo_file, cleanup=True, overwrite=args.overwrite, summary=os.path.join(output_folder, 'summary.json')) as tm:
+			# Start the thread which takes care of all changes to the TODO-file,
+			# so the master loop never has to wait for the database:
+			db = DatabaseThread(input_folder, cleanup=True, overwrite=args.overwrite, summary=os.path.join(output_folder, 'summary.json'), write_behind=args.write_behind, in_memory_queue=True, order=args.order, predicted_skips=args.predicted_skips)
+			db.start()
+			try:
+				tm = db.wait_ready()
+
+				# Make sure changes to the TODO-file are written if we are asked to terminate:
+				signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
 				# Get list of tasks:
 				numtasks = tm.get_number_tasks()
 				tm.logger.info("%d tasks to be run", numtasks)
 
-				# Start the master loop that will assign tasks
-				# to the workers:
-				num_workers = size - 1
-				closed_workers = 0
-				tm.logger.info("Master starting with %d workers", num_workers)
-				while closed_workers < num_workers:
-					# Ask workers for information:
-					data = comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
-					source = status.Get_source()
-					tag = status.Get_tag()
-
-					if tag == tags.DONE:
-						# The worker is done with a task
-						tm.logger.info("Got data from worker %d: %s", source, data)
-						tm.save_result(data)
-
-					if tag in (tags.DONE, tags.READY):
-						# Worker is ready, so send it a task
-						task = tm.get_task()
-						if task:
-							task_index = task['priority']
-							tm.start_task(task_index)
-							comm.send(task, dest=source, tag=tags.START)
-							tm.logger.info("Sending task %d to worker %d", task_index, source)
-						else:
-							comm.send(None, dest=source, tag=tags.EXIT)
-
-					elif tag == tags.EXIT:
-						# The worker has exited
-						tm.logger.info("Worker %d exited.", source)
-						closed_workers += 1
-
-					else:
-						# This should never happen, but just to
-						# make sure we don't run into an infinite loop:
-						raise Exception("Master received an unknown tag: '{0}'".format(tag))
-
-				tm.logger.info("Master finishing")
+				# With sub-masters, the memory budget is handled by each sub-master:
+				memory = None if args.sub_masters else MemoryBudget(budget=memory_budget)
+				master(upper, db, batch_time=args.batch_time, max_batch=args.max_batch, memory=memory, max_cores=args.tail_cores, staging=args.stage_folder is not None)
+
+			finally:
+				db.stop()
 
 		except:
 			# If something fails in the master
@@ -109,10 +879,6 @@ def main():
 			comm.Abort(1)
 
 	else:
-		# Worker processes execute code below
-		from photometry import tessphot
-		from timeit import default_timer
-
 		# Configure logging within photometry:
 		formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 		console = logging.StreamHandler()
@@ -121,52 +887,49 @@ def main():
 		logger.addHandler(console)
 		logger.setLevel(logging.WARNING)
 
-		try:
-			# Send signal that we are ready for task:
-			comm.send(None, dest=0, tag=tags.READY)
-
-			while True:
-				# Receive a task from the master:
-				task = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
-				tag = status.Get_tag()
-
-				if tag == tags.START:
-					# Do the work here
-					result = task.copy()
-					del task['priority'], task['tmag']
-
-					t1 = default_timer()
-					pho = tessphot(input_folder=input_folder, output_folder=output_folder, plot=args.plot, **task)
-					t2 = default_timer()
-
-					# Construct result message:
-					result.update({
-						'status': pho.status,
-						'time': t2 - t1,
-						'details': pho._details
-					})
-
-					# Send the result back to the master:
-					comm.send(result, dest=0, tag=tags.DONE)
-
-					# Attempt some cleanup:
-					# TODO: Is this even needed?
-					del pho, task, result
-
-				elif tag == tags.EXIT:
-					# We were told to EXIT, so lets do that
-					break
-
-				else:
-					# This should never happen, but just to
-					# make sure we don't run into an infinite loop:
-					raise Exception("Worker received an unknown tag: '{0}'".format(tag))
-
-		except:
-			logger.exception("Something failed in worker")
-
-		finally:
-			comm.send(None, dest=0, tag=tags.EXIT)
+		if lower is not None and upper is not lower and lower.size > 1:
+			# Sub-master process executes code below
+			try:
+				submaster(upper, lower, batch_time=args.batch_time, max_batch=args.max_batch, memory_budget=memory_budget, flush_interval=args.flush_interval)
+			except:
+				print(traceback.format_exc().strip())
+				comm.Abort(1)
+
+		else:
+			# Worker processes execute code below
+			# A sub-master without any other processes on its node simply acts as a worker.
+			from photometry import tessphot
+			from photometry.staging import staging_folder, stage_files, evict_files
+			stage_folder = staging_folder(args.stage_folder)
+
+			def process(task):
+				result = task.copy()
+				task = dict(task)
+				del task['priority'], task['tmag']
+
+				t1 = default_timer()
+				if stage_folder is not None:
+					try:
+						stage_files(input_folder, stage_folder, task['sector'], task['camera'], task['ccd'])
+					except (IOError, OSError):
+						# The files are simply loaded from the input folder instead:
+						logger.exception("Could not stage files")
+				pho = tessphot(input_folder=input_folder, output_folder=output_folder, plot=args.plot, stage_folder=stage_folder, secondary_targets=args.secondary_targets, **task)
+				t2 = default_timer()
+
+				# Construct result message:
+				result.update({
+					'status': pho.status,
+					'time': t2 - t1,
+					'details': pho._details
+				})
+				return result
+
+			def evict(partitions):
+				for sector, camera, ccd in partitions:
+					evict_files(stage_folder, sector, camera, ccd)
+
+			worker(upper, process, evict=evict if stage_folder is not None else None)
 
 if __name__ == '__main__':
-	main()
\ No newline at end of file
+	main()
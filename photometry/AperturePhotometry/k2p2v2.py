@@ -135,6 +135,72 @@ def run_DBSCAN(X2, Y2, cluster_radius, min_for_cluster):
 
 	return XX, labels, core_samples_mask
 
+#==============================================================================
+# Connected-component clustering
+#==============================================================================
+def run_label(X2, Y2, cluster_radius, min_for_cluster):
+	"""
+	Cluster pixels using connected-component labelling.
+
+	On a regular grid of pixels, DBSCAN with a radius below 2 pixels is the same as
+	labelling the connected components of the core pixels, using the neighbourhood
+	given by the radius, and then assigning each border pixel to the neighbouring
+	cluster found first. This gives exactly the same result as :py:func:`run_DBSCAN`,
+	but is much faster for large clusters.
+
+	Parameters:
+		X2 (ndarray): Column of each point.
+		Y2 (ndarray): Row of each point.
+		cluster_radius (float): Radius from each point to consider inside cluster. Must be less than 2.
+		min_for_cluster (integer): Minimum number of points to consider a cluster.
+
+	Returns:
+		ndarray: Coordinates of points.
+		ndarray: Labels of each point.
+		ndarray: Boolean array which is `True` if the correspondig point is considered a core point.
+
+	Raises:
+		ValueError: If the radius is 2 or larger, where the neighbourhood of a pixel is not
+			limited to the 8 surrounding pixels.
+	"""
+
+	if cluster_radius >= 2:
+		raise ValueError("Connected-component clustering only supports cluster radius below 2.")
+
+	X2 = np.asarray(X2, dtype='int64')
+	Y2 = np.asarray(Y2, dtype='int64')
+	XX = np.column_stack((X2, Y2))
+	if len(XX) == 0:
+		return XX, np.zeros(0, dtype='int64'), np.zeros(0, dtype='bool')
+
+	# Neighbourhood of each pixel, including the pixel itself:
+	dy, dx = np.mgrid[-1:2, -1:2]
+	footprint = (np.sqrt(dx**2 + dy**2) <= cluster_radius)
+
+	# Image of the points:
+	ix = X2 - X2.min()
+	iy = Y2 - Y2.min()
+	img = np.zeros((iy.max()+1, ix.max()+1), dtype='bool')
+	img[iy, ix] = True
+
+	# Core points have at least min_for_cluster points in their neighbourhood:
+	neighbours = ndimage.convolve(img.astype('int32'), footprint.astype('int32'), mode='constant', cval=0)
+	core = img & (neighbours >= min_for_cluster)
+
+	# Clusters are the connected groups of core points. Like in DBSCAN, they are
+	# numbered in the order their first point is found, scanning row by row:
+	clusters, _ = ndimage.label(core, structure=footprint)
+
+	# Border points are given to the first cluster among the neighbouring core points,
+	# which is the one DBSCAN would reach them from first:
+	nolabel = np.iinfo(clusters.dtype).max
+	border = ndimage.minimum_filter(np.where(core, clusters, nolabel), footprint=footprint, mode='constant', cval=nolabel)
+	clusters = np.where(core, clusters, np.where(border == nolabel, 0, border))
+
+	labels = clusters[iy, ix] - 1
+	core_samples_mask = core[iy, ix]
+	return XX, labels, core_samples_mask
+
 #==============================================================================
 # Segment clusters using watershed
 #==============================================================================
@@ -149,9 +215,6 @@ def k2p2WS(X, Y, X2, Y2, flux0, XX, labels, core_samples_mask, saturated_masks=N
 
 	unique_labels_ini = set(labels)
 
-
-	XX2 = np.array([[x,y] for x,y in zip(X.flatten(),Y.flatten())])
-
 	Labels = np.ones_like(flux0)*-2
 	Labels[XX[:,1], XX[:,0]] = labels
 
@@ -163,20 +226,16 @@ def k2p2WS(X, Y, X2, Y2, flux0, XX, labels, core_samples_mask, saturated_masks=N
 
 	max_label = np.max(labels)
 
-	for i in range(len(unique_labels_ini)):
-
-		lab = list(unique_labels_ini)[i]
+	for i, lab in enumerate(unique_labels_ini):
 
 		if lab == -1 or lab == -2:
 			continue
 
 		# select class members - non-core members have been set to noise
-		class_member_mask = (Labels == lab).flatten()
-		xy = XX2[class_member_mask,:]
-
+		class_member_mask = (Labels == lab)
 
 		Z = np.zeros_like(flux0, dtype='float64')
-		Z[xy[:,1], xy[:,0]] = flux0[xy[:,1], xy[:,0]] #y=row, x=column
+		Z[class_member_mask] = flux0[class_member_mask]
 
 		if ws_alg == 'dist':
 			distance0 = ndimage.distance_transform_edt(Z)
@@ -196,16 +255,13 @@ def k2p2WS(X, Y, X2, Y2, flux0, XX, labels, core_samples_mask, saturated_masks=N
 			# Find maxima in the basin image to use for markers:
 			local_maxi_loc = peak_local_max(distance, indices=True, exclude_border=False, threshold_rel=ws_thres, footprint=np.ones((ws_footprint, ws_footprint)))
 
-			for c in catalog:
-				d = np.sqrt( (local_maxi_loc[:,1] - c[0])**2 + (local_maxi_loc[:,0] - c[1])**2 )
-				indx = np.argmin(d)
-				if c[2] > saturation_limit:
-					dist_factor = 2.0
-				else:
-					dist_factor = 5.0
-
-				if d[indx] < dist_factor*np.sqrt(2):
-					local_maxi[local_maxi_loc[indx,0], local_maxi_loc[indx,1]] = True
+			# Use the maxima closest to each star in the catalog, if they are close enough:
+			if len(catalog) > 0 and len(local_maxi_loc) > 0:
+				d = np.sqrt( (local_maxi_loc[np.newaxis,:,1] - catalog[:,0,np.newaxis])**2 + (local_maxi_loc[np.newaxis,:,0] - catalog[:,1,np.newaxis])**2 )
+				indx = np.argmin(d, axis=1)
+				dist_factor = np.where(catalog[:,2] > saturation_limit, 2.0, 5.0)
+				close = (d[np.arange(len(catalog)), indx] < dist_factor*np.sqrt(2))
+				local_maxi[local_maxi_loc[indx[close],0], local_maxi_loc[indx[close],1]] = True
 
 			"""
 			for m in local_maxi_loc:
@@ -245,20 +301,20 @@ def k2p2WS(X, Y, X2, Y2, flux0, XX, labels, core_samples_mask, saturated_masks=N
 			# Split the saturated pixels up into patches that are connected:
 			sat_labels, numfeatures = ndimage.label(saturated_pixels)
 
-			# Loop through the patches of saturated pixels:
-			for k in range(1, numfeatures+1):
+			# Number of local maxima found within each patch of saturated pixels:
+			maxima_in_patch = np.bincount(sat_labels[local_maxi], minlength=numfeatures+1)
+
+			# Loop through the patches of saturated pixels with more than one local maximum:
+			for k in np.nonzero(maxima_in_patch[1:] > 1)[0] + 1:
 				# This mask of saturated pixels:
 				sp = saturated_pixels & (sat_labels == k)
 
-				# Check if there is more than one local maximum found
-				# within this patch of saturated pixels:
-				if np.sum(local_maxi & sp) > 1:
-					# Find the local maximum with the highest value that is also saturated:
-					imax = np.unravel_index(np.nanargmax(distance * local_maxi * sp), distance.shape)
-					# Only keep the maximum with the highest value and remove all
-					# the others if they are saturated:
-					local_maxi[sp] = False
-					local_maxi[imax] = True
+				# Find the local maximum with the highest value that is also saturated:
+				imax = np.unravel_index(np.nanargmax(distance * local_maxi * sp), distance.shape)
+				# Only keep the maximum with the highest value and remove all
+				# the others if they are saturated:
+				local_maxi[sp] = False
+				local_maxi[imax] = True
 
 		# Assign markers/labels to the found maxima:
 		markers = ndimage.label(local_maxi)[0]
@@ -268,7 +324,7 @@ def k2p2WS(X, Y, X2, Y2, flux0, XX, labels, core_samples_mask, saturated_masks=N
 			logger.error("No maxima were found as basins for watershed!")
 
 			# Set all cluster points to noise, so the cluster is effectively rejected:
-			Labels[xy[:,1], xy[:,0]] = -1
+			Labels[class_member_mask] = -1
 			labels_ws = Labels
 		else:
 			# Run the watershed segmentation algorithm on the negative
@@ -276,11 +332,11 @@ def k2p2WS(X, Y, X2, Y2, flux0, XX, labels, core_samples_mask, saturated_masks=N
 			labels_ws = watershed(-distance0, markers, mask=Z)
 
 			# The number of masks after the segmentation:
-			no_labels = len(set(labels_ws.flatten()))
+			no_labels = len(np.unique(labels_ws))
 
 			# Set all original cluster points to noise, in this way things that in the
 			# end is not associated with a "new" cluster will not be used any more
-			Labels[xy[:,1], xy[:,0]] = -1
+			Labels[class_member_mask] = -1
 
 			# Use the original label for a part of the new cluster -  if only
 			# one cluster is identified by the watershed algorithm this will then
@@ -290,15 +346,9 @@ def k2p2WS(X, Y, X2, Y2, flux0, XX, labels, core_samples_mask, saturated_masks=N
 
 			# If the cluster is segmented we will assign these new labels, starting from
 			# the highest original label + 1
-			for u in range(no_labels-2):
-				max_label += 1
-
-				idx = (labels_ws==u+2) & (Z!=0)
-				Labels[idx] = max_label
-
-		labels_new = Labels[Y2, X2]
-		unique_labels = set(labels_new)
-		NoCluster = len(unique_labels) - (1 if -1 in labels_new else 0)
+			idx = (labels_ws >= 2) & (labels_ws <= no_labels-1) & (Z != 0)
+			Labels[idx] = max_label + labels_ws[idx] - 1
+			max_label += max(no_labels-2, 0)
 
 		# Create plot of the watershed segmentation:
 		if not output_folder is None:
@@ -334,6 +384,10 @@ def k2p2WS(X, Y, X2, Y2, flux0, XX, labels, core_samples_mask, saturated_masks=N
 			save_figure(os.path.join(output_folder, figname))
 			plt.close(fig)
 
+	labels_new = Labels[Y2, X2]
+	unique_labels = set(labels_new)
+	NoCluster = len(unique_labels) - (1 if -1 in labels_new else 0)
+
 	return labels_new, unique_labels, NoCluster
 
 #==============================================================================
@@ -346,58 +400,161 @@ def k2p2_saturated(SumImage, MASKS, idx):
 
 	no_masks = MASKS.shape[0]
 
-	column_mask = np.zeros_like(SumImage, dtype='bool')
 	saturated_mask = np.zeros_like(MASKS, dtype='bool')
 	pixels_added = 0
 
+	# Number the unbroken runs of pixels with significant flux along each column,
+	# so pixels in the same column with the same number are directly connected:
+	runs = np.cumsum(~idx, axis=0)
+
 	# Loop through the different masks:
 	for u in range(no_masks):
 		# Create binary version of mask and extract
-		# the rows and columns which it spans and
+		# the columns which it spans and
 		# the highest value in it:
 		mask = np.asarray(MASKS[u, :, :], dtype='bool')
-		mask_rows, mask_columns = np.where(mask)
+		mask_columns = np.nonzero(np.any(mask, axis=0))[0]
 		mask_max = np.nanmax(SumImage[mask])
 
 		# Loop through the columns of the mask:
-		for c in set(mask_columns):
-
-			column_mask[:, c] = True
-
+		for c in mask_columns:
 			# Extract the pixels that are in this column and in the mask:
-			pixels = SumImage[mask & column_mask]
+			column = SumImage[:, c]
+			column_in_mask = mask[:, c]
+			pixels = column[column_in_mask]
 
 			# Calculate ratio as defined in Lund & Handberg (2014):
 			ratio = np.abs(nanmedian(np.diff(pixels)))/np.nanmax(pixels)
 			if ratio < 0.01 and nanmedian(pixels) >= mask_max/2:
 				logger.debug("Column %d - RATIO = %f - Saturated", c, ratio)
 
-				# Has significant flux and is in saturated column:
-				add_to_mask = (idx & column_mask)
-
-				# Make sure the pixels we add are directly connected to the highest flux pixel:
-				new_mask_labels, numfeatures = ndimage.label(add_to_mask)
-				imax = np.unravel_index(np.nanargmax(SumImage * mask * column_mask), SumImage.shape)
-				add_to_mask &= (new_mask_labels == new_mask_labels[imax])
+				# Has significant flux and is in saturated column, and is
+				# directly connected to the highest flux pixel:
+				imax = np.nanargmax(column * column_in_mask)
+				if idx[imax, c]:
+					add_to_mask = idx[:, c] & (runs[:, c] == runs[imax, c])
+				else:
+					add_to_mask = np.zeros_like(column_in_mask)
 
 				# Modify the mask:
-				pixels_added += np.sum(add_to_mask) - np.sum(mask[column_mask])
-				logger.debug("  %d pixels should be added to column %d", np.sum(add_to_mask) - np.sum(mask[column_mask]), c)
-				saturated_mask[u][add_to_mask] = True
+				added = np.sum(add_to_mask) - np.sum(column_in_mask)
+				pixels_added += added
+				logger.debug("  %d pixels should be added to column %d", added, c)
+				saturated_mask[u, add_to_mask, c] = True
 			else:
 				logger.debug("Column %d - RATIO = %f", c, ratio)
 
-			column_mask[:, c] = False
-
 	return saturated_mask, pixels_added
 
+#==============================================================================
+# Estimate background level of Sum-image
+#==============================================================================
+def k2p2_background(SumImage, method='kde'):
+	"""
+	Estimate the background level and scatter of a sum-image.
+
+	The background level is found as the mode of the distribution of the pixel values,
+	after cutting away the brightest pixels, and the scatter as the MAD of the pixels
+	below the mode.
+
+	Parameters:
+		SumImage (ndarray): Sum-image.
+		method (string, optional): Method used to estimate the distribution of pixel values.
+			Choices are ``'kde'``, which fits a Gaussian KDE and finds its maximum by
+			minimization, and ``'histogram'``, which smooths a finely binned histogram with
+			the same Gaussian kernel and takes the maximum on the grid. Default='kde'.
+
+	Returns:
+		dict: Dictionary with the background level (``mode``), the scatter converted to
+		a standard deviation (``mad``), the bandwidth of the kernel (``bandwidth``) and the
+		estimated distribution (``support`` and ``density``).
+
+	Raises:
+		K2P2NoFlux: If there is no measured flux in the sum-image.
+		ValueError: If an invalid method is given.
+
+	.. codeauthor:: Rasmus Handberg <rasmush@phys.au.dk>
+	.. codeauthor:: Mikkel Lund <mnl@phys.au.dk>
+	"""
+
+	# Get logger for printing messages:
+	logger = logging.getLogger(__name__)
+
+	if method not in ('kde', 'histogram'):
+		raise ValueError("Invalid background method: '%s'" % method)
+
+	# Cut out pixels from sum image which were collected and contains flux
+	# and flatten the 2D image to 1D array:
+	Flux = SumImage[~np.isnan(SumImage)].flatten()
+	Flux = Flux[Flux > 0]
+
+	# Check if there was actually any flux measured:
+	if len(Flux) == 0:
+		raise K2P2NoFlux("No measured flux in sum-image")
+
+	# Cut away the top 15% of the fluxes:
+	if method == 'kde':
+		flux_cut = stats.trim1(np.sort(Flux), 0.15)
+	else:
+		# The same pixels as above, but without sorting all of them:
+		uppercut = len(Flux) - int(0.15*len(Flux))
+		flux_cut = np.partition(Flux, uppercut-1)[:uppercut]
+	# Also do a cut on the absolute values of pixel - This helps in cases where
+	# the image is dominated by saturated pixels. The exact value is of course
+	# in principle dependent on the CCD, but we have found this value to be
+	# reasonable in TESS simulated data:
+	flux_cut = flux_cut[flux_cut < 70000]
+
+	# Estimate the bandwidth we are going to use for the background:
+	background_bandwidth = select_bandwidth(flux_cut, bw='scott', kernel='gau')
+	logger.debug("  Sum-image KDE bandwidth: %f", background_bandwidth)
+
+	if method == 'kde':
+		# Make the Kernel Density Estimation of the fluxes:
+		kernel = KDE(flux_cut)
+		kernel.fit(kernel='gau', bw=background_bandwidth, fft=True, gridsize=100)
+		support = kernel.support
+		density = kernel.density
+
+		# MODE
+		def kernel_opt(x): return -1*kernel.evaluate(x)
+		max_guess = kernel.support[np.argmax(kernel.density)]
+		MODE = minimize(kernel_opt, max_guess, method='Powell').x
+	else:
+		# Histogram with bins much narrower than the kernel, extending three
+		# bandwidths beyond the data, which is then smoothed by the kernel:
+		binwidth = background_bandwidth/8
+		low = np.min(flux_cut) - 3*background_bandwidth
+		Nbins = min(int(np.ceil((np.max(flux_cut) + 3*background_bandwidth - low)/binwidth)), 2**16)
+		hist, edges = np.histogram(flux_cut, bins=Nbins, range=(low, low + Nbins*binwidth))
+		support = 0.5*(edges[1:] + edges[:-1])
+		density = ndimage.gaussian_filter1d(hist.astype('float64'), background_bandwidth/binwidth, mode='constant') / (len(flux_cut)*binwidth)
+
+		# MODE - refined by fitting a parabola through the maximum and its neighbours:
+		imax = int(np.clip(np.argmax(density), 1, Nbins-2))
+		dm, d0, dp = density[imax-1:imax+2]
+		denom = dm - 2*d0 + dp
+		offset = 0.5*(dm - dp)/denom if denom < 0 else 0
+		MODE = np.atleast_1d(support[imax] + offset*binwidth)
+
+	# MAD (around mode)
+	MAD1 = mad_to_sigma * nanmedian( np.abs( Flux[(Flux < MODE)] - MODE ) )
+
+	return {
+		'mode': MODE,
+		'mad': MAD1,
+		'bandwidth': background_bandwidth,
+		'support': support,
+		'density': density
+	}
+
 #==============================================================================
 # Create pixel masks from Sum-image.
 #==============================================================================
 def k2p2FixFromSum(SumImage, thresh=1, output_folder=None, plot_folder=None, show_plot=True,
 				   min_no_pixels_in_mask=8, min_for_cluster=4, cluster_radius=np.sqrt(2),
 				   segmentation=True, ws_alg='flux', ws_blur=0.5, ws_thres=0.05, ws_footprint=3,
-				   extend_overflow=True, catalog=None):
+				   extend_overflow=True, catalog=None, clustering='dbscan', background=None, background_method='kde'):
 	"""
 	Create pixel masks from Sum-image.
 
@@ -418,6 +575,12 @@ def k2p2FixFromSum(SumImage, thresh=1, output_folder=None, plot_folder=None, sho
 		catalog (ndarray, optional): Catalog of stars as an array with three columns (column, row and magnitude). If this is provided
 			the results will only allow masks to be returned for stars in the catalog and the information is
 			also used in the extension of overflow columns.
+		clustering (string, optional): Clustering algorithm to use. Choices are ``'dbscan'`` and ``'label'``, which gives
+			the same clusters using connected-component labelling (see :py:func:`run_label`). Default='dbscan'.
+		background (dict, optional): Background level and scatter of the sum-image, as returned by :py:func:`k2p2_background`.
+			If not provided, it is estimated from the sum-image.
+		background_method (string, optional): Method used to estimate the background level if ``background``
+			is not provided. See :py:func:`k2p2_background`. Default='kde'.
 
 	Returns:
 		tuple: Tuple with two elements: A 3D boolean ndarray of masks and a float indicating the bandwidth used for the estimation background-levels.
@@ -434,38 +597,12 @@ def k2p2FixFromSum(SumImage, thresh=1, output_folder=None, plot_folder=None, sho
 	ori_mask = ~np.isnan(SumImage)
 	X, Y = np.meshgrid(np.arange(NX), np.arange(NY))
 
-	# Cut out pixels from sum image which were collected and contains flux
-	# and flatten the 2D image to 1D array:
-	Flux = SumImage[ori_mask].flatten()
-	Flux = Flux[Flux > 0]
-
-	# Check if there was actually any flux measured:
-	if len(Flux) == 0:
-		raise K2P2NoFlux("No measured flux in sum-image")
-
-	# Cut away the top 15% of the fluxes:
-	flux_cut = stats.trim1(np.sort(Flux), 0.15)
-	# Also do a cut on the absolute values of pixel - This helps in cases where
-	# the image is dominated by saturated pixels. The exact value is of course
-	# in principle dependent on the CCD, but we have found this value to be
-	# reasonable in TESS simulated data:
-	flux_cut = flux_cut[flux_cut < 70000]
-
-	# Estimate the bandwidth we are going to use for the background:
-	background_bandwidth = select_bandwidth(flux_cut, bw='scott', kernel='gau')
-	logger.debug("  Sum-image KDE bandwidth: %f", background_bandwidth)
-
-	# Make the Kernel Density Estimation of the fluxes:
-	kernel = KDE(flux_cut)
-	kernel.fit(kernel='gau', bw=background_bandwidth, fft=True, gridsize=100)
-
-	# MODE
-	def kernel_opt(x): return -1*kernel.evaluate(x)
-	max_guess = kernel.support[np.argmax(kernel.density)]
-	MODE = minimize(kernel_opt, max_guess, method='Powell').x
-
-	# MAD (around mode)
-	MAD1 = mad_to_sigma * nanmedian( np.abs( Flux[(Flux < MODE)] - MODE ) )
+	# Estimate the background level, unless it was given:
+	if background is None:
+		background = k2p2_background(SumImage, method=background_method)
+	MODE = background['mode']
+	MAD1 = background['mad']
+	background_bandwidth = background['bandwidth']
 
 	# Define the cutoff above which pixels are regarded significant:
 	CUT = MODE + thresh * MAD1
@@ -475,7 +612,7 @@ def k2p2FixFromSum(SumImage, thresh=1, output_folder=None, plot_folder=None, sho
 	if logger.isEnabledFor(logging.DEBUG) and plot_folder is not None:
 		fig = plt.figure()
 		ax = fig.add_subplot(111)
-		ax.fill_between(kernel.support, kernel.density, alpha=0.3)
+		ax.fill_between(background['support'], background['density'], alpha=0.3)
 		ax.axvline(MODE, color='k')
 		ax.axvline(CUT, color='r')
 		ax.set_xlabel('Flux')
@@ -502,7 +639,12 @@ def k2p2FixFromSum(SumImage, thresh=1, output_folder=None, plot_folder=None, sho
 	logger.debug("  Cluster radius is: %f", cluster_radius)
 
 	# Run clustering algorithm
-	XX, labels_ini, core_samples_mask = run_DBSCAN(X2, Y2, cluster_radius, min_for_cluster)
+	if clustering == 'label' and cluster_radius < 2:
+		XX, labels_ini, core_samples_mask = run_label(X2, Y2, cluster_radius, min_for_cluster)
+	elif clustering in ('dbscan', 'label'):
+		XX, labels_ini, core_samples_mask = run_DBSCAN(X2, Y2, cluster_radius, min_for_cluster)
+	else:
+		raise ValueError("Invalid clustering algorithm: '%s'" % clustering)
 
 	# Run watershed segmentation algorithm:
 	# Demand that there was any non-noise clusters found.
@@ -510,18 +652,10 @@ def k2p2FixFromSum(SumImage, thresh=1, output_folder=None, plot_folder=None, sho
 		# Create a set of dummy-masks that are made up of the clusters
 		# that were found by DBSCAN, meaning that there could be masks
 		# with several stars in them:
-		DUMMY_MASKS = np.zeros((0, NY, NX), dtype='bool')
-		DUMMY_MASKS_LABELS = []
-		m = np.zeros_like(SumImage, dtype='bool')
-		for lab in set(labels_ini):
-			if lab == -1: continue
-			# Create "image" of this mask:
-			m[:,:] = False
-			for x,y in XX[labels_ini == lab]:
-				m[y, x] = True
-			# Append them to lists:
-			DUMMY_MASKS = np.append(DUMMY_MASKS, [m], axis=0)
-			DUMMY_MASKS_LABELS.append(lab)
+		DUMMY_MASKS_LABELS = [lab for lab in set(labels_ini) if lab != -1]
+		labels_image = np.full((NY, NX), -1, dtype=labels_ini.dtype)
+		labels_image[XX[:,1], XX[:,0]] = labels_ini
+		DUMMY_MASKS = (labels_image[np.newaxis, :, :] == np.reshape(DUMMY_MASKS_LABELS, (-1, 1, 1)))
 
 		# Run the dummy masks through the detection of saturated columns:
 		logger.debug("Detecting saturated columns in non-segmentated masks...")
@@ -547,10 +681,10 @@ def k2p2FixFromSum(SumImage, thresh=1, output_folder=None, plot_folder=None, sho
 	unique_labels = tuple(unique_labels)
 
 	# Create list of clusters and their number of pixels:
+	label_counts = dict(zip(*np.unique(labels, return_counts=True)))
 	No_pix_sort = np.zeros([len(unique_labels), 2])
-	for u,lab in enumerate(unique_labels):
-		No_pix_sort[u, 0] = np.sum(labels == lab)
-		No_pix_sort[u, 1] = lab
+	No_pix_sort[:, 0] = [label_counts[lab] for lab in unique_labels]
+	No_pix_sort[:, 1] = unique_labels
 
 	# Only select the clusters that have enough pixels and are not noise:
 	cluster_select = (No_pix_sort[:, 0] >= min_no_pixels_in_mask) & (No_pix_sort[:, 1] != -1)
@@ -567,12 +701,9 @@ def k2p2FixFromSum(SumImage, thresh=1, output_folder=None, plot_folder=None, sho
 		No_pix_sort = No_pix_sort[cluster_sort[::-1], :]
 
 		# Create 3D array that will hold masks for each target:
-		MASKS = np.zeros((no_masks, NY, NX))
-		for u in range(no_masks):
-			lab = No_pix_sort[u, 1]
-			class_member_mask = (labels == lab)
-			xy = XX[class_member_mask ,:]
-			MASKS[u, xy[:,1], xy[:,0]] = 1
+		labels_image = np.full((NY, NX), -2, dtype='float64')
+		labels_image[XX[:,1], XX[:,0]] = labels
+		MASKS = np.asarray(labels_image[np.newaxis, :, :] == No_pix_sort[:, 1, np.newaxis, np.newaxis], dtype='float64')
 
 		#==========================================================================
 		# Fill holes in masks
@@ -586,9 +717,7 @@ def k2p2FixFromSum(SumImage, thresh=1, output_folder=None, plot_folder=None, sho
 
 			if not plot_folder is None:
 				# Create image showing all masks at different levels:
-				img = np.zeros((NY,NX))
-				for r in np.transpose(np.where(MASKS > 0)):
-					img[r[1], r[2]] = r[0]+1
+				img = np.max(MASKS * np.arange(1, no_masks+1)[:, np.newaxis, np.newaxis], axis=0)
 
 				# Plot everything together:
 				fig = plt.figure()
@@ -7,13 +7,264 @@ Simple Aperture Photometry using K2P2 to define masks.
 """
 
 from __future__ import division, with_statement, print_function, absolute_import
-from six.moves import range, zip
+from six.moves import range, map, zip
 import numpy as np
-from bottleneck import allnan
+from scipy import ndimage
+from bottleneck import allnan, nanmedian
 import logging
+import multiprocessing
+from timeit import default_timer
 from .. import BasePhotometry, STATUS
 from . import k2p2v2 as k2p2
 
+#------------------------------------------------------------------------------
+# Settings used for K2P2 when creating masks, both for single targets and when
+# segmenting the sum-image of a whole CCD:
+default_k2p2_settings = {
+	'thresh': 0.8,
+	'min_no_pixels_in_mask': 4,
+	'min_for_cluster': 4,
+	'cluster_radius': np.sqrt(2) + np.finfo(np.float64).eps,
+	'segmentation': True,
+	'ws_blur': 0.5,
+	'ws_thres': 0,
+	'ws_footprint': 3,
+	'extend_overflow': True,
+	'clustering': 'label',
+	'background_method': 'kde'
+}
+
+#------------------------------------------------------------------------------
+def extract_lightcurve(images, images_err, backgrounds, mask, members):
+	"""
+	Extract lightcurve from the pixels in a mask, for all timestamps at once.
+
+	Parameters:
+		images (ndarray): Cube of images, with time along the last axis.
+		images_err (ndarray): Cube of uncertainties of the images.
+		backgrounds (ndarray): Cube of backgrounds.
+		mask (ndarray): Boolean mask of the pixels to sum.
+		members (ndarray): Positions (column, row) of the pixels in the mask, in the order given by ``images[mask]``.
+
+	Returns:
+		tuple: Flux, flux uncertainty, background flux in the mask and flux-weighted
+		centroid (column, row) of the pixels in the mask, for each timestamp. Timestamps
+		where all pixels in the mask are NaN or zero get NaN flux and centroid.
+	"""
+
+	# Pixels in the mask as (time, pixel) arrays, so all sums are taken over
+	# the contiguous last axis:
+	flux_in_cluster = np.ascontiguousarray(images[mask].T)
+	err_in_cluster = np.ascontiguousarray(images_err[mask].T)
+	bck_in_cluster = np.ascontiguousarray(backgrounds[mask].T)
+
+	# Timestamps without any flux in the mask:
+	no_flux = allnan(flux_in_cluster, axis=1) | np.all(flux_in_cluster == 0, axis=1)
+
+	# Calculate flux in mask:
+	flux = np.sum(flux_in_cluster, axis=1)
+	flux[no_flux] = np.nan
+	flux_err = np.sqrt(np.sum(err_in_cluster**2, axis=1))
+	flux_err[no_flux] = np.nan
+
+	# Calculate flux centroid, only using the pixels with positive flux:
+	weights = np.where(flux_in_cluster > 0, flux_in_cluster, 0).astype('float64')
+	sum_weights = np.sum(weights, axis=1)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		pos_centroid = np.dot(weights, members) / sum_weights[:, np.newaxis]
+	pos_centroid[no_flux | (sum_weights == 0), :] = np.nan
+
+	# Calculate background in mask:
+	flux_background = np.nansum(bck_in_cluster, axis=1)
+	flux_background[allnan(bck_in_cluster, axis=1)] = np.nan
+
+	return flux, flux_err, flux_background, pos_centroid
+
+#------------------------------------------------------------------------------
+def predict_stamp_size(sumimage, row, column, Nrows, Ncolumns, thresh=0.8, grow=30):
+	"""
+	Predict the size of the stamp needed to contain the mask of a target.
+
+	The pixels above the same threshold as used by K2P2 are grown from the pixels
+	around the target in the full sum-image, and the stamp is made large enough to
+	contain the whole region. Since the mask found by K2P2 will be part of this region,
+	the mask will then not touch the edges of the stamp, so the stamp does not have
+	to be resized.
+
+	Parameters:
+		sumimage (ndarray): Full sum-image of the CCD.
+		row (float): Row of the target in the sum-image (zero-based).
+		column (float): Column of the target in the sum-image (zero-based).
+		Nrows (int): Default number of rows in the stamp.
+		Ncolumns (int): Default number of columns in the stamp.
+		thresh (float, optional): Threshold for significant flux, in the same units as in
+			:py:func:`k2p2v2.k2p2FixFromSum`. Default=0.8.
+		grow (int, optional): Maximal number of pixels the stamp is extended by on each side. Default=30.
+
+	Returns:
+		tuple: Number of rows and columns of the stamp, which are at least ``Nrows`` and ``Ncolumns``.
+	"""
+	row = int(np.round(row))
+	column = int(np.round(column))
+	dr = int(Nrows)//2 + grow
+	dc = int(Ncolumns)//2 + grow
+
+	# Cut out the area the stamp can grow into:
+	r1 = max(row - dr, 0)
+	c1 = max(column - dc, 0)
+	img = sumimage[r1:row+dr+1, c1:column+dc+1]
+	row -= r1
+	column -= c1
+	if not (0 <= row < img.shape[0] and 0 <= column < img.shape[1]):
+		return Nrows, Ncolumns
+
+	# Threshold for significant flux, calculated like in K2P2:
+	flux = img[np.isfinite(img)]
+	flux = flux[flux > 0]
+	if len(flux) == 0:
+		return Nrows, Ncolumns
+	mode = nanmedian(flux)
+	mad = 1.4826 * nanmedian(np.abs(flux[flux < mode] - mode))
+	cut = mode + thresh*mad
+
+	# Connected regions of significant flux, and the ones touching the target:
+	with np.errstate(invalid='ignore'):
+		labels, _ = ndimage.label(img > cut, structure=np.ones((3,3), dtype='bool'))
+	target_labels = np.unique(labels[max(row-1, 0):row+2, max(column-1, 0):column+2])
+	target_labels = target_labels[target_labels > 0]
+	if len(target_labels) == 0:
+		return Nrows, Ncolumns
+
+	# Make the stamp large enough to contain the regions with a pixel to spare:
+	rows, cols = np.nonzero(np.isin(labels, target_labels))
+	Nrows = max(Nrows, 2*(np.max(np.abs(rows - row)) + 1) + 1)
+	Ncolumns = max(Ncolumns, 2*(np.max(np.abs(cols - column)) + 1) + 1)
+	return Nrows, Ncolumns
+
+#------------------------------------------------------------------------------
+def _segment_tile(args):
+	"""Masks found by K2P2 in a single tile of the sum-image. Used by :py:func:`segment_sumimage`."""
+	img, catalog, k2p2_settings = args
+	try:
+		masks, _ = k2p2.k2p2FixFromSum(img, show_plot=False, catalog=catalog, **k2p2_settings)
+	except (k2p2.K2P2NoFlux, k2p2.K2P2NoStars):
+		return None
+	if masks is None:
+		return None
+	return np.asarray(masks, dtype='bool')
+
+#------------------------------------------------------------------------------
+def segment_sumimage(sumimage, starids, catalog, tile_size=256, overlap=64, threads=1, k2p2_settings=None):
+	"""
+	Segment the sum-image of a whole CCD into masks using K2P2.
+
+	The sum-image is split into tiles of ``tile_size`` pixels, which are extended by
+	``overlap`` pixels on all sides and run through K2P2 independently, in parallel if
+	``threads`` is larger than one. A mask found in a tile is only kept if its
+	brightest pixel lies inside the tile itself, so masks crossing the border between
+	two tiles are only kept once. Pixels which already belong to a mask are never
+	reassigned to another.
+
+	Parameters:
+		sumimage (ndarray): Sum-image of the CCD.
+		starids (ndarray): TIC numbers of the stars in ``catalog``.
+		catalog (ndarray): Stars as an array with three columns (column, row and magnitude),
+			with positions relative to the sum-image.
+		tile_size (int, optional): Size of tiles in pixels. Default=256.
+		overlap (int, optional): Number of pixels each tile is extended by on all sides.
+			Should be larger than the extent of the largest masks. Default=64.
+		threads (int, optional): Number of processes to use. Default=1.
+		k2p2_settings (dict, optional): Settings passed to :py:func:`k2p2v2.k2p2FixFromSum`.
+			Default is to use the same settings as :py:class:`AperturePhotometry`.
+
+	Returns:
+		tuple:
+		- ndarray: Image of labels of the masks, with zero for pixels not in any mask.
+		- ndarray: Two columns with the TIC number and label of the stars falling inside a mask.
+		- ndarray: Bounding box (row_min, row_max, col_min, col_max) of each mask, where
+		  the row with index ``k`` holds the bounding box of label ``k+1``.
+	"""
+
+	logger = logging.getLogger(__name__)
+
+	if k2p2_settings is None:
+		k2p2_settings = default_k2p2_settings
+
+	NY, NX = sumimage.shape
+	starids = np.asarray(starids, dtype='int64')
+	catalog = np.atleast_2d(np.asarray(catalog, dtype='float64'))
+
+	# Split the image into tiles, extended by the overlap on all sides:
+	tiles = []
+	for r1 in range(0, NY, tile_size):
+		for c1 in range(0, NX, tile_size):
+			core = (r1, min(r1+tile_size, NY), c1, min(c1+tile_size, NX))
+			padded = (max(core[0]-overlap, 0), min(core[1]+overlap, NY), max(core[2]-overlap, 0), min(core[3]+overlap, NX))
+			tiles.append((core, padded))
+
+	def tile_arguments():
+		for core, padded in tiles:
+			pr1, pr2, pc1, pc2 = padded
+			# Stars in the tile, with positions relative to the tile:
+			indx = (catalog[:, 1] >= pr1 - 1) & (catalog[:, 1] < pr2) & (catalog[:, 0] >= pc1 - 1) & (catalog[:, 0] < pc2)
+			cat = catalog[indx, :] - np.array([[pc1, pr1, 0]])
+			yield sumimage[pr1:pr2, pc1:pc2], cat, k2p2_settings
+
+	if threads > 1:
+		pool = multiprocessing.Pool(threads)
+		m = pool.imap
+	else:
+		m = map
+
+	labels = np.zeros((NY, NX), dtype='int32')
+	Nlabels = 0
+	tic = default_timer()
+	for (core, padded), masks in zip(tiles, m(_segment_tile, tile_arguments())):
+		if masks is None:
+			continue
+		pr1, pr2, pc1, pc2 = padded
+		img = sumimage[pr1:pr2, pc1:pc2]
+		tile_labels = labels[pr1:pr2, pc1:pc2] # View into the full image of labels
+
+		for mask in masks:
+			# Only keep the mask in the tile containing its brightest pixel:
+			rmax, cmax = np.unravel_index(np.nanargmax(np.where(mask, img, -np.inf)), mask.shape)
+			if not (core[0] <= rmax + pr1 < core[1] and core[2] <= cmax + pc1 < core[3]):
+				continue
+
+			if (np.any(mask[0, :]) and pr1 > 0) or (np.any(mask[-1, :]) and pr2 < NY) \
+				or (np.any(mask[:, 0]) and pc1 > 0) or (np.any(mask[:, -1]) and pc2 < NX):
+				logger.warning("Mask at (%d, %d) is touching the edge of the tile. Consider increasing the overlap.", rmax + pr1, cmax + pc1)
+
+			mask &= (tile_labels == 0)
+			if np.any(mask):
+				Nlabels += 1
+				tile_labels[mask] = Nlabels
+
+		logger.debug("Segmented tile %s: %d masks in total", core, Nlabels)
+
+	if threads > 1:
+		pool.close()
+		pool.join()
+
+	logger.info("Segmentation of sum-image: %d masks, %f sec/tile", Nlabels, (default_timer() - tic)/len(tiles))
+
+	# Labels of the pixels the stars fall in:
+	rows = np.round(catalog[:, 1]).astype('int64')
+	cols = np.round(catalog[:, 0]).astype('int64')
+	indx = (rows >= 0) & (rows < NY) & (cols >= 0) & (cols < NX)
+	star_labels = labels[rows[indx], cols[indx]]
+	inmask = (star_labels > 0)
+	star_table = np.column_stack((starids[indx][inmask], star_labels[inmask])).astype('int64')
+
+	# Bounding box of each mask:
+	bbox = np.zeros((Nlabels, 4), dtype='int32')
+	for k, slices in enumerate(ndimage.find_objects(labels)):
+		if slices is not None:
+			bbox[k, :] = (slices[0].start, slices[0].stop, slices[1].start, slices[1].stop)
+
+	return labels, star_table, bbox
+
 #------------------------------------------------------------------------------
 class AperturePhotometry(BasePhotometry):
 	"""Simple Aperture Photometry using K2P2 to define masks.
@@ -22,6 +273,15 @@ class AperturePhotometry(BasePhotometry):
 	"""
 
 	def __init__(self, *args, **kwargs):
+		# Extract lightcurves of the other targets in the stamp as well:
+		self.secondary_targets = kwargs.pop('secondary_targets', False)
+		# Predict the stamp needed from the full sum-image, instead of resizing the stamp later:
+		self.predict_stamp = kwargs.pop('predict_stamp', True)
+		# Use the mask from the segmentation of the full sum-image, if it is available:
+		self.use_segmentation = kwargs.pop('use_segmentation', True)
+		# Method used for estimating the background of the sum-image (see k2p2v2.k2p2_background):
+		self.background_method = kwargs.pop('background_method', default_k2p2_settings['background_method'])
+
 		# Call the parent initializing:
 		# This will set several default settings
 		super(self.__class__, self).__init__(*args, **kwargs)
@@ -29,136 +289,201 @@ class AperturePhotometry(BasePhotometry):
 		# Here you could do other things that needs doing in the beginning
 		# of the run on each target.
 
+	def default_stamp(self):
+		"""
+		The default size of the stamp to use.
+
+		For FFIs the size is grown from the default size to contain the region of
+		significant flux around the target in the full sum-image, which the mask
+		found by K2P2 will be part of.
+
+		Returns:
+			int: Number of rows
+			int: Number of columns
+		"""
+		Nrows, Ncolumns = super(self.__class__, self).default_stamp()
+		if self.predict_stamp and self.datasource == 'ffi' and self._sumimage_full is not None:
+			Nrows, Ncolumns = predict_stamp_size(self._sumimage_full,
+				self.target_pos_row - self.pixel_offset_row,
+				self.target_pos_column - self.pixel_offset_col,
+				Nrows, Ncolumns)
+		return Nrows, Ncolumns
+
+	def _segmentation_masks(self):
+		"""
+		Masks in the stamp from the segmentation of the full sum-image.
+
+		The segmentation is created when preparing the data (see :py:func:`segment_sumimage`).
+		The stamp is grown if needed, so it contains the mask of the target with a pixel
+		to spare on all sides.
+
+		Returns:
+			tuple: Mask of the target, masks of all segments in the stamp and TIC numbers of the stars
+			falling in the mask of the target. ``None`` if no segmentation is available or the
+			target is not in any mask.
+		"""
+		if not self.use_segmentation or self.datasource != 'ffi' or self._segmentation is None:
+			return None
+
+		label = self._segmentation['target_labels'].get(self.starid)
+		if label is None:
+			return None
+
+		# Grow the stamp to contain the mask. This is not counted as a resize of
+		# the stamp, since it is not a retry after the mask touched the edge:
+		r1, r2, c1, c2 = [int(b) for b in self._segmentation['bbox'][label-1]]
+		resize_args = {
+			'down': max(self._stamp[0] - (r1 + self.pixel_offset_row - 1), 0),
+			'up': max(r2 + self.pixel_offset_row + 1 - self._stamp[1], 0),
+			'left': max(self._stamp[2] - (c1 + self.pixel_offset_col - 1), 0),
+			'right': max(c2 + self.pixel_offset_col + 1 - self._stamp[3], 0)
+		}
+		if any(resize_args.values()):
+			self._resize_stamp(**resize_args)
+
+		ir1 = self._stamp[0] - self.pixel_offset_row
+		ir2 = self._stamp[1] - self.pixel_offset_row
+		ic1 = self._stamp[2] - self.pixel_offset_col
+		ic2 = self._stamp[3] - self.pixel_offset_col
+		labels = self._segmentation['labels'][ir1:ir2, ic1:ic2]
+		unique_labels = np.unique(labels[labels > 0])
+		masks = (labels[np.newaxis, :, :] == unique_labels[:, np.newaxis, np.newaxis])
+
+		starids = self._segmentation['starids']
+		return (labels == label), masks, starids[starids[:, 1] == label, 0]
+
 	def _minimum_aperture(self):
 		cols, rows = self.get_pixel_grid()
 		mask_main = ( np.abs(cols - self.target_pos_column - 1) <= 1 ) \
 					& ( np.abs(rows - self.target_pos_row - 1) <= 1 )
 		return mask_main
 
-	def do_photometry(self):
+	def _targets_in_mask(self, mask):
+		"""Indices in the catalog of the targets falling in the mask."""
+		# Pixel in the stamp that each target falls in:
+		rows = np.round(self.catalog['row']).astype('int64') - self._stamp[0]
+		cols = np.round(self.catalog['column']).astype('int64') - self._stamp[2]
+		inside = (rows >= 0) & (rows < mask.shape[0]) & (cols >= 0) & (cols < mask.shape[1])
+		indx = np.nonzero(inside)[0]
+		return list(indx[mask[rows[inside], cols[inside]]])
+
+	def do_photometry(self, mask=None):
 		"""Perform photometry on the given target.
 
 		This function needs to set
 			* self.lightcurve
+
+		Parameters:
+			mask (ndarray, optional): Aperture to use instead of creating new masks using K2P2.
 		"""
 
 		logger = logging.getLogger(__name__)
 		logger.info("Running aperture photometry...")
 
-		k2p2_settings = {
-			'thresh': 0.8,
-			'min_no_pixels_in_mask': 4,
-			'min_for_cluster': 4,
-			'cluster_radius': np.sqrt(2) + np.finfo(np.float64).eps,
-			'segmentation': True,
-			'ws_blur': 0.5,
-			'ws_thres': 0,
-			'ws_footprint': 3,
-			'extend_overflow': True
-		}
-
-		for retries in range(5):
-			# Delete any plots left over in the plots folder from an earlier iteration:
-			self.delete_plots()
+		k2p2_settings = dict(default_k2p2_settings, background_method=self.background_method)
 
-			# Create the sum-image:
-			SumImage = self.sumimage
-
-			logger.info(self.stamp)
-			logger.info("Target position in stamp: (%f, %f)", self.target_pos_row_stamp, self.target_pos_column_stamp )
-
-			cat = np.column_stack((self.catalog['column_stamp'], self.catalog['row_stamp'], self.catalog['tmag']))
-
-			logger.info("Creating new masks...")
-			try:
-				masks, background_bandwidth = k2p2.k2p2FixFromSum(SumImage, plot_folder=self.plot_folder, show_plot=False, catalog=cat, **k2p2_settings)
-				masks = np.asarray(masks, dtype='bool')
-			except k2p2.K2P2NoStars:
-				self.report_details(error='No flux above threshold.')
-				masks = np.asarray(0, dtype='bool')
+		masks = None
+		starids_in_mask = None
+		if mask is None:
+			# Look up the mask in the segmentation of the full sum-image:
+			segmentation = self._segmentation_masks()
+			if segmentation is not None:
+				logger.info("Using mask from segmentation of sum-image...")
+				mask, masks, starids_in_mask = segmentation
 
+		if mask is not None:
+			# Use the given mask, e.g. found while processing another target in the same stamp:
+			mask_main = mask
 			using_minimum_mask = False
-			if len(masks.shape) == 0:
-				logger.warning("No masks found")
-				self.report_details(error='No masks found. Using minimum aperture.')
-				mask_main = self._minimum_aperture()
-				using_minimum_mask = True
-
-			else:
-				# Look at the central pixel where the target should be:
-				indx_main = masks[:, int(round(self.target_pos_row_stamp)), int(round(self.target_pos_column_stamp))].flatten()
-
-				if not np.any(indx_main):
-					logger.warning('No mask found for main target. Using minimum aperture.')
-					self.report_details(error='No mask found for main target. Using minimum aperture.')
+		else:
+			# The background level of the sum-image is estimated on the first try,
+			# and is reused after the stamp has been resized:
+			background = None
+			for retries in range(5):
+				# Delete any plots left over in the plots folder from an earlier iteration:
+				self.delete_plots()
+
+				# Create the sum-image:
+				SumImage = self.sumimage
+
+				logger.info(self.stamp)
+				logger.info("Target position in stamp: (%f, %f)", self.target_pos_row_stamp, self.target_pos_column_stamp )
+
+				cat = np.column_stack((self.catalog['column_stamp'], self.catalog['row_stamp'], self.catalog['tmag']))
+
+				if background is None:
+					background = k2p2.k2p2_background(SumImage, method=k2p2_settings['background_method'])
+
+				logger.info("Creating new masks...")
+				try:
+					masks, background_bandwidth = k2p2.k2p2FixFromSum(SumImage, plot_folder=self.plot_folder, show_plot=False, catalog=cat, background=background, **k2p2_settings)
+					masks = np.asarray(masks, dtype='bool')
+				except k2p2.K2P2NoStars:
+					self.report_details(error='No flux above threshold.')
+					masks = np.asarray(0, dtype='bool')
+
+				using_minimum_mask = False
+				if len(masks.shape) == 0:
+					logger.warning("No masks found")
+					self.report_details(error='No masks found. Using minimum aperture.')
 					mask_main = self._minimum_aperture()
 					using_minimum_mask = True
 
-				elif np.sum(indx_main) > 1:
-					logger.error('Too many masks')
-					self.report_details(error='Too many masks')
-					return STATUS.ERROR
-
 				else:
-					# Mask of the main target:
-					mask_main = masks[indx_main, :, :].reshape(SumImage.shape)
-
-			# Find out if we are touching any of the edges:
-			resize_args = {}
-			if np.any(mask_main[0, :]):
-				resize_args['down'] = 10
-			if np.any(mask_main[-1, :]):
-				resize_args['up'] = 10
-			if np.any(mask_main[:, 0]):
-				resize_args['left'] = 10
-			if np.any(mask_main[:, -1]):
-				resize_args['right'] = 10
-
-			if resize_args:
-				logger.warning("Touching the edges! Retrying")
-				logger.info(resize_args)
-				if not self.resize_stamp(**resize_args):
-					resize_args = {}
-					logger.warning("Could not resize stamp any further")
+					# Look at the central pixel where the target should be:
+					indx_main = masks[:, int(round(self.target_pos_row_stamp)), int(round(self.target_pos_column_stamp))].flatten()
+
+					if not np.any(indx_main):
+						logger.warning('No mask found for main target. Using minimum aperture.')
+						self.report_details(error='No mask found for main target. Using minimum aperture.')
+						mask_main = self._minimum_aperture()
+						using_minimum_mask = True
+
+					elif np.sum(indx_main) > 1:
+						logger.error('Too many masks')
+						self.report_details(error='Too many masks')
+						return STATUS.ERROR
+
+					else:
+						# Mask of the main target:
+						mask_main = masks[indx_main, :, :].reshape(SumImage.shape)
+
+				# Find out if we are touching any of the edges:
+				resize_args = {}
+				if np.any(mask_main[0, :]):
+					resize_args['down'] = 10
+				if np.any(mask_main[-1, :]):
+					resize_args['up'] = 10
+				if np.any(mask_main[:, 0]):
+					resize_args['left'] = 10
+				if np.any(mask_main[:, -1]):
+					resize_args['right'] = 10
+
+				if resize_args:
+					logger.warning("Touching the edges! Retrying")
+					logger.info(resize_args)
+					if not self.resize_stamp(**resize_args):
+						resize_args = {}
+						logger.warning("Could not resize stamp any further")
+						break
+				else:
 					break
-			else:
-				break
 
-		# If we reached the last retry but still needed a resize, give up:
-		if resize_args:
-			self.report_details(error='Too many stamp resizes')
-			return STATUS.ERROR
+			# If we reached the last retry but still needed a resize, give up:
+			if resize_args:
+				self.report_details(error='Too many stamp resizes')
+				return STATUS.ERROR
 
 		# XY of pixels in frame
 		cols, rows = self.get_pixel_grid()
 		members = np.column_stack((cols[mask_main], rows[mask_main]))
 
-		# Loop through the images and backgrounds together:
-		for k, (img, imgerr, bck) in enumerate(zip(self.images, self.images_err, self.backgrounds)):
-
-			flux_in_cluster = img[mask_main]
-
-			# Calculate flux in mask:
-			if allnan(flux_in_cluster) or np.all(flux_in_cluster == 0):
-				self.lightcurve['flux'][k] = np.NaN
-				self.lightcurve['flux_err'][k] = np.NaN
-				self.lightcurve['pos_centroid'][k, :] = np.NaN
-				#self.lightcurve['quality']
-			else:
-				self.lightcurve['flux'][k] = np.sum(flux_in_cluster)
-				self.lightcurve['flux_err'][k] = np.sqrt(np.sum(imgerr[mask_main]**2))
-
-				# Calculate flux centroid:
-				finite_vals = (flux_in_cluster > 0)
-				if np.any(finite_vals):
-					self.lightcurve['pos_centroid'][k, :] = np.average(members[finite_vals], weights=flux_in_cluster[finite_vals], axis=0)
-				else:
-					self.lightcurve['pos_centroid'][k, :] = np.NaN
-
-			if allnan(bck[mask_main]):
-				self.lightcurve['flux_background'][k] = np.NaN
-			else:
-				self.lightcurve['flux_background'][k] = np.nansum(bck[mask_main])
+		# Extract the lightcurve from all images at once:
+		flux, flux_err, flux_background, pos_centroid = extract_lightcurve(self.images_cube, self.images_err_cube, self.backgrounds_cube, mask_main, members)
+		self.lightcurve['flux'][:] = flux
+		self.lightcurve['flux_err'][:] = flux_err
+		self.lightcurve['flux_background'][:] = flux_background
+		self.lightcurve['pos_centroid'][:] = pos_centroid
 
 		# Save the mask to be stored in the outout file:
 		self.final_mask = mask_main
@@ -175,18 +500,24 @@ class AperturePhotometry(BasePhotometry):
 		self.additional_headers['KP_WSTHR'] = (k2p2_settings['ws_thres'], 'K2P2 watershed threshold')
 		self.additional_headers['KP_WSFOT'] = (k2p2_settings['ws_footprint'], 'K2P2 watershed footprint')
 		self.additional_headers['KP_EX'] = (bool(k2p2_settings['extend_overflow']), 'K2P2 extend overflow')
+		self.additional_headers['KP_SEGM'] = (starids_in_mask is not None, 'K2P2 mask from CCD segmentation')
 
-		# Targets that are in the mask:
-		target_in_mask = [k for k,t in enumerate(self.catalog) if np.round(t['row'])+1 in rows[mask_main] and np.round(t['column'])+1 in cols[mask_main]]
+		# Targets that are in the mask, which are already known if the
+		# mask came from the segmentation of the full sum-image:
+		if starids_in_mask is not None:
+			target_in_mask = list(np.nonzero(np.isin(self.catalog['starid'], starids_in_mask))[0])
+		else:
+			target_in_mask = self._targets_in_mask(mask_main)
+		catalog_in_mask = self.catalog[target_in_mask]
 
 		# Calculate contamination from the other targets in the mask:
-		if len(target_in_mask) == 0:
+		if len(catalog_in_mask) == 0:
 			contamination = np.nan
-		elif len(target_in_mask) == 1 and self.catalog[target_in_mask][0]['starid'] == self.starid:
+		elif len(catalog_in_mask) == 1 and catalog_in_mask['starid'][0] == self.starid:
 			contamination = 0
 		else:
 			# Calculate contamination metric as defined in Lund & Handberg (2014):
-			mags_in_mask = self.catalog[target_in_mask]['tmag']
+			mags_in_mask = catalog_in_mask['tmag']
 			mags_total = -2.5*np.log10(np.nansum(10**(-0.4*mags_in_mask)))
 			contamination = 1.0 - 10**(0.4*(mags_total - self.target_tmag))
 			contamination = np.abs(contamination) # Avoid stupid signs due to round-off errors
@@ -198,11 +529,41 @@ class AperturePhotometry(BasePhotometry):
 		# Check if there are other targets in the mask that could then be skipped from
 		# processing, and report this back to the TaskManager. The TaskManager will decide
 		# if this means that this target or the other targets should be skipped in the end.
-		skip_targets = [t['starid'] for t in self.catalog[target_in_mask] if t['starid'] != self.starid]
+		skip_targets = list(catalog_in_mask['starid'][catalog_in_mask['starid'] != self.starid])
 		if skip_targets:
 			logger.info("These stars could be skipped: %s", skip_targets)
 			self.report_details(skip_targets=skip_targets)
 
+		# Extract lightcurves of the other targets in the stamp, which have their own
+		# mask lying fully inside the stamp:
+		if self.secondary_targets and self.datasource == 'ffi' and masks is not None and masks.ndim == 3:
+			for mask_other in masks:
+				if np.any(mask_other & mask_main) or np.any(mask_other[0, :]) or np.any(mask_other[-1, :]) \
+					or np.any(mask_other[:, 0]) or np.any(mask_other[:, -1]):
+					continue
+
+				# The lightcurve is extracted for the brightest target in the mask,
+				# which the other targets in the mask are then skipped in favour of:
+				target_in_other = self._targets_in_mask(mask_other)
+				if not target_in_other:
+					continue
+				starid_other = self.catalog[target_in_other][np.argmin(self.catalog[target_in_other]['tmag'])]['starid']
+				if starid_other == self.starid:
+					continue
+
+				try:
+					t1 = default_timer()
+					other = self.secondary(starid_other)
+					other.photometry(mask=mask_other)
+					other.elaptime = default_timer() - t1
+				except (KeyboardInterrupt, SystemExit):
+					raise
+				except:
+					logger.exception("Photometry of secondary target %d failed", starid_other)
+					continue
+				self.secondary_photometry.append(other)
+			logger.info("Extracted %d secondary targets", len(self.secondary_photometry))
+
 		# Figure out which status to report back:
 		my_status = STATUS.OK
 		if using_minimum_mask:
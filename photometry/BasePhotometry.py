@@ -18,7 +18,7 @@ warnings.filterwarnings('ignore', category=FutureWarning, module="scipy") # they
 warnings.filterwarnings('ignore', category=FutureWarning, module="skimage") # they are simply annoying!
 warnings.filterwarnings('ignore', category=ErfaWarning, module="astropy")
 from astropy.io import fits
-from astropy.table import Table, Column
+from astropy.table import Table, Column, vstack
 import h5py
 import sqlite3
 import logging
@@ -26,7 +26,7 @@ import datetime
 import os.path
 import glob
 import contextlib
-from copy import deepcopy
+from copy import copy, deepcopy
 #from astropy import coordinates, units
 from astropy.time import Time
 from astropy.wcs import WCS
@@ -34,7 +34,7 @@ import enum
 from bottleneck import replace, nanmedian, nanvar, nanstd
 from .image_motion import ImageMovementKernel
 from .quality import TESSQualityFlags
-from .utilities import find_tpf_files, find_hdf5_files, find_catalog_files, rms_timescale
+from .utilities import find_tpf_files, find_hdf5_files, find_catalog_files, rms_timescale, default_stamp_size
 from .plots import plot_image, plt, save_figure
 from .version import get_version
 
@@ -68,6 +68,8 @@ class BasePhotometry(object):
 		output_folder (string): Root directory where output files are saved.
 		plot (boolean): Indicates wheter plots should be created as part of the output.
 		plot_folder (string): Directory where plots are saved to.
+		cores (integer): Number of processes the photometry is allowed to use.
+		stage_folder (string): Directory with local copies of the HDF5 and catalog files.
 
 		sector (integer): TESS observing sector.
 		camera (integer): TESS camera (1-4).
@@ -94,7 +96,7 @@ class BasePhotometry(object):
 	"""
 
 	def __init__(self, starid, input_folder, output_folder, datasource='ffi',
-		sector=None, camera=None, ccd=None, plot=False, cache='basic'):
+		sector=None, camera=None, ccd=None, plot=False, cache='basic', cores=1, stage_folder=None):
 		"""
 		Initialize the photometry object.
 
@@ -107,6 +109,11 @@ class BasePhotometry(object):
 			camera (integer, optional): TESS camera (1-4) to load target from (Only used for FFIs).
 			ccd (integer, optional): TESS CCD (1-4) to load target from (Only used for FFIs).
 			cache (string, optional): Optional values are ``'none'``, ``'full'`` or ``'basic'`` (Default).
+			cores (integer, optional): Number of processes the photometry is allowed to use. Methods
+				which support it will split the work between forked processes. Default is 1.
+			stage_folder (string, optional): Directory with local copies of the HDF5 and catalog files
+				(see :py:func:`photometry.staging.stage_files`). Files not found there are loaded
+				from ``input_folder``.
 
 		Raises:
 			IOError: If starid could not be found in catalog.
@@ -127,11 +134,15 @@ class BasePhotometry(object):
 		self.output_folder_base = os.path.abspath(output_folder)
 		self.plot = plot
 		self.datasource = datasource
+		self.cores = max(int(cores), 1)
+		self.stage_folder = stage_folder
 
 		logger.info('STARID = %d, DATASOURCE = %s', self.starid, self.datasource)
 
 		self._status = STATUS.UNKNOWN
 		self._details = {}
+		self._parent = None
+		self.secondary_photometry = [] # Photometry of other targets extracted from the same stamp.
 		self.tpf = None
 		self.hdf = None
 		self._MovementKernel = None
@@ -139,6 +150,7 @@ class BasePhotometry(object):
 		self._images_err_cube_full = None
 		self._backgrounds_cube_full = None
 		self._sumimage_full = None
+		self._segmentation = None
 
 		# Directory where output files will be saved:
 		self.output_folder = os.path.join(
@@ -172,7 +184,7 @@ class BasePhotometry(object):
 			logger.debug('CCD = %s', self.ccd)
 
 			# Load stuff from the common HDF5 file:
-			filepath_hdf5 = find_hdf5_files(input_folder, sector=self.sector, camera=self.camera, ccd=self.ccd)[0]
+			filepath_hdf5 = self._find_input_files(find_hdf5_files)[0]
 			self.filepath_hdf5 = filepath_hdf5
 
 			logger.debug("CACHE = %s", cache)
@@ -235,6 +247,18 @@ class BasePhotometry(object):
 				# The full sum-image:
 				attrs['_sumimage_full'] = np.asarray(self.hdf['sumimage'])
 
+				# Segmentation of the full sum-image into masks, if it has been created:
+				if 'segmentation' in self.hdf:
+					starids = np.asarray(self.hdf['segmentation/starids'])
+					attrs['_segmentation'] = {
+						'labels': np.asarray(self.hdf['segmentation/labels']),
+						'bbox': np.asarray(self.hdf['segmentation/bbox']),
+						'starids': starids,
+						'target_labels': dict(zip(starids[:, 0], starids[:, 1]))
+					}
+				else:
+					attrs['_segmentation'] = None
+
 				# If we are doing a full cache (everything in memory) load the image cubes as well.
 				# Note that this will take up A LOT of memory!
 				if cache == 'full':
@@ -326,7 +350,7 @@ class BasePhotometry(object):
 			self.n_readout = self.tpf[1].header.get('NUM_FRM', 900) # Number of frames co-added in each timestamp.
 
 		# The file to load the star catalog from:
-		self.catalog_file = find_catalog_files(input_folder, sector=self.sector, camera=self.camera, ccd=self.ccd)
+		self.catalog_file = self._find_input_files(find_catalog_files)
 		self._catalog = None
 		logger.debug('Catalog file: %s', self.catalog_file)
 		if len(self.catalog_file) != 1:
@@ -334,6 +358,24 @@ class BasePhotometry(object):
 		self.catalog_file = self.catalog_file[0]
 
 		# Load information about main target:
+		self._load_target()
+
+		# Init the stamp:
+		self._stamp = None
+		self.target_pos_column_stamp = None # Main target CCD column position in stamp.
+		self.target_pos_row_stamp = None # Main target CCD row position in stamp.
+		self._set_stamp()
+		self._sumimage = None
+		self._images_cube = None
+		self._images_err_cube = None
+		self._backgrounds_cube = None
+		self._pixelflags = None
+
+	def _load_target(self):
+		"""Load information about the main target and initialize the lightcurve columns of the target."""
+
+		logger = logging.getLogger(__name__)
+
 		with contextlib.closing(sqlite3.connect(self.catalog_file)) as conn:
 			conn.row_factory = sqlite3.Row
 			cursor = conn.cursor()
@@ -381,16 +423,40 @@ class BasePhotometry(object):
 		else:
 			self.lightcurve['pos_corr'][:] = self.MovementKernel.jitter(self.lightcurve['time'], self.target_pos_column, self.target_pos_row)
 
-		# Init the stamp:
-		self._stamp = None
-		self.target_pos_column_stamp = None # Main target CCD column position in stamp.
-		self.target_pos_row_stamp = None # Main target CCD row position in stamp.
-		self._set_stamp()
-		self._sumimage = None
-		self._images_cube = None
-		self._images_err_cube = None
-		self._backgrounds_cube = None
-		self._pixelflags = None
+	def secondary(self, starid):
+		"""
+		Photometry object for another target in the same stamp.
+
+		The new object shares the stamp, the loaded images and the catalog with this
+		object, so lightcurves of several targets can be extracted from a single load
+		of the data. Plots are not created for the other target. The time spent on
+		the other target should be stored in its ``elaptime`` attribute by the caller.
+
+		Parameters:
+			starid (int): TIC number of the other target.
+
+		Returns:
+			:py:class:`BasePhotometry`: Photometry object of the same class for the other target.
+		"""
+		other = copy(self)
+		other._parent = self
+		other.starid = starid
+		other.plot = False
+		other.plot_folder = None
+		other._status = STATUS.UNKNOWN
+		other._details = {'stamp': self._stamp}
+		other.secondary_photometry = []
+		other.elaptime = None
+		other.output_folder = os.path.join(
+			self.output_folder_base,
+			self.datasource[:3],
+			'{0:011d}'.format(starid)[:5]
+		)
+		other.lightcurve = self.lightcurve.copy()
+		other._load_target()
+		other.target_pos_row_stamp = other.target_pos_row - self._stamp[0]
+		other.target_pos_column_stamp = other.target_pos_column - self._stamp[2]
+		return other
 
 	def __enter__(self):
 		return self
@@ -400,6 +466,9 @@ class BasePhotometry(object):
 
 	def close(self):
 		"""Close photometry object and close all associated open file handles."""
+		# The file handles of secondary targets belong to the main target:
+		if self._parent is not None:
+			return
 		if self.hdf:
 			self.hdf.close()
 		if self.tpf:
@@ -410,6 +479,14 @@ class BasePhotometry(object):
 		global hdf5_cache
 		hdf5_cache = {}
 
+	def _find_input_files(self, find_files):
+		"""Find input files of the CCD of the target, preferring staged copies."""
+		if self.stage_folder:
+			files = find_files(self.stage_folder, sector=self.sector, camera=self.camera, ccd=self.ccd)
+			if files:
+				return files
+		return find_files(self.input_folder, sector=self.sector, camera=self.camera, ccd=self.ccd)
+
 	@property
 	def status(self):
 		"""The status of the photometry. From :py:class:`STATUS`."""
@@ -434,31 +511,7 @@ class BasePhotometry(object):
 		See Also:
 			:py:func:`resize_stamp`
 		"""
-		# Decide how many pixels to use based on lookup tables as a function of Tmag:
-		tmag = np.array([0.0, 0.52631579, 1.05263158, 1.57894737, 2.10526316,
-			2.63157895, 3.15789474, 3.68421053, 4.21052632, 4.73684211,
-			5.26315789, 5.78947368, 6.31578947, 6.84210526, 7.36842105,
-			7.89473684, 8.42105263, 8.94736842, 9.47368421, 10.0, 13.0])
-
-		height = np.array([831.98319063, 533.58494422, 344.0840884, 223.73963332,
-			147.31365728, 98.77856016, 67.95585074, 48.38157414,
-			35.95072974, 28.05639497, 23.043017, 19.85922009,
-			17.83731732, 16.5532873, 15.73785092, 15.21999971,
-			14.89113301, 14.68228285, 14.54965042, 14.46542084, 14.0])
-
-		width = np.array([157.71602062, 125.1238281, 99.99440209, 80.61896267,
-			65.6799962, 54.16166547, 45.28073365, 38.4333048,
-			33.15375951, 28.05639497, 23.043017, 19.85922009,
-			17.83731732, 16.5532873, 15.73785092, 15.21999971,
-			14.89113301, 14.68228285, 14.54965042, 14.46542084, 14.0])
-
-		Ncolumns = np.interp(self.target_tmag, tmag, width)
-		Nrows = np.interp(self.target_tmag, tmag, height)
-
-		# Round off and make sure we have minimum 15 pixels:
-		Nrows = np.maximum(np.ceil(Nrows), 15)
-		Ncolumns = np.maximum(np.ceil(Ncolumns), 15)
-		return Nrows, Ncolumns
+		return default_stamp_size(self.target_tmag)
 
 	def resize_stamp(self, down=None, up=None, left=None, right=None):
 		"""
@@ -474,6 +527,27 @@ class BasePhotometry(object):
 			bool: `True` if the stamp could be resized, `False` otherwise.
 		"""
 
+		# Resize the stamp and check if the stamp actually changed:
+		stamp_changed = self._resize_stamp(down=down, up=up, left=left, right=right)
+
+		# Count the number of times that we are resizing the stamp:
+		if stamp_changed:
+			self._details['stamp_resizes'] = self._details.get('stamp_resizes', 0) + 1
+
+		# Return if the stamp actually changed:
+		return stamp_changed
+
+	def _resize_stamp(self, down=None, up=None, left=None, right=None):
+		"""
+		Resize the stamp in a given direction, without counting it as a resize of the stamp.
+
+		Used when the size of the stamp needed is known up front, as opposed to retrying
+		with a larger stamp. See :py:func:`resize_stamp` for the parameters.
+
+		Returns:
+			bool: `True` if the stamp could be resized, `False` otherwise.
+		"""
+
 		old_stamp = self._stamp
 
 		self._stamp = list(self._stamp)
@@ -487,15 +561,8 @@ class BasePhotometry(object):
 			self._stamp[3] += right
 		self._stamp = tuple(self._stamp)
 
-		# Set stamp and check if the stamp actually changed:
-		stamp_changed = self._set_stamp(old_stamp)
-
-		# Count the number of times that we are resizing the stamp:
-		if stamp_changed:
-			self._details['stamp_resizes'] = self._details.get('stamp_resizes', 0) + 1
-
-		# Return if the stamp actually changed:
-		return stamp_changed
+		# Set stamp and return if the stamp actually changed:
+		return self._set_stamp(old_stamp)
 
 	def _set_stamp(self, compare_stamp=None):
 		"""
@@ -567,14 +634,72 @@ class BasePhotometry(object):
 		self.target_pos_row_stamp = self.target_pos_row - self._stamp[0]
 		self.target_pos_column_stamp = self.target_pos_column - self._stamp[2]
 
-		# Force sum-image and catalog to be recalculated next time:
+		if compare_stamp is not None and self._stamp[0] <= compare_stamp[0] and self._stamp[1] >= compare_stamp[1] \
+			and self._stamp[2] <= compare_stamp[2] and self._stamp[3] >= compare_stamp[3]:
+			# The stamp has grown, so keep the data which has already been loaded,
+			# and only load the data in the strips which have been added around it:
+			strips = self._stamp_strips(compare_stamp)
+			self._images_cube = self._grow_cube(self._images_cube, compare_stamp, strips, tpf_field='FLUX', hdf_group='images', full_cube=self._images_cube_full)
+			self._images_err_cube = self._grow_cube(self._images_err_cube, compare_stamp, strips, tpf_field='FLUX_ERR', hdf_group='images_err', full_cube=self._images_err_cube_full)
+			self._backgrounds_cube = self._grow_cube(self._backgrounds_cube, compare_stamp, strips, tpf_field='FLUX_BKG', hdf_group='backgrounds', full_cube=self._backgrounds_cube_full)
+			self._catalog = self._grow_catalog(compare_stamp, strips)
+		else:
+			self._catalog = None
+			self._images_cube = None
+			self._images_err_cube = None
+			self._backgrounds_cube = None
+
+		# Force sum-image and pixel flags to be recalculated next time:
 		self._sumimage = None
-		self._catalog = None
-		self._images_cube = None
-		self._backgrounds_cube = None
 		self._pixelflags = None
 		return True
 
+	def _stamp_strips(self, old_stamp):
+		"""
+		Strips which have been added to the stamp when it was grown from an older stamp.
+
+		Parameters:
+			old_stamp (tuple): Older stamp lying within the current stamp.
+
+		Returns:
+			list: Stamps (row_min, row_max, col_min, col_max) of the added strips, which
+			together with ``old_stamp`` cover the current stamp without overlapping.
+		"""
+		strips = []
+		if self._stamp[0] < old_stamp[0]:
+			strips.append((self._stamp[0], old_stamp[0], self._stamp[2], self._stamp[3]))
+		if self._stamp[1] > old_stamp[1]:
+			strips.append((old_stamp[1], self._stamp[1], self._stamp[2], self._stamp[3]))
+		if self._stamp[2] < old_stamp[2]:
+			strips.append((old_stamp[0], old_stamp[1], self._stamp[2], old_stamp[2]))
+		if self._stamp[3] > old_stamp[3]:
+			strips.append((old_stamp[0], old_stamp[1], old_stamp[3], self._stamp[3]))
+		return strips
+
+	def _grow_cube(self, cube, old_stamp, strips, full_cube=None, **kwargs):
+		"""
+		Grow data cube of an older stamp to the current stamp, only loading the added strips.
+
+		Parameters:
+			cube (ndarray or None): Data cube of the older stamp.
+			old_stamp (tuple): Older stamp lying within the current stamp.
+			strips (list): Strips added to the stamp, from :py:func:`_stamp_strips`.
+			full_cube (ndarray, optional): In-memory version of the full cube.
+			**kwargs: Passed on to :py:func:`_load_cube`.
+
+		Returns:
+			ndarray or None: Data cube of the current stamp, or ``None`` if the cube
+			was not loaded or can simply be cut out of the in-memory full cube.
+		"""
+		if cube is None or (full_cube is not None and self.datasource == 'ffi'):
+			return None
+
+		grown = np.empty((self._stamp[1]-self._stamp[0], self._stamp[3]-self._stamp[2], cube.shape[2]), dtype=cube.dtype)
+		grown[old_stamp[0]-self._stamp[0]:old_stamp[1]-self._stamp[0], old_stamp[2]-self._stamp[2]:old_stamp[3]-self._stamp[2], :] = cube
+		for strip in strips:
+			grown[strip[0]-self._stamp[0]:strip[1]-self._stamp[0], strip[2]-self._stamp[2]:strip[3]-self._stamp[2], :] = self._load_cube(stamp=strip, **kwargs)
+		return grown
+
 	def get_pixel_grid(self):
 		"""
 		Returns mesh-grid of the pixels (1-based) in the stamp.
@@ -597,15 +722,21 @@ class BasePhotometry(object):
 		"""
 		return self._stamp
 
-	def _load_cube(self, tpf_field='FLUX', hdf_group='images', full_cube=None):
+	def _load_cube(self, tpf_field='FLUX', hdf_group='images', full_cube=None, stamp=None):
 		"""
 		Load data cube into memory from TPF and HDF5 files depending on datasource.
+
+		Parameters:
+			stamp (tuple, optional): Stamp to load. Default is the current stamp.
 		"""
+		if stamp is None:
+			stamp = self._stamp
+
 		if self.datasource == 'ffi':
-			ir1 = self._stamp[0] - self.pixel_offset_row
-			ir2 = self._stamp[1] - self.pixel_offset_row
-			ic1 = self._stamp[2] - self.pixel_offset_col
-			ic2 = self._stamp[3] - self.pixel_offset_col
+			ir1 = stamp[0] - self.pixel_offset_row
+			ir2 = stamp[1] - self.pixel_offset_row
+			ic1 = stamp[2] - self.pixel_offset_col
+			ic2 = stamp[3] - self.pixel_offset_col
 			if full_cube is None:
 				# We dont have an in-memory version of the full cube, so let us
 				# create the cube by loading the cutouts of each image:
@@ -620,10 +751,10 @@ class BasePhotometry(object):
 				# TODO: Will this create copy of data in memory?
 				cube = full_cube[ir1:ir2, ic1:ic2, :]
 		else:
-			ir1 = self._stamp[0] - self._max_stamp[0]
-			ir2 = self._stamp[1] - self._max_stamp[0]
-			ic1 = self._stamp[2] - self._max_stamp[2]
-			ic2 = self._stamp[3] - self._max_stamp[2]
+			ir1 = stamp[0] - self._max_stamp[0]
+			ir2 = stamp[1] - self._max_stamp[0]
+			ic1 = stamp[2] - self._max_stamp[2]
+			ic2 = stamp[3] - self._max_stamp[2]
 			cube = np.empty((ir2-ir1, ic2-ic1, self.Ntimes), dtype='float32')
 			for k in range(self.Ntimes):
 				cube[:, :, k] = self.tpf[1].data[tpf_field][k][ir1:ir2, ic1:ic2]
@@ -875,126 +1006,173 @@ class BasePhotometry(object):
 		"""
 
 		if not self._catalog:
-			# Pixel-positions of the corners of the current stamp:
-			corners = np.array([
-				[self._stamp[2]-0.5, self._stamp[0]-0.5],
-				[self._stamp[2]-0.5, self._stamp[1]-0.5],
-				[self._stamp[3]-0.5, self._stamp[0]-0.5],
-				[self._stamp[3]-0.5, self._stamp[1]-0.5]
-			], dtype='float64')
+			self._catalog = self._query_catalog(self._stamp)
+		return self._catalog
+
+	def _query_catalog(self, stamp):
+		"""
+		Query the catalog file for the stars falling within part of the CCD.
+
+		Parameters:
+			stamp (tuple): Area (row_min, row_max, col_min, col_max) to search.
+
+		Returns:
+			``astropy.table.Table``: Table with the same columns as :py:func:`catalog`
+			of the stars within the area (plus a small buffer), with the ``row_stamp``
+			and ``column_stamp`` relative to the current stamp.
+		"""
+		# Pixel-positions of the corners of the stamp:
+		corners = np.array([
+			[stamp[2]-0.5, stamp[0]-0.5],
+			[stamp[2]-0.5, stamp[1]-0.5],
+			[stamp[3]-0.5, stamp[0]-0.5],
+			[stamp[3]-0.5, stamp[1]-0.5]
+		], dtype='float64')
+		# Because the TPF world coordinate solution is relative to the stamp,
+		# add the pixel offset to these:
+		if self.datasource.startswith('tpf'):
+			corners[:, 0] -= self.pixel_offset_col
+			corners[:, 1] -= self.pixel_offset_row
+
+		# Convert the corners into (ra, dec) coordinates and find the max and min values:
+		pixel_scale = 21.0 # Size of single pixel in arcsecs
+		buffer_size = 5 # Buffer to add around stamp in pixels
+		buffer_deg = buffer_size*pixel_scale/3600.0
+		corners_radec = self.wcs.all_pix2world(corners, 0, ra_dec_order=True)
+		radec_min = np.min(corners_radec, axis=0)
+		radec_max = np.max(corners_radec, axis=0)
+
+		# Upper and lower bounds on ra and dec:
+		ra_min_tmp = np.mod(radec_min[0] - buffer_deg, 360)
+		ra_max_tmp = np.mod(radec_max[0] + buffer_deg, 360)
+		ra_min = min(ra_min_tmp, ra_max_tmp)
+		ra_max = max(ra_min_tmp, ra_max_tmp)
+
+		dec_min = radec_min[1] - buffer_deg
+		dec_max = radec_max[1] + buffer_deg
+
+		logger = logging.getLogger(__name__)
+		logger.debug('Catalog search - ra_min = %.10f', ra_min)
+		logger.debug('Catalog search - ra_max = %.10f', ra_max)
+		logger.debug('Catalog search - dec_min = %.10f', dec_min)
+		logger.debug('Catalog search - dec_max = %.10f', dec_max)
+
+		# Select only the stars within the current stamp:
+		# TODO: Change to opening in read-only mode: sqlite3.connect("file:" + self.catalog_file + "?mode=ro", uri=True). Requires Python 3.4
+		with contextlib.closing(sqlite3.connect(self.catalog_file)) as conn:
+			cursor = conn.cursor()
+			query = "SELECT starid,ra,decl,tmag FROM catalog WHERE ra BETWEEN :ra_min AND :ra_max AND decl BETWEEN :dec_min AND :dec_max;"
+			if dec_min < -90 or dec_max > 90:
+				# We are very close to a pole
+				# Ignore everything about RA, but keep searches above abs(90),
+				# since no targets exists in database above 90 anyway
+				logger.debug("Catalog search - Near pole")
+				cursor.execute(query, {
+					'ra_min': 0,
+					'ra_max': 360,
+					'dec_min': dec_min,
+					'dec_max': dec_max
+				})
+			elif abs(ra_min - ra_max) > 90:
+				# The stamp is spanning across the ra=0 line
+				# and the difference is therefore large as WCS will always
+				# return coordinates between 0 and 360.
+				# We therefore have to change how we query on either side of the line.
+
+				corners_ra = np.mod(corners_radec[:,0] - buffer_deg, 360)
+				ra_max = np.min(corners_ra[corners_ra > 180])
+				corners_ra = np.mod(corners_radec[:,0] + buffer_deg, 360)
+				ra_min = np.max(corners_ra[corners_ra < 180])
+
+				logger.debug("Catalog search - RA=0")
+				cursor.execute("SELECT starid,ra,decl,tmag FROM catalog WHERE (ra <= :ra_min OR ra >= :ra_max) AND decl BETWEEN :dec_min AND :dec_max;", {
+					'ra_min': ra_min,
+					'ra_max': ra_max,
+					'dec_min': dec_min,
+					'dec_max': dec_max
+				})
+			else:
+				logger.debug("Catalog search - Normal")
+				cursor.execute(query, {
+					'ra_min': ra_min,
+					'ra_max': ra_max,
+					'dec_min': dec_min,
+					'dec_max': dec_max
+				})
+
+			cat = cursor.fetchall()
+			cursor.close()
+
+		if not cat:
+			# Nothing was found. Return an empty table with the correct format:
+			catalog = Table(
+				names=('starid', 'ra', 'dec', 'tmag', 'column', 'row', 'column_stamp', 'row_stamp'),
+				dtype=('int64', 'float64', 'float64', 'float32', 'float32', 'float32', 'float32', 'float32')
+			)
+		else:
+			# Convert data to astropy table for further use:
+			catalog = Table(
+				rows=cat,
+				names=('starid', 'ra', 'dec', 'tmag'),
+				dtype=('int64', 'float64', 'float64', 'float32')
+			)
+
+			# Use the WCS to find pixel coordinates of stars in mask:
+			pixel_coords = self.wcs.all_world2pix(np.column_stack((catalog['ra'], catalog['dec'])), 0, ra_dec_order=True)
+
 			# Because the TPF world coordinate solution is relative to the stamp,
 			# add the pixel offset to these:
 			if self.datasource.startswith('tpf'):
-				corners[:, 0] -= self.pixel_offset_col
-				corners[:, 1] -= self.pixel_offset_row
-
-			# Convert the corners into (ra, dec) coordinates and find the max and min values:
-			pixel_scale = 21.0 # Size of single pixel in arcsecs
-			buffer_size = 5 # Buffer to add around stamp in pixels
-			buffer_deg = buffer_size*pixel_scale/3600.0
-			corners_radec = self.wcs.all_pix2world(corners, 0, ra_dec_order=True)
-			radec_min = np.min(corners_radec, axis=0)
-			radec_max = np.max(corners_radec, axis=0)
-
-			# Upper and lower bounds on ra and dec:
-			ra_min_tmp = np.mod(radec_min[0] - buffer_deg, 360)
-			ra_max_tmp = np.mod(radec_max[0] + buffer_deg, 360)
-			ra_min = min(ra_min_tmp, ra_max_tmp)
-			ra_max = max(ra_min_tmp, ra_max_tmp)
-
-			dec_min = radec_min[1] - buffer_deg
-			dec_max = radec_max[1] + buffer_deg
-
-			logger = logging.getLogger(__name__)
-			logger.debug('Catalog search - ra_min = %.10f', ra_min)
-			logger.debug('Catalog search - ra_max = %.10f', ra_max)
-			logger.debug('Catalog search - dec_min = %.10f', dec_min)
-			logger.debug('Catalog search - dec_max = %.10f', dec_max)
-
-			# Select only the stars within the current stamp:
-			# TODO: Change to opening in read-only mode: sqlite3.connect("file:" + self.catalog_file + "?mode=ro", uri=True). Requires Python 3.4
-			with contextlib.closing(sqlite3.connect(self.catalog_file)) as conn:
-				cursor = conn.cursor()
-				query = "SELECT starid,ra,decl,tmag FROM catalog WHERE ra BETWEEN :ra_min AND :ra_max AND decl BETWEEN :dec_min AND :dec_max;"
-				if dec_min < -90 or dec_max > 90:
-					# We are very close to a pole
-					# Ignore everything about RA, but keep searches above abs(90),
-					# since no targets exists in database above 90 anyway
-					logger.debug("Catalog search - Near pole")
-					cursor.execute(query, {
-						'ra_min': 0,
-						'ra_max': 360,
-						'dec_min': dec_min,
-						'dec_max': dec_max
-					})
-				elif abs(ra_min - ra_max) > 90:
-					# The stamp is spanning across the ra=0 line
-					# and the difference is therefore large as WCS will always
-					# return coordinates between 0 and 360.
-					# We therefore have to change how we query on either side of the line.
-
-					corners_ra = np.mod(corners_radec[:,0] - buffer_deg, 360)
-					ra_max = np.min(corners_ra[corners_ra > 180])
-					corners_ra = np.mod(corners_radec[:,0] + buffer_deg, 360)
-					ra_min = np.max(corners_ra[corners_ra < 180])
-
-					logger.debug("Catalog search - RA=0")
-					cursor.execute("SELECT starid,ra,decl,tmag FROM catalog WHERE (ra <= :ra_min OR ra >= :ra_max) AND decl BETWEEN :dec_min AND :dec_max;", {
-						'ra_min': ra_min,
-						'ra_max': ra_max,
-						'dec_min': dec_min,
-						'dec_max': dec_max
-					})
-				else:
-					logger.debug("Catalog search - Normal")
-					cursor.execute(query, {
-						'ra_min': ra_min,
-						'ra_max': ra_max,
-						'dec_min': dec_min,
-						'dec_max': dec_max
-					})
-
-				cat = cursor.fetchall()
-				cursor.close()
-
-			if not cat:
-				# Nothing was found. Return an empty table with the correct format:
-				self._catalog = Table(
-					names=('starid', 'ra', 'dec', 'tmag', 'column', 'row', 'column_stamp', 'row_stamp'),
-					dtype=('int64', 'float64', 'float64', 'float32', 'float32', 'float32', 'float32', 'float32')
-				)
-			else:
-				# Convert data to astropy table for further use:
-				self._catalog = Table(
-					rows=cat,
-					names=('starid', 'ra', 'dec', 'tmag'),
-					dtype=('int64', 'float64', 'float64', 'float32')
-				)
+				pixel_coords[:,0] += self.pixel_offset_col
+				pixel_coords[:,1] += self.pixel_offset_row
 
-				# Use the WCS to find pixel coordinates of stars in mask:
-				pixel_coords = self.wcs.all_world2pix(np.column_stack((self._catalog['ra'], self._catalog['dec'])), 0, ra_dec_order=True)
+			# Create columns with pixel coordinates:
+			col_x = Column(data=pixel_coords[:,0], name='column', dtype='float32')
+			col_y = Column(data=pixel_coords[:,1], name='row', dtype='float32')
 
-				# Because the TPF world coordinate solution is relative to the stamp,
-				# add the pixel offset to these:
-				if self.datasource.startswith('tpf'):
-					pixel_coords[:,0] += self.pixel_offset_col
-					pixel_coords[:,1] += self.pixel_offset_row
+			# Subtract the positions of the edge of the current stamp:
+			pixel_coords[:,0] -= self._stamp[2]
+			pixel_coords[:,1] -= self._stamp[0]
 
-				# Create columns with pixel coordinates:
-				col_x = Column(data=pixel_coords[:,0], name='column', dtype='float32')
-				col_y = Column(data=pixel_coords[:,1], name='row', dtype='float32')
+			# Add the pixel positions to the catalog table:
+			col_x_stamp = Column(data=pixel_coords[:,0], name='column_stamp', dtype='float32')
+			col_y_stamp = Column(data=pixel_coords[:,1], name='row_stamp', dtype='float32')
 
-				# Subtract the positions of the edge of the current stamp:
-				pixel_coords[:,0] -= self._stamp[2]
-				pixel_coords[:,1] -= self._stamp[0]
+			catalog.add_columns([col_x, col_y, col_x_stamp, col_y_stamp])
 
-				# Add the pixel positions to the catalog table:
-				col_x_stamp = Column(data=pixel_coords[:,0], name='column_stamp', dtype='float32')
-				col_y_stamp = Column(data=pixel_coords[:,1], name='row_stamp', dtype='float32')
+		return catalog
 
-				self._catalog.add_columns([col_x, col_y, col_x_stamp, col_y_stamp])
+	def _grow_catalog(self, old_stamp, strips):
+		"""
+		Extend the catalog of an older stamp with the stars in the strips added to the stamp.
 
-		return self._catalog
+		Parameters:
+			old_stamp (tuple): Older stamp lying within the current stamp.
+			strips (list): Strips added to the stamp, from :py:func:`_stamp_strips`.
+
+		Returns:
+			``astropy.table.Table`` or None: Catalog of the current stamp, or ``None``
+			if the catalog of the older stamp was never loaded.
+		"""
+		if self._catalog is None:
+			return None
+
+		# Move the positions of the known stars to the new edge of the stamp:
+		catalog = self._catalog.copy()
+		catalog['column_stamp'] += old_stamp[2] - self._stamp[2]
+		catalog['row_stamp'] += old_stamp[0] - self._stamp[0]
+
+		# Add the stars from the added strips, which were not already known
+		# from the buffer around the older stamp or from another strip:
+		tables = [catalog]
+		known = set(catalog['starid'])
+		for strip in strips:
+			cat = self._query_catalog(strip)
+			indx = np.array([starid not in known for starid in cat['starid']], dtype='bool')
+			tables.append(cat[indx])
+			known.update(cat['starid'])
+
+		return vstack(tables, join_type='exact')
 
 	@property
 	def MovementKernel(self):
@@ -1084,18 +1262,23 @@ class BasePhotometry(object):
 				logger.debug("Deleting plot '%s'", f)
 				os.unlink(f)
 
-	def report_details(self, error=None, skip_targets=None):
+	def report_details(self, error=None, skip_targets=None, secondary=None):
 		"""
 		Report details of the processing back to the overlying scheduler system.
 
 		Parameters:
 			error (string): Error message the be logged with the results.
 			skip_targets (list): List of starids that can be safely skipped.
+			secondary (dict): Result (starid, status, time and details) of another target
+				processed along with this target.
 		"""
 
 		if skip_targets is not None:
 			self._details['skip_targets'] = skip_targets
 
+		if secondary is not None:
+			self._details.setdefault('secondary', []).append(secondary)
+
 		if error is not None:
 			if 'errors' not in self._details: self._details['errors'] = []
 			self._details['errors'].append(error)
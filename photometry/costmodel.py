@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Model of the expected computational cost of photometry tasks.
+"""
+
+from __future__ import division, with_statement, print_function, absolute_import
+import numpy as np
+import logging
+from .utilities import default_stamp_size
+
+#------------------------------------------------------------------------------
+# Typical number of cadences in a sector for the different datasources:
+CADENCES = {
+	'ffi': 1315,
+	'tpf': 19700
+}
+
+# Approximate peak memory in bytes used per pixel-cadence by each method.
+# The image, uncertainty and background cubes are all stored as float32,
+# on top of which comes the memory used internally by each method:
+MEMORY_PER_PIXEL_CADENCE = {
+	'aperture': 16,
+	'linpsf': 32,
+	'psf': 32,
+	'halo': 64
+}
+
+# Approximate memory in bytes used by a worker, regardless of the target:
+MEMORY_OVERHEAD = 500 * 1024**2
+
+#------------------------------------------------------------------------------
+def task_datasource(task):
+	"""
+	Type of datasource of a task.
+
+	Secondary targets in Target Pixel Files (``'tpf:<starid>'``) are
+	counted as Target Pixel Files.
+
+	Parameters:
+		task (dict): Task or result from TODO-list.
+
+	Returns:
+		string: Either ``'ffi'`` or ``'tpf'``.
+	"""
+	return 'tpf' if task['datasource'].startswith('tpf') else 'ffi'
+
+#------------------------------------------------------------------------------
+def task_method(task):
+	"""
+	Photometry method used for a task.
+
+	Parameters:
+		task (dict): Task or result from TODO-list.
+
+	Returns:
+		string: Name of method. If the task doesn't specify a method,
+		``'aperture'`` is returned, which is the default in :py:func:`photometry.tessphot`.
+	"""
+	return task['method'] if task.get('method') else 'aperture'
+
+#------------------------------------------------------------------------------
+def task_pixels(task):
+	"""
+	Expected number of pixels in the stamp of a task.
+
+	If the task contains ``stamp_width`` and ``stamp_height`` (e.g. from the
+	diagnostics of previous runs) these are used, otherwise the size is estimated
+	from the magnitude of the target using :py:func:`default_stamp_size`.
+
+	Parameters:
+		task (dict): Task or result from TODO-list.
+
+	Returns:
+		float: Number of pixels.
+	"""
+	if task.get('stamp_width') and task.get('stamp_height'):
+		return float(task['stamp_width'] * task['stamp_height'])
+	tmag = task['tmag'] if task.get('tmag') is not None else 10.0
+	Nrows, Ncolumns = default_stamp_size(tmag)
+	return float(Nrows * Ncolumns)
+
+#------------------------------------------------------------------------------
+def estimate_memory(task):
+	"""
+	Estimate of the peak memory used when processing a task.
+
+	Parameters:
+		task (dict): Task from TODO-list.
+
+	Returns:
+		float: Expected peak memory in bytes.
+	"""
+	rate = MEMORY_PER_PIXEL_CADENCE.get(task_method(task), max(MEMORY_PER_PIXEL_CADENCE.values()))
+	return MEMORY_OVERHEAD + rate * task_pixels(task) * CADENCES[task_datasource(task)]
+
+#------------------------------------------------------------------------------
+class CostModel(object):
+	"""
+	Model of the expected run time of photometry tasks.
+
+	The run time of a task is modelled as a power law in the number of
+	pixel-cadences that needs to be processed,
+
+	.. math::
+		t = a \\cdot (N_\\mathrm{pixels} \\cdot N_\\mathrm{cadences})^b ,
+
+	with separate coefficients for each photometry method and datasource.
+	The coefficients are fitted to the run times of previously processed targets.
+	For combinations without enough history, a rough prior is used, which
+	is scaled to match the history which is available.
+
+	Attributes:
+		coefficients (dict): Fitted ``(log(a), b)`` for each ``(method, datasource)``.
+		scale (float): Correction factor applied to the prior.
+	"""
+
+	# Prior on run time per pixel-cadence in seconds, for each method:
+	prior_rate = {
+		'aperture': 2e-5,
+		'linpsf': 2e-4,
+		'halo': 5e-4,
+		'psf': 1e-3
+	}
+
+	def __init__(self, min_samples=20):
+		"""
+		Parameters:
+			min_samples (int): Minimum number of targets needed for
+				fitting a method and datasource. Default=20.
+		"""
+		self.min_samples = min_samples
+		self.coefficients = {}
+		self.scale = 1.0
+		self.logger = logging.getLogger(__name__)
+
+	@staticmethod
+	def _group(task):
+		return (task_method(task), task_datasource(task))
+
+	@staticmethod
+	def _size(task):
+		return task_pixels(task) * CADENCES[task_datasource(task)]
+
+	def _prior(self, task):
+		rate = self.prior_rate.get(task_method(task), max(self.prior_rate.values()))
+		return rate * self._size(task)
+
+	def fit(self, rows):
+		"""
+		Fit the model to run times of previously processed targets.
+
+		Parameters:
+			rows (iterable): Targets with known run time. Each should be a dictionary
+				(or :py:class:`sqlite3.Row`) with the keys ``method``, ``datasource``, ``tmag``,
+				``stamp_width``, ``stamp_height`` and ``elaptime``.
+
+		Returns:
+			:py:class:`CostModel`: The model itself.
+		"""
+		groups = {}
+		for row in rows:
+			row = dict(row)
+			if not row.get('elaptime') or row['elaptime'] <= 0:
+				continue
+			groups.setdefault(self._group(row), []).append((
+				np.log(self._size(row)),
+				np.log(row['elaptime']),
+				np.log(row['elaptime'] / self._prior(row))
+			))
+
+		# Scale the prior to match all the history available:
+		if groups:
+			ratios = np.concatenate([np.array(g)[:,2] for g in groups.values()])
+			self.scale = float(np.exp(np.median(ratios)))
+
+		self.coefficients = {}
+		for key, values in groups.items():
+			if len(values) < self.min_samples:
+				continue
+			values = np.array(values)
+			x = values[:,0]
+			y = values[:,1]
+			if np.ptp(x) > 0.5:
+				slope, intercept = np.polyfit(x, y, 1)
+			else:
+				# Not enough range in sizes to constrain the slope,
+				# so assume that the time is proportional to the size:
+				slope = 1.0
+				intercept = np.median(y - x)
+			self.coefficients[key] = (float(intercept), float(slope))
+			self.logger.debug("Cost model for %s: log(a)=%f, b=%f (%d targets)", key, intercept, slope, len(values))
+
+		return self
+
+	def predict(self, task):
+		"""
+		Expected run time of task.
+
+		Parameters:
+			task (dict): Task from TODO-list.
+
+		Returns:
+			float: Expected run time in seconds.
+		"""
+		coeff = self.coefficients.get(self._group(task))
+		if coeff is None:
+			return self.scale * self._prior(task)
+		return float(np.exp(coeff[0] + coeff[1]*np.log(self._size(task))))
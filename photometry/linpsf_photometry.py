@@ -14,11 +14,14 @@ import logging
 import os
 from .BasePhotometry import BasePhotometry, STATUS
 from .psf import PSF
-from .utilities import mag2flux
+from .utilities import mag2flux, fork_map, cadence_chunks
 from .plots import plot_image_fit_residuals, save_figure
 
 class LinPSFPhotometry(BasePhotometry):
 
+	# Number of consecutive images fitted by each process when using several cores:
+	cadences_per_chunk = 100
+
 	def __init__(self, *args, **kwargs):
 		"""
 		Linear PSF photometry.
@@ -47,39 +50,28 @@ class LinPSFPhotometry(BasePhotometry):
 		# TODO: Maybe we should move this into BasePhotometry?
 		self.psf = PSF(self.camera, self.ccd, self.stamp)
 
-	def do_photometry(self):
-		"""Linear PSF Photometry
-		TODO: add description of method and what A and b are
+	def _fit_cadences(self, indx, staridx, cadences):
 		"""
+		Fit the fluxes of the stars in a range of images.
 
-		logger = logging.getLogger(__name__)
+		Parameters:
+			indx (numpy array): Indices of the stars in the catalog to fit.
+			staridx (integer): Index of the main target among the stars to fit.
+			cadences (numpy array): Indices of the images to fit.
 
-		# Load catalog to determine what stars to fit:
-		cat = self.catalog
-		staridx = np.squeeze(np.where(cat['starid']==self.starid))
-
-		# Log full catalog for current stamp:
-		logger.debug(cat)
-
-		# Calculate distance from main target:
-		cat['dist'] = np.sqrt((cat['row_stamp'][staridx] - cat['row_stamp'])**2 + \
-						(cat['column_stamp'][staridx] - cat['column_stamp'])**2)
+		Returns:
+			tuple: List of tuples of the index of each image and the fitted fluxes of the stars,
+			or ``None`` if the fit failed, and the matrix ``A`` of the last image.
+		"""
 
-		# Find indices of stars in catalog to fit:
-		# (only include stars that are close to the main target and that are 
-		# not much fainter)
-		indx = (cat['dist'] < 5) & (cat['tmag'][staridx]-cat['tmag'] > -5)
+		logger = logging.getLogger(__name__)
 		nstars = np.sum(indx)
 
-		# Get target star index in the reduced catalog of stars to fit:
-		staridx = np.squeeze(np.where(cat[indx]['starid']==self.starid))
-		logger.debug('Target star index: %s', np.str(staridx))
-
-		# Preallocate flux sum array for contamination calculation:
-		fluxes_sum = np.zeros(nstars)
+		results = []
+		A = None
+		for k in cadences:
+			img = self.images_cube[:, :, k]
 
-		# Start looping through the images (time domain):
-		for k, img in enumerate(self.images):
 			# Get catalog at current time in MJD:
 			cat = self.catalog_attime(self.lightcurve['time'][k])
 
@@ -128,13 +120,7 @@ class LinPSFPhotometry(BasePhotometry):
 				logger.debug('Fluxes are: ' + np.str(fluxes))
 				logger.debug('Result is: ' + np.str(result))
 
-				# Add the result of the main star to the lightcurve:
-				self.lightcurve['flux'][k] = result
-				self.lightcurve['pos_centroid'][k] = [np.NaN, np.NaN]
-				self.lightcurve['quality'][k] = 0
-
-				# Add current fitted fluxes for contamination calculation:
-				fluxes_sum += fluxes
+				results.append((k, fluxes))
 
 				if self.plot:
 					# Make plot for debugging:
@@ -166,11 +152,62 @@ class LinPSFPhotometry(BasePhotometry):
 			# Pass result if fit failed:
 			else:
 				logger.warning("We should flag that this has not gone well.")
+				results.append((k, None))
+
+		return results, A
+
+	def do_photometry(self):
+		"""Linear PSF Photometry
+		TODO: add description of method and what A and b are
+		"""
+
+		logger = logging.getLogger(__name__)
+
+		# Load catalog to determine what stars to fit:
+		cat = self.catalog
+		staridx = np.squeeze(np.where(cat['starid']==self.starid))
+
+		# Log full catalog for current stamp:
+		logger.debug(cat)
+
+		# Calculate distance from main target:
+		cat['dist'] = np.sqrt((cat['row_stamp'][staridx] - cat['row_stamp'])**2 + \
+						(cat['column_stamp'][staridx] - cat['column_stamp'])**2)
+
+		# Find indices of stars in catalog to fit:
+		# (only include stars that are close to the main target and that are 
+		# not much fainter)
+		indx = (cat['dist'] < 5) & (cat['tmag'][staridx]-cat['tmag'] > -5)
+		nstars = np.sum(indx)
 
-				self.lightcurve['flux'][k] = np.NaN
-				self.lightcurve['pos_centroid'][k] = [np.NaN, np.NaN]
-				self.lightcurve['quality'][k] = 1 # FIXME: Use the real flag!
+		# Get target star index in the reduced catalog of stars to fit:
+		staridx = np.squeeze(np.where(cat[indx]['starid']==self.starid))
+		logger.debug('Target star index: %s', np.str(staridx))
+
+		# Split the timeseries into chunks which are fitted in parallel, when
+		# we are allowed to use more than one core. The images are loaded before
+		# splitting, so the forked processes all share the same data:
+		self.images_cube
+		chunks = cadence_chunks(self.Ntimes, self.cadences_per_chunk)
+		results = fork_map(self._fit_cadences, [(indx, staridx, cadences) for cadences in chunks], processes=self.cores)
+
+		# Preallocate flux sum array for contamination calculation:
+		fluxes_sum = np.zeros(nstars)
 
+		for chunk_results, A in results:
+			for k, fluxes in chunk_results:
+				if fluxes is not None:
+					# Add the result of the main star to the lightcurve:
+					self.lightcurve['flux'][k] = fluxes[staridx]
+					self.lightcurve['pos_centroid'][k] = [np.NaN, np.NaN]
+					self.lightcurve['quality'][k] = 0
+
+					# Add current fitted fluxes for contamination calculation:
+					fluxes_sum += fluxes
+				else:
+					self.lightcurve['flux'][k] = np.NaN
+					self.lightcurve['pos_centroid'][k] = [np.NaN, np.NaN]
+					self.lightcurve['quality'][k] = 1 # FIXME: Use the real flag!
 		
 		if np.sum(np.isnan(self.lightcurve['flux'])) == len(self.lightcurve['flux']):
 			# Set contamination to NaN if all flux values are NaN:
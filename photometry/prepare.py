@@ -3,6 +3,7 @@
 
 from __future__ import division, with_statement, print_function, absolute_import
 from six.moves import range
+import six
 import os
 import numpy as np
 import warnings
@@ -13,6 +14,7 @@ import logging
 import re
 import multiprocessing
 from astropy.wcs import WCS
+from astropy.io import fits
 from bottleneck import replace, nanmean
 from timeit import default_timer
 import itertools
@@ -20,6 +22,7 @@ import contextlib
 from .backgrounds import fit_background
 from .utilities import load_ffi_fits, find_ffi_files, find_catalog_files
 from photometry import TESSQualityFlags, ImageMovementKernel
+from .AperturePhotometry.photometry import segment_sumimage
 
 #------------------------------------------------------------------------------
 def _iterate_hdf_group(dset):
@@ -27,7 +30,7 @@ def _iterate_hdf_group(dset):
 		yield np.asarray(dset[d])
 
 #------------------------------------------------------------------------------
-def create_hdf5(input_folder=None, sectors=None, cameras=None, ccds=None):
+def create_hdf5(input_folder=None, sectors=None, cameras=None, ccds=None, segmentation=True):
 	"""
 	Restructure individual FFI images (in FITS format) into
 	a combined HDF5 file which is used in the photometry
@@ -40,6 +43,9 @@ def create_hdf5(input_folder=None, sectors=None, cameras=None, ccds=None):
 		input_folder (string): Input folder to create TODO list for. If ``None``, the input directory in the environment variable ``TESSPHOT_INPUT`` is used.
 		cameras (iterable of integers, optional): TESS camera number (1-4). If ``None``, all cameras will be processed.
 		ccds (iterable of integers, optional): TESS CCD number (1-4). If ``None``, all cameras will be processed.
+		segmentation (boolean, optional): Segment the sum-image into masks of the stars in the catalog
+			(see :py:func:`photometry.AperturePhotometry.photometry.segment_sumimage`),
+			which are used by the aperture photometry instead of creating a mask for each target. Default=True.
 
 	Raises:
 		IOError: If the specified ``input_folder`` is not an existing directory or if settings table could not be loaded from the catalog SQLite file.
@@ -318,6 +324,7 @@ def create_hdf5(input_folder=None, sectors=None, cameras=None, ccds=None):
 				if 'time' in hdf: del hdf['time']
 				if 'timecorr' in hdf: del hdf['timecorr']
 				if 'sumimage' in hdf: del hdf['sumimage']
+				if 'segmentation' in hdf: del hdf['segmentation'] # Must be recreated from the new sum-image
 				if 'cadenceno' in hdf: del hdf['cadenceno']
 				if 'quality' in hdf: del hdf['quality']
 				hdf.create_dataset('sumimage', data=SumImage, **args)
@@ -379,5 +386,40 @@ def create_hdf5(input_folder=None, sectors=None, cameras=None, ccds=None):
 				dset.attrs['warpmode'] = imk.warpmode
 				dset.attrs['ref_frame'] = refindx
 
+			if segmentation and 'segmentation' not in hdf:
+				logger.info("Segmenting sum-image...")
+
+				# World Coordinate System of the reference image:
+				hdr_string = wcs['%04d' % refindx][0]
+				if not isinstance(hdr_string, six.string_types): hdr_string = hdr_string.decode("utf-8") # For Python 3
+				ref_wcs = WCS(header=fits.Header().fromstring(hdr_string), relax=True)
+
+				# Load all stars from the catalog and find their positions in the sum-image:
+				with contextlib.closing(sqlite3.connect(catalog_file[0])) as conn:
+					cursor = conn.cursor()
+					cursor.execute("SELECT starid,ra,decl,tmag FROM catalog;")
+					cat = np.array(cursor.fetchall(), dtype='float64').reshape(-1, 4)
+					cursor.close()
+
+				pixel_coords = np.zeros((len(cat), 2), dtype='float64')
+				if len(cat) > 0:
+					pixel_coords = ref_wcs.all_world2pix(cat[:, 1:3], 0, ra_dec_order=True)
+				catalog = np.column_stack((
+					pixel_coords[:, 0] - images.attrs.get('PIXEL_OFFSET_COLUMN', 44),
+					pixel_coords[:, 1] - images.attrs.get('PIXEL_OFFSET_ROW', 0),
+					cat[:, 3]
+				))
+
+				tic = default_timer()
+				labels, starids, bbox = segment_sumimage(np.asarray(hdf['sumimage']), cat[:, 0], catalog, threads=threads)
+				logger.info("Segmentation: %f sec", default_timer()-tic)
+
+				# Save the image of labels, and which stars and pixels belong to each label:
+				segm = hdf.create_group('segmentation')
+				segm.create_dataset('labels', data=labels, chunks=imgchunks, **args)
+				segm.create_dataset('starids', data=starids)
+				segm.create_dataset('bbox', data=bbox)
+				hdf.flush()
+
 		logger.info("Done.")
 		logger.info("Total: %f sec/image", (default_timer()-tic_total)/numfiles)
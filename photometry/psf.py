@@ -11,10 +11,56 @@ from six.moves import range
 import os
 import numpy as np
 from scipy.io import loadmat
-from scipy.interpolate import RectBivariateSpline
+from scipy.interpolate import RectBivariateSpline, bisplev
 import glob
 from .plots import plt, plot_image
 
+#------------------------------------------------------------------------------
+def _antiderivative_coeffs(t, c, k):
+	"""
+	Coefficients of the antiderivative of a spline along the first axis.
+
+	Parameters:
+		t (ndarray): Knots of the spline.
+		c (ndarray): Coefficients of the spline, with one row for each B-spline.
+		k (int): Degree of the spline.
+
+	Returns:
+		tuple: Knots and coefficients of the antiderivative, which has degree ``k+1``
+		and is zero at the first knot.
+	"""
+	# Same recurrence as scipy.interpolate.splantider, but for several splines at once:
+	dt = t[k+1:] - t[:-k-1]
+	c = np.cumsum(c * dt.reshape((-1,) + (1,)*(c.ndim-1)), axis=0) / (k + 1)
+	c = np.concatenate((np.zeros((1,) + c.shape[1:]), c), axis=0)
+	t = np.concatenate(([t[0]], t, [t[-1]]))
+	return t, c
+
+#------------------------------------------------------------------------------
+def integral_spline(spline):
+	"""
+	Integral of a 2D spline from the lower corner of its domain.
+
+	The integral of the spline over any rectangle is given by the returned spline
+	evaluated in the four corners of the rectangle, like a summed-area table.
+
+	Parameters:
+		spline (`scipy.interpolate.RectBivariateSpline` object): Spline to integrate.
+
+	Returns:
+		list: Knots, coefficients and degrees of the integral, which is a spline of one
+		degree higher than ``spline`` in both directions, to be evaluated using
+		:py:func:`scipy.interpolate.bisplev`.
+	"""
+	tx, ty, c = spline.tck
+	kx, ky = spline.degrees
+	c = np.reshape(c, (len(tx)-kx-1, len(ty)-ky-1))
+	tx, c = _antiderivative_coeffs(tx, c, kx)
+	ty, c = _antiderivative_coeffs(ty, c.T, ky)
+	return [tx, ty, c.T.flatten(), kx+1, ky+1]
+
+#------------------------------------------------------------------------------
+
 class PSF(object):
 	"""
 	Point Spread Function (PSF).
@@ -28,6 +74,7 @@ class PSF(object):
 		ref_column (float): Reference CCD column that PSF is calculated for.
 		ref_row (float): Reference CCD row that PSF is calculated for.
 		splineInterpolation (`scipy.interpolate.RectBivariateSpline` object): Interpolation to evaluate PSF on arbitrery position relative to center of PSF.
+		integralSpline (list): Integral of ``splineInterpolation`` (see :py:func:`integral_spline`).
 
 	.. codeauthor:: Rasmus Handberg <rasmush@phys.au.dk>
 	"""
@@ -110,11 +157,18 @@ class PSF(object):
 		# Interpolation function over the PRF:
 		self.splineInterpolation = RectBivariateSpline(PRFx, PRFy, prf) #: 2D-interpolation of PSF (RectBivariateSpline).
 
+		# Integral of the PSF, used for integrating the PSF onto pixels:
+		self.integralSpline = integral_spline(self.splineInterpolation) #: Integral of :py:attr:`splineInterpolation` from the lower corner of its domain.
+
 
 	def integrate_to_image(self, params, cutoff_radius=5):
 		"""
 		Integrate the underlying high-res PSF onto pixels.
 
+		The integral over each pixel is found from :py:attr:`integralSpline` evaluated in
+		the corners of the pixels, which gives the same as integrating
+		:py:attr:`splineInterpolation` over each pixel, up to round-off errors.
+
 		Parameters:
 			params (iterator, numpy.array): List of stars to add to image. Should be an iterator where each element is an numpy array with three elements: row, column and flux.
 			cutoff_radius (float, optional): Maximal radius away from center of star in pixels to integrate PSF model.
@@ -124,16 +178,30 @@ class PSF(object):
 		"""
 
 		img = np.zeros(self.shape, dtype='float64')
-		for i in range(self.shape[0]):
-			for j in range(self.shape[1]):
-				for star in params:
-					star_row = star[0]
-					star_column = star[1]
-					if np.sqrt((j-star_column)**2 + (i-star_row)**2) < cutoff_radius:
-						star_flux = star[2]
-						column_cen = j - star_column
-						row_cen = i - star_row
-						img[i,j] += star_flux * self.splineInterpolation.integral(column_cen-0.5, column_cen+0.5, row_cen-0.5, row_cen+0.5)
+		for star in params:
+			star_row = star[0]
+			star_column = star[1]
+			star_flux = star[2]
+
+			# Pixels within the cutoff radius of the star:
+			i1 = max(int(np.ceil(star_row - cutoff_radius)), 0)
+			i2 = min(int(np.floor(star_row + cutoff_radius)), self.shape[0]-1)
+			j1 = max(int(np.ceil(star_column - cutoff_radius)), 0)
+			j2 = min(int(np.floor(star_column + cutoff_radius)), self.shape[1]-1)
+			if i1 > i2 or j1 > j2:
+				continue
+
+			# Integral of the PSF up to the edges of the pixels, relative to the star:
+			column_edges = np.arange(j1, j2+2) - 0.5 - star_column
+			row_edges = np.arange(i1, i2+2) - 0.5 - star_row
+			integral = bisplev(column_edges, row_edges, self.integralSpline)
+
+			# Integral over each pixel from the integrals in the corners:
+			pixels = (integral[1:, 1:] - integral[:-1, 1:] - integral[1:, :-1] + integral[:-1, :-1]).T
+
+			rows, cols = np.mgrid[i1:i2+1, j1:j2+1]
+			inside = (np.sqrt((cols - star_column)**2 + (rows - star_row)**2) < cutoff_radius)
+			img[i1:i2+1, j1:j2+1] += star_flux * np.where(inside, pixels, 0)
 
 		return img
 
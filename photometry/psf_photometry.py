@@ -7,8 +7,8 @@ Created on Wed Nov  8 16:37:12 2017
 """
 
 from __future__ import division, with_statement, print_function, absolute_import
-from six.moves import zip
 import os.path
+import itertools
 import numpy as np
 import matplotlib.pyplot as plt
 import logging
@@ -16,11 +16,16 @@ from copy import deepcopy
 from scipy.optimize import minimize
 from . import BasePhotometry, STATUS
 from .psf import PSF
-from .utilities import mag2flux
+from .utilities import mag2flux, fork_map, cadence_chunks
 from .plots import plot_image, save_figure
 
 class PSFPhotometry(BasePhotometry):
 
+	# Number of consecutive images fitted as one chunk, each starting from the catalog
+	# parameters. The chunks are the same no matter how many cores are used, so the
+	# results do not depend on the number of cores:
+	cadences_per_chunk = 100
+
 	def __init__(self, *args, **kwargs):
 		# Call the parent initializing:
 		# This will set several default settings
@@ -91,41 +96,31 @@ class PSFPhotometry(BasePhotometry):
 			raise ValueError("Invalid statistic: '%s'" % lhood_stat)
 
 
-	def do_photometry(self):
-		"""PSF Photometry"""
-
-		logger = logging.getLogger(__name__)
-
-		# Generate list of stars to fit:
-		cat = self.catalog
-
-		# Calculate distance from main target:
-		cat['dist'] = np.sqrt((self.target_pos_row_stamp - cat['row_stamp'])**2 + (self.target_pos_column_stamp - cat['column_stamp'])**2)
+	def _fit_cadences(self, params0, params_start, cadences):
+		"""
+		Fit the PSF to a consecutive range of images.
 
-		# Only include stars that are close to the main target and that are not much fainter:
-		cat = cat[(cat['dist'] < 5) & (self.target_tmag-cat['tmag'] > -5)]
+		Parameters:
+			params0 (numpy array): Starting parameters for the first image.
+			params_start (numpy array): Catalog parameters, used for plotting.
+			cadences (numpy array): Indices of the images to fit.
 
-		# Sort the catalog by distance and include at max the five closest stars:
-		# FIXME: Make sure that the main target is in there!!!
-		cat.sort('dist')
-		if len(cat) > 5:
-			cat = cat[:5]
+		Returns:
+			list: Tuples of the index of each image and the fitted parameters
+			(number of stars x 3), or ``None`` if the fit failed.
+		"""
 
-		# Because the minimize routine used below only likes 1D numpy arrays
-		# we have to restructure the catalog:
-		params0 = np.empty((len(cat), 3), dtype='float64')
-		for k, target in enumerate(cat):
-			params0[k,:] = [target['row_stamp'], target['column_stamp'], mag2flux(target['tmag'])]
-		params_start = deepcopy(params0) # Save the starting parameters for later
-		params0 = params0.flatten() # Make the parameters into a 1D array
+		logger = logging.getLogger(__name__)
 
-		# Start looping through the images (time domain):
-		for k, (img, bkg) in enumerate(zip(self.images, self.backgrounds)):
+		results = []
+		for i, k in enumerate(cadences):
 			# Print timestep index to logger:
 			logger.info('Current timestep: %s' % k)
+			img = self.images_cube[:, :, k]
+			bkg = self.backgrounds_cube[:, :, k]
 
 			# Set the maximum number of iterations for the minimize routine:
-			if k > 0:
+			if i > 0:
 				maxiter = 500
 			else: # The first step requires more iterations due to bad starting guess
 				maxiter = 1500
@@ -139,11 +134,7 @@ class PSFPhotometry(BasePhotometry):
 				result = res.x
 				result = np.array(result.reshape(len(result)//3, 3))
 				logger.debug(result)
-
-				# Add the result of the main star to the lightcurve:
-				self.lightcurve['flux'][k] = result[0, 2]
-				self.lightcurve['pos_centroid'][k] = result[0, 0:2]
-				self.lightcurve['quality'][k] = 0
+				results.append((k, result))
 
 				# TODO: use debug figure toggle to decide if to plot and export
 				if self.plot and logger.isEnabledFor(logging.DEBUG):
@@ -173,7 +164,54 @@ class PSFPhotometry(BasePhotometry):
 				params0 = res.x
 			else:
 				logger.warning("We should flag that this has not gone well.")
+				results.append((k, None))
 
+		return results
+
+	def do_photometry(self):
+		"""PSF Photometry"""
+
+		logger = logging.getLogger(__name__)
+
+		# Generate list of stars to fit:
+		cat = self.catalog
+
+		# Calculate distance from main target:
+		cat['dist'] = np.sqrt((self.target_pos_row_stamp - cat['row_stamp'])**2 + (self.target_pos_column_stamp - cat['column_stamp'])**2)
+
+		# Only include stars that are close to the main target and that are not much fainter:
+		cat = cat[(cat['dist'] < 5) & (self.target_tmag-cat['tmag'] > -5)]
+
+		# Sort the catalog by distance and include at max the five closest stars:
+		# FIXME: Make sure that the main target is in there!!!
+		cat.sort('dist')
+		if len(cat) > 5:
+			cat = cat[:5]
+
+		# Because the minimize routine used below only likes 1D numpy arrays
+		# we have to restructure the catalog:
+		params0 = np.empty((len(cat), 3), dtype='float64')
+		for k, target in enumerate(cat):
+			params0[k,:] = [target['row_stamp'], target['column_stamp'], mag2flux(target['tmag'])]
+		params_start = deepcopy(params0) # Save the starting parameters for later
+		params0 = params0.flatten() # Make the parameters into a 1D array
+
+		# Split the timeseries into chunks which are fitted in parallel, when
+		# we are allowed to use more than one core. Each chunk starts over from
+		# the catalog positions and fluxes. The images are loaded before
+		# splitting, so the forked processes all share the same data:
+		self.images_cube
+		self.backgrounds_cube
+		chunks = cadence_chunks(self.Ntimes, self.cadences_per_chunk)
+		results = fork_map(self._fit_cadences, [(params0, params_start, cadences) for cadences in chunks], processes=self.cores)
+
+		# Add the results of the main star to the lightcurve:
+		for k, result in itertools.chain.from_iterable(results):
+			if result is not None:
+				self.lightcurve['flux'][k] = result[0, 2]
+				self.lightcurve['pos_centroid'][k] = result[0, 0:2]
+				self.lightcurve['quality'][k] = 0
+			else:
 				self.lightcurve['flux'][k] = np.NaN
 				self.lightcurve['pos_centroid'][k] = [np.NaN, np.NaN]
 				self.lightcurve['quality'][k] = 1 # FIXME: Use the real flag!
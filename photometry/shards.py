@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+TODO-files split into shards by sector, camera and CCD.
+
+Instead of a single ``todo.sqlite``, the tasks can be kept in a set of smaller
+TODO-files (shards), one for each combination of sector, camera and CCD. All the
+targets which can affect each other (e.g. by marking each other as SKIPPED) are on
+the same CCD, so every change is made to a single shard. This spreads the writes
+over many files, and limits the damage if a file is corrupted.
+
+The shards are named ``todo_sector###_camera#_ccd#.sqlite`` and are created from an
+existing TODO-file using :py:func:`split_todo_file`. The :py:class:`ShardedTaskManager`
+works on a set of shards as if they were a single TODO-file, and :py:func:`merge_todo_files`
+combines the shards into a single TODO-file again for use downstream.
+"""
+
+from __future__ import division, with_statement, print_function, absolute_import
+import os
+import glob
+import sqlite3
+import logging
+import contextlib
+import random
+import signal
+import zlib
+from timeit import default_timer
+from . import STATUS
+from .taskmanager import TaskManager, TaskQueue, _cost_samples
+from .costmodel import CostModel
+
+#------------------------------------------------------------------------------
+#: Tables which are split into the shards and merged again.
+TABLES = ('todolist', 'diagnostics', 'photometry_skipped', 'skip_predictions')
+
+def shard_filename(sector, camera, ccd):
+	"""Filename of the shard of the TODO-file for the given sector, camera and CCD."""
+	return 'todo_sector{0:03d}_camera{1:d}_ccd{2:d}.sqlite'.format(sector, camera, ccd)
+
+def find_shards(folder):
+	"""
+	Find the shards of the TODO-file in a directory.
+
+	Parameters:
+		folder (string): Directory to search.
+
+	Returns:
+		list: Sorted list of paths to the shards.
+	"""
+	return sorted(glob.glob(os.path.join(folder, 'todo_sector*_camera*_ccd*.sqlite')))
+
+def open_task_manager(todo_file, **kwargs):
+	"""
+	Open the TaskManager for a TODO-file, or for the shards of a TODO-file.
+
+	If ``todo_file`` is a directory without a ``todo.sqlite`` but with shards,
+	a :py:class:`ShardedTaskManager` for the shards is returned.
+
+	Parameters:
+		todo_file (string): Path to the TODO-file, or the directory containing it.
+		**kwargs: Keyword-arguments passed on to the TaskManager.
+
+	Returns:
+		:py:class:`photometry.TaskManager`: TaskManager for the TODO-file.
+	"""
+	if os.path.isdir(todo_file) and not os.path.exists(os.path.join(todo_file, 'todo.sqlite')):
+		shards = find_shards(todo_file)
+		if shards:
+			return ShardedTaskManager(shards, **kwargs)
+	return TaskManager(todo_file, **kwargs)
+
+#------------------------------------------------------------------------------
+def _columns(cursor, table, schema='main'):
+	# Names of the columns in table:
+	cursor.execute("PRAGMA {0:s}.table_info({1:s});".format(schema, table))
+	return [row[1] for row in cursor.fetchall()]
+
+def split_todo_file(todo_file, output_folder=None, overwrite=False):
+	"""
+	Split TODO-file into shards for each sector, camera and CCD.
+
+	The tables with tasks, diagnostics and skipped targets are split between
+	the shards, including the results already in the TODO-file.
+
+	Parameters:
+		todo_file (string): Path to the TODO-file.
+		output_folder (string, optional): Directory to put the shards in. Default is
+			the directory of the TODO-file.
+		overwrite (boolean): Overwrite existing shards. Default=False.
+
+	Returns:
+		list: Paths to the created shards.
+
+	Raises:
+		IOError: If the TODO-file could not be found, or a shard already exists and ``overwrite`` is not enabled.
+	"""
+	logger = logging.getLogger(__name__)
+
+	if not os.path.isfile(todo_file):
+		raise IOError("Could not find TODO-file")
+	if output_folder is None:
+		output_folder = os.path.dirname(os.path.abspath(todo_file))
+
+	with contextlib.closing(sqlite3.connect(todo_file)) as conn:
+		cursor = conn.cursor()
+		cursor.execute("SELECT DISTINCT sector,camera,ccd FROM todolist ORDER BY sector,camera,ccd;")
+		keys = cursor.fetchall()
+		cursor.execute("SELECT type,tbl_name,sql FROM sqlite_master WHERE sql IS NOT NULL AND tbl_name IN (" + ','.join(['?']*len(TABLES)) + ");", TABLES)
+		schema = cursor.fetchall()
+		cursor.close()
+
+	tables = [tbl_name for typ, tbl_name, sql in schema if typ == 'table']
+	shard_files = []
+	for sector, camera, ccd in keys:
+		shard_file = os.path.join(output_folder, shard_filename(sector, camera, ccd))
+		if os.path.exists(shard_file):
+			if not overwrite:
+				raise IOError("Shard already exists: '%s'" % shard_file)
+			os.remove(shard_file)
+
+		logger.info("Creating shard for SECTOR=%d, CAMERA=%d, CCD=%d", sector, camera, ccd)
+		with contextlib.closing(sqlite3.connect(shard_file)) as conn:
+			cursor = conn.cursor()
+			cursor.execute("ATTACH DATABASE ? AS src;", (todo_file, ))
+			for typ, tbl_name, sql in schema:
+				if typ == 'table':
+					cursor.execute(sql)
+
+			cursor.execute("INSERT INTO todolist SELECT * FROM src.todolist WHERE sector=? AND camera=? AND ccd=?;", (sector, camera, ccd))
+			for table in tables:
+				if table != 'todolist':
+					cursor.execute("INSERT INTO {0:s} SELECT * FROM src.{0:s} WHERE priority IN (SELECT priority FROM todolist);".format(table))
+			conn.commit()
+
+			for typ, tbl_name, sql in schema:
+				if typ == 'index':
+					cursor.execute(sql)
+			conn.commit()
+			cursor.execute("DETACH DATABASE src;")
+			cursor.close()
+		shard_files.append(shard_file)
+
+	return shard_files
+
+def merge_todo_files(shard_files, output_file, overwrite=False):
+	"""
+	Merge shards into a single TODO-file.
+
+	The tables with tasks, diagnostics and skipped targets from all the shards are
+	combined into a single compacted TODO-file for use downstream. Only the columns
+	present in the first shard containing a table are kept.
+
+	Parameters:
+		shard_files (list): Paths to the shards.
+		output_file (string): Path to the merged TODO-file.
+		overwrite (boolean): Overwrite existing output file. Default=False.
+
+	Raises:
+		IOError: If the output file already exists and ``overwrite`` is not enabled.
+		ValueError: If the same task (priority) is found in more than one shard.
+	"""
+	logger = logging.getLogger(__name__)
+
+	if os.path.exists(output_file):
+		if not overwrite:
+			raise IOError("Output file already exists")
+		os.remove(output_file)
+
+	indices = []
+	with contextlib.closing(sqlite3.connect(output_file)) as conn:
+		cursor = conn.cursor()
+		created = {}
+		for shard_file in shard_files:
+			logger.info("Merging '%s'", shard_file)
+			cursor.execute("ATTACH DATABASE ? AS shard;", (shard_file, ))
+			cursor.execute("SELECT type,name,tbl_name,sql FROM shard.sqlite_master WHERE sql IS NOT NULL AND tbl_name IN (" + ','.join(['?']*len(TABLES)) + ");", TABLES)
+			for typ, name, tbl_name, sql in cursor.fetchall():
+				if typ == 'table' and tbl_name not in created:
+					cursor.execute(sql)
+					created[tbl_name] = _columns(cursor, tbl_name)
+				elif typ == 'index' and name not in [i[0] for i in indices]:
+					indices.append((name, sql))
+
+			for table, columns in created.items():
+				shard_columns = _columns(cursor, table, schema='shard')
+				if not shard_columns:
+					continue
+				columns = ','.join([c for c in columns if c in shard_columns])
+				try:
+					cursor.execute("INSERT INTO main.{0:s} ({1:s}) SELECT {1:s} FROM shard.{0:s};".format(table, columns))
+				except sqlite3.IntegrityError:
+					raise ValueError("Shard '%s' contains tasks already found in another shard" % shard_file)
+			conn.commit()
+			cursor.execute("DETACH DATABASE shard;")
+
+		cursor.execute("SELECT priority FROM todolist GROUP BY priority HAVING COUNT(*) > 1 LIMIT 1;")
+		row = cursor.fetchone()
+		if row is not None:
+			raise ValueError("Task with priority %d found in more than one shard" % row[0])
+
+		for name, sql in indices:
+			cursor.execute(sql)
+		conn.commit()
+
+		# Compact the merged file:
+		cursor.execute("PRAGMA page_size=4096;")
+		conn.isolation_level = None
+		cursor.execute("VACUUM;")
+		cursor.close()
+
+#------------------------------------------------------------------------------
+class ShardedTaskManager(TaskManager):
+	"""
+	TaskManager working on a set of shards of the TODO-file as if they were a single TODO-file.
+
+	Each shard is handled by its own :py:class:`photometry.TaskManager`, and every task or
+	result is routed to the shard it belongs to. With ``in_memory_queue``, all the shards
+	share a single :py:class:`photometry.taskmanager.TaskQueue`, so tasks are handed out
+	in the same order as from a single TODO-file.
+	"""
+
+	def __init__(self, shard_files, summary=None, summary_interval=100, in_memory_queue=False,
+		order='priority', cost_model=None, **kwargs):
+		"""
+		Open all the shards of the TODO-file.
+
+		Parameters:
+			shard_files (list): Paths to the shards.
+			summary (string): Path to file where to periodically write a progress summary. Default=None.
+			summary_interval (int): Interval at which to write summary file. Default=100.
+			in_memory_queue (boolean): Serve tasks from an in-memory queue shared by all shards. Default=False.
+			order (string): Order in which tasks are handed out from the in-memory queue. Default='priority'.
+			cost_model (:py:class:`CostModel`): Model of the expected run time of tasks. If not provided
+				with ``in_memory_queue``, the model is fitted to the diagnostics in all the shards.
+			**kwargs: Other keyword-arguments are passed on to the :py:class:`photometry.TaskManager` of each shard.
+
+		Raises:
+			IOError: If no shards are given, or a shard could not be found.
+		"""
+		if not shard_files:
+			raise IOError('Could not find any shards of TODO-file')
+
+		self.summary_file = summary
+		self.summary_interval = summary_interval
+		self.write_behind = kwargs.get('write_behind', False)
+		self.shared = kwargs.get('shared', False)
+		self._busy = False
+		self._pending_signal = None
+		self._old_sigterm = None
+
+		# Fit a single model of the run time to all the shards,
+		# so the order of tasks from different shards is consistent:
+		self.cost_model = None
+		if in_memory_queue:
+			self.cost_model = cost_model
+			if self.cost_model is None:
+				samples = []
+				for shard_file in shard_files:
+					if not os.path.exists(shard_file):
+						raise IOError("Could not find shard '%s'" % shard_file)
+					with contextlib.closing(sqlite3.connect(shard_file)) as conn:
+						conn.row_factory = sqlite3.Row
+						samples += _cost_samples(conn.cursor())
+				self.cost_model = CostModel().fit(samples)
+
+		self.shards = []
+		try:
+			for shard_file in shard_files:
+				self.shards.append(TaskManager(shard_file, in_memory_queue=in_memory_queue, order=order, cost_model=self.cost_model, **kwargs))
+		except:
+			for shard in self.shards:
+				shard.close()
+			raise
+
+		self.logger = self.shards[0].logger
+		self.predicted_skips = self.shards[0].predicted_skips
+		self.worker_id = self.shards[0].worker_id
+
+		# Route tasks to shards by their sector, camera and CCD, or by priority
+		# for the tasks which are waiting to be processed:
+		self._partitions = {}
+		self._routes = {}
+		for shard in self.shards:
+			shard.cursor.execute("SELECT DISTINCT sector,camera,ccd FROM todolist;")
+			for row in shard.cursor.fetchall():
+				self._partitions[tuple(row)] = shard
+			shard.cursor.execute("SELECT priority FROM todolist WHERE status IS NULL;")
+			for row in shard.cursor.fetchall():
+				self._routes[row['priority']] = shard
+
+		# Let all the shards share a single queue:
+		self.queue = None
+		if in_memory_queue:
+			tasks = []
+			for shard in self.shards:
+				tasks += shard.queue.tasks()
+			self.queue = TaskQueue(tasks, cost=self.cost_model.predict, largest_first=(order == 'cost'))
+			for shard in self.shards:
+				shard.queue = self.queue
+			self.logger.info("Loaded %d tasks from %d shards into memory", len(self.queue), len(self.shards))
+
+		# Keep track of run time of tasks, for estimating the remaining time:
+		self._run_start = default_timer()
+		self._run_elaptime = 0.0
+		self._run_predicted = 0.0
+
+		# Prepare summary object:
+		self.summary = {
+			'slurm_jobid': os.environ.get('SLURM_JOB_ID', None),
+			'numtasks': 0,
+			'tasks_run': 0,
+			'last_error': None,
+			'eta': None
+		}
+		for s in STATUS: self.summary[s.name] = 0
+		if self.summary_file:
+			for shard in self.shards:
+				shard.cursor.execute("SELECT status,COUNT(*) AS cnt FROM todolist GROUP BY status;")
+				for row in shard.cursor.fetchall():
+					self.summary['numtasks'] += row['cnt']
+					if row['status'] is not None:
+						self.summary[STATUS(row['status']).name] += row['cnt']
+			self.write_summary()
+
+		# Handle SIGTERM here instead of in each shard, so a signal never
+		# interrupts a change to one shard while another shard is flushed:
+		if self.write_behind:
+			self._old_sigterm = self.shards[0]._old_sigterm
+			for shard in self.shards:
+				shard._old_sigterm = None
+			if self._old_sigterm is not None:
+				signal.signal(signal.SIGTERM, self._signal_handler)
+
+	def _call(self, shard, method, *args):
+		"""Call method of the TaskManager of a shard, and update the summary with the changes."""
+		counters = ['tasks_run'] + [s.name for s in STATUS]
+		before = [shard.summary[key] for key in counters]
+		last_error = shard.summary['last_error']
+
+		self._busy = True
+		try:
+			value = getattr(shard, method)(*args)
+		finally:
+			self._busy = False
+
+		for key, value_before in zip(counters, before):
+			self.summary[key] += shard.summary[key] - value_before
+		if shard.summary['last_error'] != last_error:
+			self.summary['last_error'] = shard.summary['last_error']
+
+		# If a signal was received while changes were being made, handle it now:
+		if self._pending_signal is not None:
+			signum, self._pending_signal = self._pending_signal, None
+			self._signal_handler(signum, None)
+		return value
+
+	def _waiting_cost(self):
+		"""Expected cost of the tasks waiting in the shared queue or deferred in any of the shards."""
+		return max(self.queue.total_cost, 0) + sum([max(shard._deferred_cost, 0) for shard in self.shards])
+
+	def _running_tasks(self):
+		"""Expected cost and start time of the tasks currently running in all the shards."""
+		return [running for shard in self.shards for running in shard._running.values()]
+
+	def _shard(self, priority):
+		"""Find the shard containing the task with the given priority."""
+		shard = self._routes.get(priority)
+		if shard is None:
+			for shard in self.shards:
+				shard.cursor.execute("SELECT priority FROM todolist WHERE priority=?;", (priority, ))
+				if shard.cursor.fetchone():
+					self._routes[priority] = shard
+					break
+			else:
+				raise KeyError("Task %d not found in any shard" % priority)
+		return shard
+
+	def flush(self):
+		"""Commit all buffered changes to all shards."""
+		for shard in self.shards:
+			shard.flush()
+
+	def close(self):
+		"""Close all shards."""
+		if self._old_sigterm is not None:
+			signal.signal(signal.SIGTERM, self._old_sigterm)
+			self._old_sigterm = None
+		for shard in reversed(self.shards):
+			shard.close()
+		self.write_summary()
+
+	def get_number_tasks(self):
+		"""
+		Get number of tasks due to be processed.
+
+		Returns:
+			int: Number of tasks due to be processed.
+		"""
+		if self.queue is not None:
+			return len(self.queue) + sum(shard._num_deferred for shard in self.shards)
+		return sum(shard.get_number_tasks() for shard in self.shards)
+
+	def get_task(self, starid=None):
+		"""
+		Get next task to be processed.
+
+		Parameters:
+			starid (integer, optional): Only return task for this target.
+
+		Returns:
+			dict or None: Dictionary of settings for task.
+		"""
+		if self.queue is not None and starid is None:
+			return self.queue.peek()
+
+		task = None
+		for shard in self.shards:
+			candidate = shard.get_task(starid=starid)
+			if candidate is not None and (task is None or candidate['priority'] < task['priority']):
+				task = candidate
+		if task is not None:
+			self._routes[task['priority']] = self._partitions[TaskQueue.partition(task)]
+		return task
+
+	def get_random_task(self):
+		"""
+		Get random task to be processed.
+
+		Returns:
+			dict or None: Dictionary of settings for task.
+		"""
+		shards = list(self.shards)
+		random.shuffle(shards)
+		for shard in shards:
+			task = shard.get_random_task()
+			if task is not None:
+				self._routes[task['priority']] = shard
+				return task
+		return None
+
+	def save_result(self, result):
+		"""
+		Save results and diagnostics in the shard of the task.
+
+		Parameters:
+			results (dict): Dictionary of results and diagnostics.
+
+		Returns:
+			boolean: ``True`` if the result was saved, ``False`` if it was discarded because
+				the task had been claimed by another process.
+		"""
+		shard = self._partitions[TaskQueue.partition(result)]
+		tasks_run = self.summary['tasks_run']
+		stored = self._call(shard, 'save_result', result)
+		saved = self.summary['tasks_run'] - tasks_run
+		self._routes.pop(result['priority'], None)
+		if not stored:
+			return False
+		if self.cost_model is not None:
+			self._update_eta(result)
+
+		# Write summary file:
+		# The number of tasks run can jump past the interval when secondary targets
+		# are saved along with the task:
+		if self.summary_file and self.summary['tasks_run'] % self.summary_interval < saved:
+			self.write_summary()
+		return True
+
+	def start_task(self, taskid):
+		"""
+		Mark a task as STARTED in the TODO-list.
+		"""
+		self._call(self._shard(taskid), 'start_task', taskid)
+
+	def claim_task(self, lease=3600.0):
+		"""
+		Claim the next task to be processed in shared shards.
+
+		Each worker starts looking for tasks in its own shard, chosen from the worker
+		identifier, and moves on to the next shards when it runs out. This way the
+		workers are spread out over the shards, and rarely wait for each other.
+
+		Parameters:
+			lease (float): Number of seconds before the claim expires. Default=3600.
+
+		Returns:
+			dict or None: Dictionary of settings for task, or ``None`` if no tasks are waiting.
+
+		Raises:
+			RuntimeError: If the TaskManager was not opened with ``shared`` enabled.
+		"""
+		start = zlib.crc32(self.worker_id.encode('utf-8')) % len(self.shards)
+		for k in range(len(self.shards)):
+			shard = self.shards[(start + k) % len(self.shards)]
+			task = self._call(shard, 'claim_task', lease)
+			if task is not None:
+				self._routes[task['priority']] = shard
+				return task
+		return None
+
+	def renew_claim(self, taskid, lease=3600.0):
+		"""
+		Extend the claim on a task in the shared shards.
+
+		Parameters:
+			taskid (int): Priority of the task.
+			lease (float): Number of seconds from now before the claim expires. Default=3600.
+
+		Returns:
+			boolean: ``True`` if the claim was renewed, ``False`` if the task is no longer
+				claimed by this process.
+		"""
+		return self._call(self._shard(taskid), 'renew_claim', taskid, lease)
+
+	def requeue_task(self, taskid):
+		"""
+		Put a task which was marked as STARTED, but never processed, back into the TODO-list.
+
+		Parameters:
+			taskid (int): Priority of the task.
+		"""
+		self._call(self._shard(taskid), 'requeue_task', taskid)
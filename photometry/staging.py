@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Staging of input files onto storage local to each node.
+
+The photometry reads the HDF5 file and catalog of the CCD a target is on with
+random access to many small chunks, which is slow on a shared filesystem when
+many processes do it at once. Instead the files of each CCD can be copied once
+per node to local scratch or tmpfs, using :py:func:`stage_files`, and loaded from
+there by giving the folder as ``stage_folder`` to the photometry classes.
+Once all the tasks of a CCD are done, the copies are removed again with
+:py:func:`evict_files`.
+"""
+
+from __future__ import division, with_statement, print_function, absolute_import
+import os
+import shutil
+import logging
+import contextlib
+from .utilities import find_hdf5_files, find_catalog_files
+
+try:
+	import fcntl
+except ImportError: # pragma: no cover
+	fcntl = None
+
+#------------------------------------------------------------------------------
+def staging_folder(folder):
+	"""
+	Staging folder for this node.
+
+	Environment variables in the path are expanded on each node, so the path can
+	point to storage which is different on each node, e.g. ``$TMPDIR/tessphot``.
+
+	Parameters:
+		folder (string or None): Path of the staging folder.
+
+	Returns:
+		string or None: Path with environment variables expanded, or ``None`` if ``folder`` is ``None``.
+	"""
+	if folder is None:
+		return None
+	return os.path.abspath(os.path.expanduser(os.path.expandvars(folder)))
+
+#------------------------------------------------------------------------------
+@contextlib.contextmanager
+def _lock(stage_folder, sector, camera, ccd):
+	# Lock shared by all processes on the node handling the files of this CCD,
+	# so the files are only copied once, and never removed while being copied:
+	lockfile = os.path.join(stage_folder, '.lock_sector{0:03d}_camera{1:d}_ccd{2:d}'.format(sector, camera, ccd))
+	with open(lockfile, 'a') as fid:
+		if fcntl is not None:
+			fcntl.flock(fid, fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			if fcntl is not None:
+				fcntl.flock(fid, fcntl.LOCK_UN)
+
+#------------------------------------------------------------------------------
+def stage_files(input_folder, stage_folder, sector, camera, ccd):
+	"""
+	Copy the HDF5 file and catalog of a CCD to the staging folder.
+
+	Files which have already been staged, and have not changed since, are not
+	copied again. If several processes on the same node stage the same CCD at the
+	same time, one of them copies the files while the others wait for it to finish.
+
+	Parameters:
+		input_folder (string): Input folder containing the original files.
+		stage_folder (string): Folder on local storage to copy the files to.
+		sector (integer): TESS observing sector.
+		camera (integer): TESS camera (1-4).
+		ccd (integer): TESS CCD (1-4).
+
+	Returns:
+		list: Paths to the staged files.
+	"""
+	logger = logging.getLogger(__name__)
+
+	if not os.path.exists(stage_folder):
+		try:
+			os.makedirs(stage_folder)
+		except OSError:
+			# Could have been created by another process in the meantime:
+			if not os.path.isdir(stage_folder):
+				raise
+
+	files = find_hdf5_files(input_folder, sector=sector, camera=camera, ccd=ccd) \
+		+ find_catalog_files(input_folder, sector=sector, camera=camera, ccd=ccd)
+
+	staged = []
+	with _lock(stage_folder, sector, camera, ccd):
+		for fpath in files:
+			destination = os.path.join(stage_folder, os.path.basename(fpath))
+			stat = os.stat(fpath)
+			if not os.path.exists(destination) or os.path.getsize(destination) != stat.st_size \
+				or int(os.path.getmtime(destination)) != int(stat.st_mtime):
+				logger.info("Staging '%s' to '%s'", fpath, stage_folder)
+				# Copy to a temporary file first, so an interrupted copy is never used:
+				tmpfile = destination + '.tmp{0:d}'.format(os.getpid())
+				shutil.copy2(fpath, tmpfile)
+				os.rename(tmpfile, destination)
+			staged.append(destination)
+
+	return staged
+
+#------------------------------------------------------------------------------
+def evict_files(stage_folder, sector, camera, ccd):
+	"""
+	Remove the staged HDF5 file and catalog of a CCD from the staging folder.
+
+	Parameters:
+		stage_folder (string): Folder on local storage containing the staged files.
+		sector (integer): TESS observing sector.
+		camera (integer): TESS camera (1-4).
+		ccd (integer): TESS CCD (1-4).
+
+	Returns:
+		list: Paths to the removed files.
+	"""
+	logger = logging.getLogger(__name__)
+
+	if not os.path.isdir(stage_folder):
+		return []
+
+	with _lock(stage_folder, sector, camera, ccd):
+		files = find_hdf5_files(stage_folder, sector=sector, camera=camera, ccd=ccd) \
+			+ find_catalog_files(stage_folder, sector=sector, camera=camera, ccd=ccd)
+		for fpath in files:
+			logger.info("Removing staged file '%s'", fpath)
+			os.remove(fpath)
+
+	return files
@@ -12,14 +12,261 @@ import os
 import sqlite3
 import logging
 import json
+import signal
+import socket
+import time
+import heapq
+import threading
+from timeit import default_timer
 from . import STATUS
+from .costmodel import CostModel
 
+class TaskQueue(object):
+	"""
+	In-memory priority queue of tasks waiting to be processed.
+
+	The tasks are kept in separate heaps for each combination of sector, camera and CCD,
+	which allows the next task to be found both globally and for a given CCD.
+	Tasks are ordered by priority, or optionally by decreasing expected cost.
+	Tasks are removed lazily, meaning that removing a task is a constant-time operation.
+	All methods are thread-safe.
+	"""
+
+	fields = ('priority', 'starid', 'method', 'sector', 'camera', 'ccd', 'datasource', 'tmag')
+
+	def __init__(self, tasks=[], cost=None, largest_first=False):
+		"""
+		Initialize queue of tasks.
+
+		Parameters:
+			tasks (iterable): Tasks to put in the queue. Each task should be a dictionary
+				(or :py:class:`sqlite3.Row`) containing at least the keys in :py:attr:`fields`.
+			cost (callable, optional): Function returning the expected cost of a task.
+				If provided, the total expected cost of the tasks in the queue is available
+				in :py:attr:`total_cost`.
+			largest_first (boolean, optional): Order tasks by decreasing expected cost
+				instead of by priority. Requires ``cost`` to be provided. Default=False.
+
+		Raises:
+			ValueError: If ``largest_first`` is enabled without a ``cost``.
+		"""
+		if largest_first and cost is None:
+			raise ValueError("Ordering by largest cost first requires a cost function")
+
+		self.cost = cost
+		self.largest_first = largest_first
+		self.total_cost = 0.0
+		self._lock = threading.RLock()
+		self._heaps = {}
+		self._entries = {}
+		self._starids = {}
+		for task in tasks:
+			item = self._add(task)
+			self._heaps.setdefault(self.partition(task), []).append(item)
+		for heap in self._heaps.values():
+			heapq.heapify(heap)
+
+	def __len__(self):
+		return len(self._entries)
+
+	def __contains__(self, priority):
+		return priority in self._entries
+
+	def _add(self, task):
+		# Register task as waiting, and return its item for the heaps.
+		# The expected cost of the task is stored as the last element of the entry:
+		entry = tuple([task[key] for key in self.fields])
+		cost = 0.0 if self.cost is None else float(self.cost(dict(zip(self.fields, entry))))
+		entry += (cost, )
+		self._entries[entry[0]] = entry
+		self._starids.setdefault(entry[1], set()).add(entry[0])
+		self.total_cost += cost
+		key = (-cost, entry[0]) if self.largest_first else entry[0]
+		return (key, entry)
+
+	@staticmethod
+	def partition(task):
+		"""Partition (sector, camera, ccd) a task belongs to."""
+		return (task['sector'], task['camera'], task['ccd'])
+
+	def partitions(self):
+		"""
+		Partitions which still have tasks waiting.
+
+		Returns:
+			list: List of (sector, camera, ccd) tuples.
+		"""
+		with self._lock:
+			return [key for key in self._heaps if self._head(key) is not None]
+
+	def _head(self, key):
+		# Get the first item in the heap of a single partition,
+		# cleaning out entries which have been removed along the way:
+		heap = self._heaps.get(key)
+		if not heap:
+			return None
+		while heap and self._entries.get(heap[0][1][0]) is not heap[0][1]:
+			heapq.heappop(heap)
+		return heap[0] if heap else None
+
+	def peek(self, partition=None):
+		"""
+		Get the next task in the queue without removing it.
+
+		Parameters:
+			partition (tuple, optional): Only consider tasks from this (sector, camera, ccd).
+
+		Returns:
+			dict or None: Task with the lowest priority value, or ``None`` if no tasks are waiting.
+		"""
+		with self._lock:
+			if partition is not None:
+				item = self._head(partition)
+			else:
+				item = None
+				for key in list(self._heaps.keys()):
+					head = self._head(key)
+					if head is None:
+						del self._heaps[key]
+					elif item is None or head[0] < item[0]:
+						item = head
+		if item is None:
+			return None
+		return dict(zip(self.fields, item[1]))
+
+	def find(self, starids, datasource, sector):
+		"""
+		Find waiting tasks for the given targets.
+
+		Parameters:
+			starids (iterable): TIC identifiers of targets.
+			datasource (string): Datasource of tasks.
+			sector (int): Sector of tasks.
+
+		Returns:
+			list: List of tasks for the targets which are still in the queue.
+		"""
+		tasks = []
+		with self._lock:
+			for starid in set(starids):
+				for priority in self._starids.get(starid, ()):
+					entry = self._entries.get(priority)
+					if entry is not None and entry[6] == datasource and entry[3] == sector:
+						tasks.append(dict(zip(self.fields, entry)))
+		return tasks
+
+	def tasks(self):
+		"""
+		All tasks waiting in the queue, in no particular order.
+
+		Returns:
+			list: List of tasks.
+		"""
+		with self._lock:
+			return [dict(zip(self.fields, entry)) for entry in self._entries.values()]
+
+	def push(self, task):
+		"""
+		Add task to the queue.
+
+		Parameters:
+			task (dict): Task to add to the queue.
+		"""
+		with self._lock:
+			item = self._add(task)
+			heapq.heappush(self._heaps.setdefault(self.partition(task), []), item)
+
+	def remove(self, priority):
+		"""
+		Remove task from the queue.
+
+		Parameters:
+			priority (int): Priority of the task to remove. Removing a task
+				which is not in the queue is not an error.
+		"""
+		with self._lock:
+			entry = self._entries.pop(priority, None)
+			if entry is not None:
+				self._starids[entry[1]].discard(priority)
+				self.total_cost = self.total_cost - entry[-1] if self._entries else 0.0
+
+	def pop(self, partition=None, accept=None, search=100):
+		"""
+		Remove and return the next task in the queue.
+
+		Parameters:
+			partition (tuple, optional): Only consider tasks from this (sector, camera, ccd).
+			accept (callable, optional): Only return a task for which this function returns True.
+				The tasks are considered in the order of the queue.
+			search (int, optional): When using ``accept``, the maximum number of tasks from the
+				front of the queue to consider. Default=100.
+
+		Returns:
+			dict or None: Task with the lowest priority value, or ``None`` if no tasks are waiting.
+		"""
+		with self._lock:
+			if accept is None:
+				task = self.peek(partition)
+				if task is not None:
+					self.remove(task['priority'])
+				return task
+
+			# Take tasks from the front of the queue until one is accepted,
+			# and put the rest back afterwards:
+			task = None
+			rejected = []
+			for k in range(search):
+				candidate = self.peek(partition)
+				if candidate is None:
+					break
+				entry = self._entries[candidate['priority']]
+				self.remove(candidate['priority'])
+				if accept(candidate):
+					task = candidate
+					break
+				rejected.append(entry)
+			for entry in rejected:
+				self._restore(entry)
+		return task
+
+	def _restore(self, entry):
+		# Put a removed entry back into the queue, keeping its expected cost:
+		self._entries[entry[0]] = entry
+		self._starids.setdefault(entry[1], set()).add(entry[0])
+		self.total_cost += entry[-1]
+		key = (-entry[-1], entry[0]) if self.largest_first else entry[0]
+		task = dict(zip(self.fields, entry))
+		heapq.heappush(self._heaps.setdefault(self.partition(task), []), (key, entry))
+
+#------------------------------------------------------------------------------
+def _cost_samples(cursor):
+	"""
+	Load the run times of the successful tasks in a TODO-file, for fitting a :py:class:`CostModel`.
+
+	Parameters:
+		cursor (:py:class:`sqlite3.Cursor`): Cursor of the TODO-file, returning rows as :py:class:`sqlite3.Row`.
+
+	Returns:
+		list: Rows with the method, datasource, tmag, elaptime, stamp_width and stamp_height of the tasks.
+	"""
+	cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='diagnostics';")
+	if not cursor.fetchone():
+		return []
+	cursor.execute("SELECT todolist.method,todolist.datasource,todolist.tmag,diagnostics.elaptime,diagnostics.stamp_width,diagnostics.stamp_height FROM diagnostics INNER JOIN todolist ON todolist.priority=diagnostics.priority WHERE todolist.status IN (?,?);", (
+		STATUS.OK.value,
+		STATUS.WARNING.value
+	))
+	return cursor.fetchall()
+
+#------------------------------------------------------------------------------
 class TaskManager(object):
 	"""
 	A TaskManager which keeps track of which targets to process.
 	"""
 
-	def __init__(self, todo_file, cleanup=False, overwrite=False, summary=None, summary_interval=100):
+	def __init__(self, todo_file, cleanup=False, overwrite=False, summary=None, summary_interval=100,
+		write_behind=False, commit_interval=100, commit_timeout=10.0, in_memory_queue=False,
+		order='priority', cost_model=None, predicted_skips=None, shared=False, worker_id=None):
 		"""
 		Initialize the TaskManager which keeps track of which targets to process.
 
@@ -30,14 +277,66 @@ class TaskManager(object):
 			overwrite (boolean): Restart calculation from the beginning, discarding any previous results. Default=False.
 			summary (string): Path to file where to periodically write a progress summary. The output file will be in JSON format. Default=None.
 			summary_interval (int): Interval at which to write summary file. Setting this to 1 will mean writing the file after every tasks completes. Default=100.
+			write_behind (boolean): Buffer changes to the TODO-file and only commit them in batches,
+				instead of after every change. The TODO-file is put in WAL journal mode. Buffered changes
+				are written when calling :py:meth:`flush`, when closing the TaskManager and if the process
+				receives a SIGTERM signal. Default=False.
+			commit_interval (int): When ``write_behind`` is enabled, commit after this number of results
+				have been saved. Default=100.
+			commit_timeout (float): When ``write_behind`` is enabled, commit if this number of seconds has
+				passed since the last commit. Default=10.
+			in_memory_queue (boolean): Load all tasks waiting to be processed into an in-memory
+				:py:class:`TaskQueue` at startup, and serve :py:meth:`get_task` from it instead of
+				querying the TODO-file every time. Default=False.
+			order (string): Order in which tasks are handed out from the in-memory queue.
+				Either ``'priority'`` or ``'cost'``, where the latter hands out the tasks
+				with the largest expected run time first. Default='priority'.
+			cost_model (:py:class:`CostModel`): Model of the expected run time of tasks,
+				used for ordering tasks and estimating the remaining run time in the summary.
+				If not provided, the model is fitted to diagnostics already in the TODO-file,
+				from before it is cleared by ``overwrite``. Only used with ``in_memory_queue``.
+			predicted_skips (string): How to use the predictions of which targets are going to be
+				marked as SKIPPED by a brighter target (see :py:func:`photometry.todolist.predict_skipped_targets`).
+				With ``'defer'`` these targets are not handed out until the brighter target is finished,
+				and with ``'skip'`` they are marked as SKIPPED up front. In both cases, the targets are
+				processed anyway if the brighter target turns out not to skip them. Default=None.
+			shared (boolean): The TODO-file is shared with other processes running at the same time,
+				which take tasks using :py:meth:`claim_task`. Tasks claimed by other processes are
+				not reset, and all changes are made in transactions which wait for the other processes.
+				Can not be combined with ``cleanup``, ``overwrite``, ``write_behind`` or ``in_memory_queue``.
+				Default=False.
+			worker_id (string): Identifier of this process, used for claiming tasks in a shared TODO-file.
+				Tasks still claimed by a previous process with the same identifier are reset at startup.
+				Default is the hostname and process ID.
 
 		Raises:
 			IOError: If TODO-file could not be found.
+			ValueError: If ``order`` or ``predicted_skips`` is invalid, ``'cost'`` is used without ``in_memory_queue``
+				or ``shared`` is combined with an option which is not allowed.
 		"""
 
+		if order not in ('priority', 'cost'):
+			raise ValueError("Invalid order: '%s'" % order)
+		if order == 'cost' and not in_memory_queue:
+			raise ValueError("Ordering tasks by cost requires the in-memory queue")
+		if predicted_skips not in (None, 'defer', 'skip'):
+			raise ValueError("Invalid predicted_skips: '%s'" % predicted_skips)
+		if shared and (cleanup or overwrite or write_behind or in_memory_queue):
+			raise ValueError("A shared TODO-file can not be used with cleanup, overwrite, write_behind or in_memory_queue")
+
 		self.overwrite = overwrite
 		self.summary_file = summary
 		self.summary_interval = summary_interval
+		self.write_behind = write_behind
+		self.commit_interval = commit_interval
+		self.commit_timeout = commit_timeout
+		self._uncommitted = 0
+		self._last_commit = default_timer()
+		self._busy = False
+		self._pending_signal = None
+		self._old_sigterm = None
+		self.shared = shared
+		self.worker_id = worker_id if worker_id else '%s:%d' % (socket.gethostname(), os.getpid())
 
 		if os.path.isdir(todo_file):
 			todo_file = os.path.join(todo_file, 'todo.sqlite')
@@ -46,18 +345,38 @@ class TaskManager(object):
 			raise IOError('Could not find TODO-file')
 
 		# Setup logging:
-		formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-		console = logging.StreamHandler()
-		console.setFormatter(formatter)
+		# Only add the handler once, since several TaskManagers may be opened in the same process:
 		self.logger = logging.getLogger(__name__)
-		self.logger.addHandler(console)
+		if not self.logger.handlers:
+			formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+			console = logging.StreamHandler()
+			console.setFormatter(formatter)
+			self.logger.addHandler(console)
 		self.logger.setLevel(logging.INFO)
 
 		# Load the SQLite file:
-		self.conn = sqlite3.connect(todo_file)
+		# When sharing the TODO-file, wait for a long time for other processes to finish their changes:
+		# The claims on tasks may be renewed from another thread while the task is processed
+		# (see :py:meth:`renew_claim`), so the connection can not be tied to a single thread:
+		self.conn = sqlite3.connect(todo_file, timeout=60.0 if self.shared else 5.0, check_same_thread=not self.shared)
 		self.conn.row_factory = sqlite3.Row
 		self.cursor = self.conn.cursor()
 
+		# When changes are written in batches, use the write-ahead log,
+		# which makes each commit a lot cheaper:
+		if self.write_behind:
+			self.cursor.execute("PRAGMA journal_mode=WAL;")
+			self.cursor.execute("PRAGMA synchronous=NORMAL;")
+
+		# Fit model of the run time of tasks to previous results,
+		# before they are potentially deleted below:
+		self.cost_model = None
+		if in_memory_queue:
+			self.cost_model = cost_model
+			if self.cost_model is None:
+				self.cost_model = CostModel()
+				self.cost_model.fit(_cost_samples(self.cursor))
+
 		# Reset the status of everything for a new run:
 		if overwrite:
 			self.cursor.execute("UPDATE todolist SET status=NULL;")
@@ -94,19 +413,83 @@ class TaskManager(object):
 		);""") # PRIMARY KEY
 		self.conn.commit()
 
-		# Reset calculations with status STARTED or ABORT:
-		clear_status = str(STATUS.STARTED.value) + ',' + str(STATUS.ABORT.value)
-		self.cursor.execute("DELETE FROM diagnostics WHERE priority IN (SELECT todolist.priority FROM todolist WHERE status IN (" + clear_status + "));")
-		self.cursor.execute("DELETE FROM photometry_skipped WHERE priority IN (SELECT todolist.priority FROM todolist WHERE status IN (" + clear_status + "));")
-		self.cursor.execute("UPDATE todolist SET status=NULL WHERE status IN (" + clear_status + ");")
+		# Reset calculations with status STARTED or ABORT.
+		# When the TODO-file is shared, tasks claimed by other running processes are left alone,
+		# but tasks claimed by a previous process with the same identifier are reset:
+		clear_status = "status IN (" + str(STATUS.STARTED.value) + ',' + str(STATUS.ABORT.value) + ")"
+		if self.shared:
+			self.cursor.execute("""CREATE TABLE IF NOT EXISTS claims (
+				priority INT PRIMARY KEY NOT NULL,
+				worker TEXT NOT NULL,
+				expires REAL NOT NULL,
+				FOREIGN KEY (priority) REFERENCES todolist(priority) ON DELETE CASCADE ON UPDATE CASCADE
+			);""")
+			self.conn.commit()
+			self._begin()
+			self.cursor.execute("DELETE FROM claims WHERE worker=?;", (self.worker_id, ))
+			clear_status = "(status=" + str(STATUS.ABORT.value) + " OR (status=" + str(STATUS.STARTED.value) + " AND priority NOT IN (SELECT priority FROM claims)))"
+		else:
+			self.cursor.execute("DROP TABLE IF EXISTS claims;")
+		self.cursor.execute("DELETE FROM diagnostics WHERE priority IN (SELECT todolist.priority FROM todolist WHERE " + clear_status + ");")
+		self.cursor.execute("DELETE FROM photometry_skipped WHERE priority IN (SELECT todolist.priority FROM todolist WHERE " + clear_status + ");")
+		self.cursor.execute("UPDATE todolist SET status=NULL WHERE " + clear_status + ";")
 		self.conn.commit()
 
+		# Use the predictions of which targets are going to be skipped by brighter targets,
+		# for the targets where both are still waiting to be processed:
+		self.predicted_skips = predicted_skips
+		self._deferring = {} # Deferred tasks waiting for each task
+		self._num_deferred = 0
+		self._deferred_costs = {} # Expected cost of each deferred task
+		self._deferred_cost = 0.0
+		if self.predicted_skips is not None:
+			self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='skip_predictions';")
+			if not self.cursor.fetchone():
+				self.logger.warning("TODO-file does not contain predictions of skipped targets")
+				self.predicted_skips = None
+		if self.predicted_skips is not None:
+			self._begin()
+			self.cursor.execute("SELECT skip_predictions.priority,skip_predictions.skipped_by FROM skip_predictions INNER JOIN todolist AS t1 ON t1.priority=skip_predictions.priority INNER JOIN todolist AS t2 ON t2.priority=skip_predictions.skipped_by WHERE t1.status IS NULL AND t2.status IS NULL;")
+			pairs = self.cursor.fetchall()
+			if self.predicted_skips == 'skip':
+				for priority, skipped_by in pairs:
+					self.cursor.execute("UPDATE todolist SET status=? WHERE priority=?;", (STATUS.SKIPPED.value, priority))
+					self.cursor.execute("INSERT INTO photometry_skipped (priority,skipped_by) VALUES (?,?);", (priority, skipped_by))
+				self.conn.commit()
+				self.logger.info("Marked %d targets as SKIPPED up front", len(pairs))
+			else:
+				for priority, skipped_by in pairs:
+					self._deferring.setdefault(skipped_by, set()).add(priority)
+				self.conn.commit()
+				self.logger.info("Deferring %d targets until their brighter neighbours are processed", len(pairs))
+
+		# Load the tasks waiting to be processed into memory:
+		self.queue = None
+		if in_memory_queue:
+			self.cursor.execute("SELECT priority,starid,method,sector,camera,ccd,datasource,tmag FROM todolist WHERE status IS NULL;")
+			tasks = self.cursor.fetchall()
+			if self._deferring:
+				deferred = set().union(*self._deferring.values())
+				self._deferred_costs = dict((task['priority'], self.cost_model.predict(dict(task))) for task in tasks if task['priority'] in deferred)
+				self._deferred_cost = sum(self._deferred_costs.values())
+				tasks = [task for task in tasks if task['priority'] not in deferred]
+				self._num_deferred = len(deferred)
+			self.queue = TaskQueue(tasks, cost=self.cost_model.predict, largest_first=(order == 'cost'))
+			self.logger.info("Loaded %d tasks into memory", len(self.queue))
+
+		# Keep track of run time of tasks, for estimating the remaining time:
+		self._running = {} # Expected cost and start time of each running task
+		self._run_start = default_timer()
+		self._run_elaptime = 0.0
+		self._run_predicted = 0.0
+
 		# Prepare summary object:
 		self.summary = {
 			'slurm_jobid': os.environ.get('SLURM_JOB_ID', None),
 			'numtasks': 0,
 			'tasks_run': 0,
-			'last_error': None
+			'last_error': None,
+			'eta': None
 		}
 		# Make sure to add all the different status to summary:
 		for s in STATUS: self.summary[s.name] = 0
@@ -132,8 +515,69 @@ class TaskManager(object):
 			finally:
 				self.conn.isolation_level = ''
 
+		# Make sure buffered changes are written if we are asked to terminate:
+		if self.write_behind:
+			try:
+				self._old_sigterm = signal.signal(signal.SIGTERM, self._signal_handler)
+			except ValueError:
+				# Signal handlers can only be installed from the main thread,
+				# so in that case it is up to the caller to call close or flush:
+				self.logger.info("TaskManager not running in main thread. SIGTERM handler not installed.")
+
+	def _signal_handler(self, signum, frame):
+		"""Write buffered changes to the TODO-file and exit when receiving a signal."""
+		if self._busy:
+			# We are in the middle of changing the TODO-file,
+			# so wait until the change is complete:
+			self._pending_signal = signum
+			return
+		self.logger.warning("Received signal %d. Writing changes to TODO-file.", signum)
+		self.flush()
+		raise SystemExit(128 + signum)
+
+	def _commit(self, results=0):
+		"""
+		Commit changes to the TODO-file.
+
+		If running in write-behind mode, the commit is postponed until ``commit_interval``
+		results have been saved or ``commit_timeout`` seconds have passed since the last commit.
+
+		Parameters:
+			results (int): Number of results saved by the changes. Default=0.
+		"""
+		self._uncommitted += results
+		if not self.write_behind \
+			or self._uncommitted >= self.commit_interval \
+			or default_timer() - self._last_commit >= self.commit_timeout:
+			self.flush()
+
+		# If a signal was received while changes were being made, handle it now:
+		if self._pending_signal is not None:
+			signum, self._pending_signal = self._pending_signal, None
+			self._signal_handler(signum, None)
+
+	def _begin(self):
+		"""
+		Start a transaction which takes the write lock on the TODO-file straight away.
+
+		Only done when the TODO-file is shared, where it ensures that changes depending on what
+		was just read are not interleaved with changes from other processes.
+		"""
+		if self.shared:
+			self.cursor.execute("BEGIN IMMEDIATE;")
+
+	def flush(self):
+		"""Commit all buffered changes to the TODO-file."""
+		self.conn.commit()
+		self._uncommitted = 0
+		self._last_commit = default_timer()
+
 	def close(self):
 		"""Close TaskManager and all associated objects."""
+		if self.write_behind and self._old_sigterm is not None:
+			signal.signal(signal.SIGTERM, self._old_sigterm)
+			self._old_sigterm = None
+		self.flush()
 		self.cursor.close()
 		self.conn.close()
 		self.write_summary()
@@ -151,6 +595,8 @@ class TaskManager(object):
 		Returns:
 			int: Number of tasks due to be processed.
 		"""
+		if self.queue is not None:
+			return len(self.queue) + self._num_deferred
 		self.cursor.execute("SELECT COUNT(*) AS num FROM todolist WHERE status IS NULL;")
 		num = int(self.cursor.fetchone()['num'])
 		return num
@@ -159,12 +605,20 @@ class TaskManager(object):
 		"""
 		Get next task to be processed.
 
+		Parameters:
+			starid (integer, optional): Only return task for this target.
+
 		Returns:
 			dict or None: Dictionary of settings for task.
 		"""
+		if self.queue is not None and starid is None:
+			return self.queue.peek()
+
 		constraints = []
 		if starid is not None:
 			constraints.append("starid=%d" % starid)
+		elif self.predicted_skips == 'defer':
+			constraints.append(self._not_deferred)
 
 		if constraints:
 			constraints = " AND " + " AND ".join(constraints)
@@ -176,6 +630,9 @@ class TaskManager(object):
 		if task: return dict(task)
 		return None
 
+	# Constraint selecting tasks which are not waiting for a brighter target to be processed:
+	_not_deferred = "NOT EXISTS (SELECT 1 FROM skip_predictions INNER JOIN todolist AS t2 ON t2.priority=skip_predictions.skipped_by WHERE skip_predictions.priority=todolist.priority AND (t2.status IS NULL OR t2.status=" + str(STATUS.STARTED.value) + "))"
+
 	def get_random_task(self):
 		"""
 		Get random task to be processed.
@@ -183,7 +640,11 @@ class TaskManager(object):
 		Returns:
 			dict or None: Dictionary of settings for task.
 		"""
-		self.cursor.execute("SELECT priority,starid,method,sector,camera,ccd,datasource,tmag FROM todolist WHERE status IS NULL ORDER BY RANDOM() LIMIT 1;")
+		constraints = ''
+		if self.predicted_skips == 'defer':
+			constraints = " AND " + self._not_deferred
+
+		self.cursor.execute("SELECT priority,starid,method,sector,camera,ccd,datasource,tmag FROM todolist WHERE status IS NULL" + constraints + " ORDER BY RANDOM() LIMIT 1;")
 		task = self.cursor.fetchone()
 		if task: return dict(task)
 		return None
@@ -192,8 +653,57 @@ class TaskManager(object):
 		"""
 		Save results and diagnostics. This will update the TODO list.
 
+		When the TODO-file is shared, the result is only saved if the task is still claimed
+		by this process. If the claim expired and the task was taken over by another process,
+		the result is discarded, since the other process is going to save its own.
+
 		Parameters:
 			results (dict): Dictionary of results and diagnostics.
+
+		Returns:
+			boolean: ``True`` if the result was saved, ``False`` if it was discarded because
+				the task had been claimed by another process.
+		"""
+
+		self._busy = True
+		try:
+			self._begin()
+
+			if self.shared and not self._holds_claim(result['priority']):
+				self.conn.rollback()
+				self.summary['STARTED'] -= 1
+				self.logger.warning("Discarding result of task %d, which is no longer claimed by worker %s.", result['priority'], self.worker_id)
+				return False
+
+			self._store_result(result)
+
+			# Results of other targets which were processed along with this one:
+			secondaries = result.get('details', {}).get('secondary', [])
+			saved = 1
+			for secondary in secondaries:
+				saved += self._store_secondary(result, secondary)
+		finally:
+			self._busy = False
+		self._commit(results=saved)
+
+		# Write summary file:
+		if self.summary_file and self.summary['tasks_run'] % self.summary_interval < saved:
+			self.write_summary()
+		return True
+
+	def _holds_claim(self, priority):
+		"""Check if the task is claimed by this process in the shared TODO-file."""
+		self.cursor.execute("SELECT 1 FROM claims WHERE priority=? AND worker=?;", (priority, self.worker_id))
+		return self.cursor.fetchone() is not None
+
+	def _store_result(self, result, primary=True):
+		"""
+		Store the status and diagnostics of a single target in the TODO-file.
+
+		Parameters:
+			result (dict): Dictionary of results and diagnostics.
+			primary (boolean): Whether the result is of a target which was handed out as a task,
+				as opposed to a target processed along with another task.
 		"""
 
 		# Extract details dictionary:
@@ -201,6 +711,7 @@ class TaskManager(object):
 
 		# The status of this target returned by the photometry:
 		my_status = result['status']
+		confirmed = []
 
 		# Also set status of targets that were marked as "SKIPPED" by this target:
 		if 'skip_targets' in details and len(details['skip_targets']) > 0:
@@ -222,15 +733,21 @@ class TaskManager(object):
 					# so let's keep it and simply mark all the other targets
 					# as SKIPPED:
 					for row in skip_rows:
-						self.cursor.execute("UPDATE todolist SET status=? WHERE priority=?;", (
+						self.cursor.execute("UPDATE todolist SET status=? WHERE priority=? AND status IS NOT ?;", (
 							STATUS.SKIPPED.value,
-							row['priority']
+							row['priority'],
+							STATUS.SKIPPED.value
 						))
 						self.summary['SKIPPED'] += self.cursor.rowcount
-						self.cursor.execute("INSERT INTO photometry_skipped (priority,skipped_by) VALUES (?,?);", (
+						if self.queue is not None:
+							self.queue.remove(row['priority'])
+						self.cursor.execute("INSERT INTO photometry_skipped (priority,skipped_by) SELECT ?,? WHERE NOT EXISTS (SELECT 1 FROM photometry_skipped WHERE priority=? AND skipped_by=?);", (
+							row['priority'],
+							result['priority'],
 							row['priority'],
 							result['priority']
 						))
+						confirmed.append(row['priority'])
 				else:
 					# This target was not the brightest star in the mask,
 					# and a brighter target is going to be processed,
@@ -246,7 +763,20 @@ class TaskManager(object):
 		))
 		self.summary['tasks_run'] += 1
 		self.summary[my_status.name] += 1
-		self.summary['STARTED'] -= 1
+		if primary:
+			self._running.pop(result['priority'], None)
+			if self.cost_model is not None:
+				self._update_eta(result)
+			self.summary['STARTED'] -= 1
+			if self.shared:
+				self.cursor.execute("DELETE FROM claims WHERE priority=? AND worker=?;", (result['priority'], self.worker_id))
+
+		# Targets which were predicted to be skipped by the targets which are now done,
+		# but were not, should now be processed:
+		if self.predicted_skips is not None:
+			for priority in confirmed:
+				self._resolve_predictions(priority)
+			self._resolve_predictions(result['priority'], confirmed)
 
 		# Save additional diagnostics:
 		error_msg = details.get('errors', None)
@@ -258,7 +788,7 @@ class TaskManager(object):
 		stamp_width = None if stamp is None else stamp[3] - stamp[2]
 		stamp_height = None if stamp is None else stamp[1] - stamp[0]
 
-		self.cursor.execute("INSERT INTO diagnostics (priority, starid, lightcurve, elaptime, pos_column, pos_row, mean_flux, variance, variability, rms_hour, ptp, mask_size, contamination, stamp_width, stamp_height, stamp_resizes, errors) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?);", (
+		self.cursor.execute("INSERT OR REPLACE INTO diagnostics (priority, starid, lightcurve, elaptime, pos_column, pos_row, mean_flux, variance, variability, rms_hour, ptp, mask_size, contamination, stamp_width, stamp_height, stamp_resizes, errors) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?);", (
 			result['priority'],
 			result['starid'],
 			details.get('filepath_lightcurve', None),
@@ -277,19 +807,233 @@ class TaskManager(object):
 			details.get('stamp_resizes', 0),
 			error_msg
 		))
-		self.conn.commit()
 
-		# Write summary file:
-		if self.summary_file and self.summary['tasks_run'] % self.summary_interval == 0:
-			self.write_summary()
+	def _store_secondary(self, result, secondary):
+		"""
+		Store the result of a target which was processed along with another task.
+
+		The result is only stored if the target is still waiting to be processed,
+		so targets which have already been processed or handed out are left alone.
+
+		Parameters:
+			result (dict): Results of the task the target was processed along with.
+			secondary (dict): Dictionary with starid, status and details of the target.
+
+		Returns:
+			int: Number of results stored, i.e. 1 if the target was waiting and 0 otherwise.
+		"""
+		self.cursor.execute("SELECT t2.priority,t2.starid,t2.tmag FROM todolist INNER JOIN todolist AS t2 ON t2.datasource=todolist.datasource AND t2.sector=todolist.sector AND t2.camera=todolist.camera AND t2.ccd=todolist.ccd AND t2.method IS todolist.method WHERE todolist.priority=? AND t2.starid=? AND t2.status IS NULL;", (
+			result['priority'],
+			secondary['starid']
+		))
+		row = self.cursor.fetchone()
+		if row is None:
+			return 0
+
+		self.logger.debug("Saving result of priority %s processed along with priority %s", row['priority'], result['priority'])
+		if self.queue is not None:
+			self.queue.remove(row['priority'])
+
+		self._store_result({
+			'priority': row['priority'],
+			'starid': row['starid'],
+			'tmag': row['tmag'],
+			'datasource': result['datasource'],
+			'sector': result['sector'],
+			'camera': result['camera'],
+			'ccd': result['ccd'],
+			'status': secondary['status'],
+			'time': secondary['time'],
+			'details': secondary.get('details', {})
+		}, primary=False)
+		return 1
+
+	def _resolve_predictions(self, priority, confirmed=()):
+		"""
+		Release the targets predicted to be skipped by a target which is done.
+
+		Parameters:
+			priority (int): Priority of the target which is done, either because it has
+				been processed or because it has itself been marked as SKIPPED.
+			confirmed (list): Priorities of the targets which were actually marked as
+				SKIPPED by the target.
+		"""
+		if self.predicted_skips == 'defer':
+			deferred = self._deferring.pop(priority, None)
+			if deferred and self.queue is not None:
+				self.cursor.execute("SELECT priority,starid,method,sector,camera,ccd,datasource,tmag FROM todolist WHERE status IS NULL AND priority IN (" + ','.join([str(p) for p in deferred]) + ");")
+				for task in self.cursor.fetchall():
+					self.queue.push(task)
+				self._num_deferred -= len(deferred)
+
+				# The expected cost of the tasks is now counted in the queue instead:
+				for p in deferred:
+					self._deferred_cost -= self._deferred_costs.pop(p, 0.0)
+
+		elif self.predicted_skips == 'skip':
+			self.cursor.execute("SELECT skip_predictions.priority FROM skip_predictions INNER JOIN photometry_skipped ON photometry_skipped.priority=skip_predictions.priority AND photometry_skipped.skipped_by=skip_predictions.skipped_by WHERE skip_predictions.skipped_by=?;", (priority, ))
+			for row in self.cursor.fetchall():
+				if row['priority'] in confirmed:
+					continue
+				self.cursor.execute("DELETE FROM photometry_skipped WHERE priority=? AND skipped_by=?;", (row['priority'], priority))
+				self.cursor.execute("UPDATE todolist SET status=NULL WHERE priority=? AND status=? AND NOT EXISTS (SELECT 1 FROM photometry_skipped WHERE priority=?);", (
+					row['priority'],
+					STATUS.SKIPPED.value,
+					row['priority']
+				))
+				if self.cursor.rowcount > 0:
+					self.logger.info("Target with priority %s was not skipped as predicted", row['priority'])
+					self.summary['SKIPPED'] -= 1
+					if self.queue is not None:
+						self.cursor.execute("SELECT priority,starid,method,sector,camera,ccd,datasource,tmag FROM todolist WHERE priority=?;", (row['priority'], ))
+						self.queue.push(self.cursor.fetchone())
+
+	def _update_eta(self, result):
+		"""
+		Update the estimate of the remaining run time in the summary.
+
+		The expected run times of the waiting tasks, including the deferred tasks, and the
+		remaining expected run times of the running tasks are corrected by how much the
+		run times of the tasks finished so far deviated from the cost model, and
+		divided by the number of tasks which have effectively been running in parallel.
+		"""
+		self._run_elaptime += result['time']
+		self._run_predicted += self.cost_model.predict(result)
+		now = default_timer()
+		walltime = now - self._run_start
+		if self._run_elaptime > 0 and self._run_predicted > 0 and walltime > 0:
+			correction = self._run_elaptime / self._run_predicted
+			parallel = self._run_elaptime / walltime
+			remaining = self._waiting_cost() * correction
+			for cost, started in self._running_tasks():
+				remaining += max(cost*correction - (now - started), 0)
+			self.summary['eta'] = remaining / parallel
+
+	def _waiting_cost(self):
+		"""Expected cost of the tasks waiting in the queue or deferred until other tasks are done."""
+		return max(self.queue.total_cost, 0) + max(self._deferred_cost, 0)
+
+	def _running_tasks(self):
+		"""Expected cost and start time of the tasks currently running."""
+		return list(self._running.values())
 
 	def start_task(self, taskid):
 		"""
 		Mark a task as STARTED in the TODO-list.
 		"""
 		self.cursor.execute("UPDATE todolist SET status=? WHERE priority=?;", (STATUS.STARTED.value, taskid))
-		self.conn.commit()
 		self.summary['STARTED'] += 1
+		if self.queue is not None:
+			self.queue.remove(taskid)
+		if self.cost_model is not None:
+			self.cursor.execute("SELECT priority,starid,method,sector,camera,ccd,datasource,tmag FROM todolist WHERE priority=?;", (taskid, ))
+			task = self.cursor.fetchone()
+			if task is not None:
+				self._running[taskid] = (self.cost_model.predict(dict(task)), default_timer())
+		self._commit()
+
+	def claim_task(self, lease=3600.0):
+		"""
+		Claim the next task to be processed in a shared TODO-file.
+
+		The task is marked as STARTED and the claim is recorded in the TODO-file in a
+		single transaction, so processes sharing the TODO-file never claim the same task.
+		A claim expires after ``lease`` seconds, after which another process may claim
+		the task again. This way tasks claimed by processes which were killed are
+		eventually processed. Tasks with expired claims are handed out first.
+
+		Parameters:
+			lease (float): Number of seconds before the claim expires. Default=3600.
+
+		Returns:
+			dict or None: Dictionary of settings for task, or ``None`` if no tasks are waiting.
+
+		Raises:
+			RuntimeError: If the TaskManager was not opened with ``shared`` enabled.
+		"""
+		if not self.shared:
+			raise RuntimeError("Tasks can only be claimed from a shared TODO-file")
+
+		now = time.time()
+		self._begin()
+		try:
+			self.cursor.execute("SELECT todolist.priority,starid,method,sector,camera,ccd,datasource,tmag FROM claims INNER JOIN todolist ON todolist.priority=claims.priority WHERE todolist.status=? AND claims.expires<? ORDER BY todolist.priority LIMIT 1;", (
+				STATUS.STARTED.value,
+				now
+			))
+			task = self.cursor.fetchone()
+			if task is None:
+				constraints = ''
+				if self.predicted_skips == 'defer':
+					constraints = " AND " + self._not_deferred
+				self.cursor.execute("SELECT priority,starid,method,sector,camera,ccd,datasource,tmag FROM todolist WHERE status IS NULL" + constraints + " ORDER BY priority LIMIT 1;")
+				task = self.cursor.fetchone()
+			else:
+				self.logger.info("Taking over expired claim on task %d", task['priority'])
+
+			if task is not None:
+				self.cursor.execute("UPDATE todolist SET status=? WHERE priority=?;", (STATUS.STARTED.value, task['priority']))
+				self.cursor.execute("INSERT OR REPLACE INTO claims (priority,worker,expires) VALUES (?,?,?);", (task['priority'], self.worker_id, now + lease))
+				self.summary['STARTED'] += 1
+			self.conn.commit()
+		except:
+			self.conn.rollback()
+			raise
+
+		if task: return dict(task)
+		return None
+
+	def renew_claim(self, taskid, lease=3600.0):
+		"""
+		Extend the claim on a task in a shared TODO-file, so it is not taken over by another process.
+
+		Processes working on tasks which may take longer than the lease should call this
+		periodically while the task is running. This may be done from another thread,
+		as long as the TaskManager is not used by the main thread at the same time.
+
+		Parameters:
+			taskid (int): Priority of the task.
+			lease (float): Number of seconds from now before the claim expires. Default=3600.
+
+		Returns:
+			boolean: ``True`` if the claim was renewed, ``False`` if the task is no longer
+				claimed by this process.
+
+		Raises:
+			RuntimeError: If the TaskManager was not opened with ``shared`` enabled.
+		"""
+		if not self.shared:
+			raise RuntimeError("Tasks can only be claimed from a shared TODO-file")
+
+		self.cursor.execute("UPDATE claims SET expires=? WHERE priority=? AND worker=?;", (time.time() + lease, taskid, self.worker_id))
+		renewed = (self.cursor.rowcount > 0)
+		self.conn.commit()
+		return renewed
+
+	def requeue_task(self, taskid):
+		"""
+		Put a task which was marked as STARTED, but never processed, back into the TODO-list.
+
+		Tasks which have since been given another status (e.g. SKIPPED by another target),
+		or which have been claimed by another process in a shared TODO-file, are left untouched.
+
+		Parameters:
+			taskid (int): Priority of the task.
+		"""
+		# The task is no longer running, no matter if it is put back or not:
+		self.summary['STARTED'] -= 1
+		self._running.pop(taskid, None)
+		self._begin()
+		if self.shared:
+			self.cursor.execute("DELETE FROM claims WHERE priority=? AND worker=?;", (taskid, self.worker_id))
+			if self.cursor.rowcount == 0:
+				self.conn.rollback()
+				return
+		self.cursor.execute("UPDATE todolist SET status=NULL WHERE priority=? AND status=?;", (taskid, STATUS.STARTED.value))
+		if self.cursor.rowcount > 0 and self.queue is not None:
+			self.cursor.execute("SELECT priority,starid,method,sector,camera,ccd,datasource,tmag FROM todolist WHERE priority=?;", (taskid, ))
+			self.queue.push(self.cursor.fetchone())
+		self._commit()
 
 	def write_summary(self):
 		"""Write summary of progress to file. The summary file will be in JSON format."""
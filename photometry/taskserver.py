@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Task server handing out tasks from a TODO-file to workers over sockets.
+
+The server keeps the :py:class:`photometry.TaskManager` of the TODO-file, and workers
+anywhere connect to it over TCP or Unix sockets to get tasks and return the results.
+In contrast to MPI, workers can connect and disconnect at any time during the run.
+Tasks held by workers which disconnect, or which have not been heard from within
+the heartbeat timeout, are put back into the TODO-list and given to other workers.
+
+The protocol is newline-delimited JSON. Each request from a worker is answered
+by exactly one reply from the server:
+
+* ``{"cmd": "task"}`` asks for a new task. The reply is ``{"task": task}``, where the
+  task is ``null`` if there are no tasks. In that case ``"wait"`` is true if tasks
+  could still become available (e.g. if other workers disappear), and the worker
+  should ask again later.
+* ``{"cmd": "result", "result": result}`` returns the result of a task. The reply is
+  ``{"ok": true}``, or ``{"ok": false}`` if the task was taken from the worker
+  in the meantime and the result was discarded.
+* ``{"cmd": "heartbeat"}`` tells the server that the worker is still alive. The reply
+  is ``{"ok": true}``. Any other request also counts as a heartbeat.
+"""
+
+from __future__ import division, with_statement, print_function, absolute_import
+import numpy as np
+import os
+import stat
+import socket
+import select
+import json
+import logging
+import threading
+import time
+from timeit import default_timer
+from . import STATUS
+from .shards import open_task_manager
+
+#------------------------------------------------------------------------------
+def parse_address(address):
+	"""
+	Parse address of task server.
+
+	Parameters:
+		address (string): Either ``'host:port'`` for a TCP socket, or the path to a Unix socket.
+
+	Returns:
+		tuple: Address family and address as used by :py:mod:`socket`.
+	"""
+	host, sep, port = address.rpartition(':')
+	if sep and port.isdigit() and os.sep not in address:
+		return socket.AF_INET, (host if host else 'localhost', int(port))
+	return socket.AF_UNIX, address
+
+def _json_default(obj):
+	"""Convert objects in results to types which can be encoded as JSON."""
+	if isinstance(obj, STATUS):
+		return obj.name
+	if isinstance(obj, np.generic):
+		return obj.item()
+	if isinstance(obj, np.ndarray):
+		return obj.tolist()
+	if isinstance(obj, (set, frozenset)):
+		return list(obj)
+	raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+def encode_message(msg):
+	"""Encode message as a single line of JSON."""
+	return (json.dumps(msg, default=_json_default) + '\n').encode('utf-8')
+
+def decode_message(line):
+	"""Decode a single line of JSON into a message."""
+	return json.loads(line.decode('utf-8'))
+
+#------------------------------------------------------------------------------
+class _Connection(object):
+	"""State of the connection to a single worker."""
+	def __init__(self, sock, name):
+		self.sock = sock
+		self.name = name
+		self.buffer = b''
+		self.tasks = set()
+		self.last_seen = default_timer()
+
+	def fileno(self):
+		return self.sock.fileno()
+
+#------------------------------------------------------------------------------
+class TaskServer(object):
+	"""
+	Server handing out tasks from a TODO-file to workers connecting over sockets.
+
+	Attributes:
+		address (string): Address the server is listening on.
+		heartbeat_timeout (float): Number of seconds without hearing from a worker before its tasks are requeued.
+		keep_running (boolean): Keep running when all tasks are done, waiting for tasks to be requeued.
+	"""
+
+	def __init__(self, todo_file, address, heartbeat_timeout=60.0, keep_running=False, **kwargs):
+		"""
+		Start listening for workers on the given address.
+
+		Parameters:
+			todo_file (string): Path to the TODO-file, or the directory containing it (or its shards).
+			address (string): Address to listen on. Either ``'host:port'`` for a TCP socket,
+				or the path to a Unix socket. Using port 0 picks a free port.
+			heartbeat_timeout (float): Number of seconds without hearing from a worker before
+				the tasks it holds are given to other workers. Default=60.
+			keep_running (boolean): Keep running when all tasks are done. Default is to stop
+				when there are no more tasks to hand out and no tasks are running.
+			**kwargs: Keyword-arguments passed on to :py:class:`photometry.TaskManager`.
+		"""
+		self.logger = logging.getLogger(__name__)
+		self.todo_file = todo_file
+		self.heartbeat_timeout = heartbeat_timeout
+		self.keep_running = keep_running
+		self.tm_kwargs = kwargs
+		self.connections = []
+		self._stopped = False
+		self._names = 0
+
+		family, addr = parse_address(address)
+		if family == socket.AF_UNIX and os.path.exists(addr) and stat.S_ISSOCK(os.stat(addr).st_mode):
+			# Remove socket left behind by a previous server:
+			os.remove(addr)
+
+		self.sock = socket.socket(family, socket.SOCK_STREAM)
+		if family == socket.AF_INET:
+			self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind(addr)
+		self.sock.listen(128)
+
+		if family == socket.AF_INET:
+			self.address = '%s:%d' % self.sock.getsockname()[0:2]
+		else:
+			self.address = addr
+		self.logger.info("Task server listening on %s", self.address)
+
+	def close(self):
+		"""Close the server and all connections to workers."""
+		for conn in self.connections:
+			conn.sock.close()
+		self.connections = []
+		if self.sock is not None:
+			self.sock.close()
+			self.sock = None
+			if not isinstance(parse_address(self.address)[1], tuple) and os.path.exists(self.address):
+				os.remove(self.address)
+
+	def __exit__(self, *args):
+		self.close()
+
+	def __enter__(self):
+		return self
+
+	def stop(self):
+		"""Ask the server to stop. Can be called from another thread."""
+		self._stopped = True
+
+	def run(self):
+		"""
+		Hand out tasks to workers until all tasks are done, or the server is stopped.
+
+		The TaskManager is opened here, so this is the thread which works on the TODO-file.
+
+		Returns:
+			dict: Summary of the tasks processed, as in :py:attr:`photometry.TaskManager.summary`.
+		"""
+		with open_task_manager(self.todo_file, in_memory_queue=True, **self.tm_kwargs) as tm:
+			self.logger.info("%d tasks to be run", tm.get_number_tasks())
+			while not self._stopped:
+				readable = select.select([self.sock] + self.connections, [], [], 0.5)[0]
+				for conn in readable:
+					if conn is self.sock:
+						self._accept()
+					else:
+						self._receive(tm, conn)
+
+				# Give the tasks of workers which have not been heard from to other workers:
+				now = default_timer()
+				for conn in list(self.connections):
+					if conn.tasks and now - conn.last_seen > self.heartbeat_timeout:
+						self._disconnect(tm, conn, "timed out")
+
+				# Stop when all tasks are done:
+				if not self.keep_running and tm.get_number_tasks() == 0 and self._running() == 0:
+					break
+
+			# Workers still connected are told there are no more tasks by the connection closing:
+			for conn in list(self.connections):
+				self._disconnect(tm, conn, "closed by server")
+			summary = dict(tm.summary)
+
+		self.logger.info("Task server finished")
+		return summary
+
+	def _running(self):
+		"""Number of tasks currently held by workers."""
+		return sum(len(conn.tasks) for conn in self.connections)
+
+	def _accept(self):
+		sock, addr = self.sock.accept()
+		self._names += 1
+		name = '%s:%d' % addr[0:2] if isinstance(addr, tuple) else 'worker%d' % self._names
+		self.connections.append(_Connection(sock, name))
+		self.logger.debug("Worker %s connected", name)
+
+	def _disconnect(self, tm, conn, reason):
+		"""Close connection to worker and requeue all the tasks it holds."""
+		if conn.tasks:
+			self.logger.warning("Worker %s %s. Requeuing %d tasks.", conn.name, reason, len(conn.tasks))
+		else:
+			self.logger.debug("Worker %s %s.", conn.name, reason)
+		for priority in conn.tasks:
+			tm.requeue_task(priority)
+		conn.tasks.clear()
+		conn.sock.close()
+		self.connections.remove(conn)
+
+	def _receive(self, tm, conn):
+		"""Read data from worker and answer all complete requests."""
+		try:
+			data = conn.sock.recv(65536)
+		except socket.error:
+			data = b''
+		if not data:
+			self._disconnect(tm, conn, "disconnected")
+			return
+
+		conn.last_seen = default_timer()
+		conn.buffer += data
+		while b'\n' in conn.buffer:
+			line, conn.buffer = conn.buffer.split(b'\n', 1)
+			try:
+				reply = self._handle(tm, conn, decode_message(line))
+				conn.sock.sendall(encode_message(reply))
+			except (socket.error, ValueError, KeyError):
+				self.logger.exception("Invalid request from worker %s", conn.name)
+				self._disconnect(tm, conn, "failed")
+				return
+
+	def _handle(self, tm, conn, msg):
+		"""Handle a single request from worker, returning the reply."""
+		cmd = msg['cmd']
+		if cmd == 'task':
+			task = tm.get_task()
+			if task is None:
+				return {'task': None, 'wait': self.keep_running or self._running() > 0}
+			task = dict(task)
+			tm.start_task(task['priority'])
+			conn.tasks.add(task['priority'])
+			return {'task': task}
+
+		elif cmd == 'result':
+			result = msg['result']
+			if result['priority'] not in conn.tasks:
+				self.logger.warning("Discarding result of task %d from worker %s, which no longer holds it.", result['priority'], conn.name)
+				return {'ok': False}
+			conn.tasks.remove(result['priority'])
+			result['status'] = STATUS[result['status']]
+			for secondary in result.get('details', {}).get('secondary', []):
+				secondary['status'] = STATUS[secondary['status']]
+			tm.save_result(result)
+			return {'ok': True}
+
+		elif cmd == 'heartbeat':
+			return {'ok': True}
+
+		raise ValueError("Unknown command: '%s'" % cmd)
+
+#------------------------------------------------------------------------------
+class TaskClient(object):
+	"""
+	Worker side of the connection to a :py:class:`TaskServer`.
+
+	While connected, heartbeats are sent to the server in a background thread,
+	so tasks taking a long time are not given to other workers.
+	"""
+
+	def __init__(self, address, heartbeat_interval=20.0, timeout=None):
+		"""
+		Connect to task server.
+
+		Parameters:
+			address (string): Address of the task server. Either ``'host:port'`` or the path to a Unix socket.
+			heartbeat_interval (float or None): Number of seconds between heartbeats sent to
+				the server. Should be well below the heartbeat timeout of the server.
+				If ``None``, no heartbeats are sent. Default=20.
+			timeout (float, optional): Timeout in seconds when connecting to the server.
+
+		Raises:
+			socket.error: If the connection to the server could not be established.
+		"""
+		family, addr = parse_address(address)
+		self.sock = socket.socket(family, socket.SOCK_STREAM)
+		self.sock.settimeout(timeout)
+		self.sock.connect(addr)
+		self.sock.settimeout(None)
+		self._reader = self.sock.makefile('rb')
+		self._lock = threading.Lock()
+		self._closed = threading.Event()
+
+		self._heartbeat = None
+		if heartbeat_interval is not None:
+			self._heartbeat = threading.Thread(target=self._send_heartbeats, args=(heartbeat_interval, ))
+			self._heartbeat.daemon = True
+			self._heartbeat.start()
+
+	def close(self):
+		"""Close the connection to the server. Tasks not returned are requeued by the server."""
+		if not self._closed.is_set():
+			self._closed.set()
+			with self._lock:
+				self._reader.close()
+				self.sock.close()
+			if self._heartbeat is not None:
+				self._heartbeat.join()
+
+	def __exit__(self, *args):
+		self.close()
+
+	def __enter__(self):
+		return self
+
+	def _request(self, msg):
+		"""
+		Send request to the server and wait for the reply.
+
+		Raises:
+			IOError: If the connection to the server was closed.
+		"""
+		with self._lock:
+			if self._closed.is_set():
+				raise IOError("Connection to task server is closed")
+			self.sock.sendall(encode_message(msg))
+			line = self._reader.readline()
+		if not line:
+			raise IOError("Connection closed by task server")
+		return decode_message(line)
+
+	def _send_heartbeats(self, interval):
+		while not self._closed.wait(interval):
+			try:
+				self._request({'cmd': 'heartbeat'})
+			except (IOError, socket.error):
+				break
+
+	def get_task(self, retry=5.0):
+		"""
+		Get next task to be processed.
+
+		If there are no tasks right now, but tasks may become available later,
+		this keeps asking the server every ``retry`` seconds.
+
+		Parameters:
+			retry (float): Number of seconds between asking the server for tasks. Default=5.
+
+		Returns:
+			dict or None: Dictionary of settings for task, or ``None`` if all tasks are done.
+		"""
+		while True:
+			try:
+				reply = self._request({'cmd': 'task'})
+			except (IOError, socket.error):
+				# The server has stopped, so there are no more tasks:
+				return None
+			if reply['task'] is not None:
+				return reply['task']
+			if not reply.get('wait'):
+				return None
+			time.sleep(retry)
+
+	def save_result(self, result):
+		"""
+		Send result of task to the server.
+
+		Parameters:
+			result (dict): Dictionary of results and diagnostics.
+
+		Returns:
+			boolean: ``True`` if the result was saved, ``False`` if it was discarded because
+				the task had been given to another worker.
+
+		Raises:
+			IOError: If the connection to the server was closed.
+		"""
+		return self._request({'cmd': 'result', 'result': result})['ok']
@@ -26,6 +26,13 @@ def _try_photometry(PhotClass, *args, **kwargs):
 			if pho.status in (STATUS.OK, STATUS.WARNING):
 				pho.save_lightcurve()
 
+				# Save the lightcurves of other targets extracted along with this one,
+				# and report them back with the results of this target:
+				for other in pho.secondary_photometry:
+					if other.status in (STATUS.OK, STATUS.WARNING):
+						other.save_lightcurve()
+					pho.report_details(secondary={'starid': other.starid, 'status': other.status, 'time': other.elaptime, 'details': other._details})
+
 	except (KeyboardInterrupt, SystemExit):
 		logger.info("Stopped by user or system")
 		try:
@@ -58,6 +65,9 @@ def tessphot(method=None, *args, **kwargs):
 
 	Parameters:
 		method (string or None): Type of photometry to run. Can be ``'aperture'``, ``'psf'``, ``'linpsf'`` or ``None``.
+		secondary_targets (boolean, optional): Also extract lightcurves of other targets in the stamp
+			of the target, which are reported in the ``secondary`` details of the result. Only used
+			with aperture photometry. Default is ``False``.
 		*args: Arguments passed on to the photometry class init-function.
 		**kwargs: Keyword-arguments passed on to the photometry class init-function.
 
@@ -67,6 +77,9 @@ def tessphot(method=None, *args, **kwargs):
 
 	logger = logging.getLogger(__name__)
 
+	if method not in (None, 'aperture'):
+		kwargs.pop('secondary_targets', None)
+
 	if method is None:
 		pho = _try_photometry(AperturePhotometry, *args, **kwargs)
 
@@ -16,13 +16,13 @@ import warnings
 warnings.filterwarnings('ignore', category=FutureWarning, module='h5py')
 import h5py
 import re
-import functools
 import contextlib
 from astropy.table import Table, vstack
 from astropy.io import fits
 from astropy.wcs import WCS
 from timeit import default_timer
-from .utilities import find_tpf_files, find_hdf5_files, find_catalog_files, sphere_distance
+from scipy.spatial import cKDTree
+from .utilities import find_tpf_files, find_hdf5_files, find_catalog_files, sphere_distance, read_fits_headers
 import multiprocessing
 
 def calc_cbv_area(catalog_row, settings):
@@ -128,7 +128,152 @@ def _ffi_todo(input_folder, sector, camera, ccd):
 	)
 
 #------------------------------------------------------------------------------
-def _tpf_todo(fname, input_folder=None, cameras=None, ccds=None, find_secondary_targets=True, exclude=[]):
+def _tpf_header_info(fname):
+	"""
+	Extract the information needed for the TODO-list from the headers of a Target Pixel File.
+
+	Only the FITS headers are read, meaning that none of the (potentially large)
+	data sections of the file are loaded.
+
+	Parameters:
+		fname (string): Path to Target Pixel File.
+
+	Returns:
+		dict: Dictionary with ``starid``, ``sector``, ``camera``, ``ccd``, the shape of the
+			stamp (``stamp_height`` and ``stamp_width``) and the ``wcs`` header string of the aperture.
+	"""
+	logger = logging.getLogger(__name__)
+	logger.debug("Reading TPF headers: '%s'", fname)
+
+	hdr0, hdr2 = read_fits_headers(fname, extensions=(0, 2))
+	return {
+		'starid': int(hdr0['TICID']),
+		'sector': int(hdr0['SECTOR']),
+		'camera': int(hdr0['CAMERA']),
+		'ccd': int(hdr0['CCD']),
+		'stamp_height': int(hdr2['NAXIS2']),
+		'stamp_width': int(hdr2['NAXIS1']),
+		'wcs': WCS(header=hdr2, relax=True).to_header_string(relax=True)
+	}
+
+#------------------------------------------------------------------------------
+def _tpf_header_info_wrapper(fname):
+	return fname, _tpf_header_info(fname)
+
+#------------------------------------------------------------------------------
+def tpf_file_index(input_folder, tpf_files, threads=1):
+	"""
+	Index of the headers of Target Pixel Files.
+
+	The information is stored in the file ``fileindex.sqlite`` in the input folder,
+	keyed on the path, size and modification time of each file. Only files which
+	are new or have changed since the last call will have their headers read again.
+	Files which no longer exist are removed from the index.
+
+	Parameters:
+		input_folder (string): Input folder where the index file is stored.
+		tpf_files (list): List of paths to Target Pixel Files to index.
+		threads (integer, optional): Number of processes to use for reading headers. Default=1.
+
+	Returns:
+		list: List of dictionaries, one for each file, as returned by :py:func:`_tpf_header_info`.
+	"""
+
+	logger = logging.getLogger(__name__)
+
+	index_file = os.path.join(input_folder, 'fileindex.sqlite')
+	with contextlib.closing(sqlite3.connect(index_file)) as conn:
+		conn.row_factory = sqlite3.Row
+		cursor = conn.cursor()
+
+		cursor.execute("""CREATE TABLE IF NOT EXISTS tpf_headers (
+			path TEXT PRIMARY KEY NOT NULL,
+			filesize BIGINT NOT NULL,
+			mtime DOUBLE PRECISION NOT NULL,
+			starid BIGINT NOT NULL,
+			sector INT NOT NULL,
+			camera INT NOT NULL,
+			ccd INT NOT NULL,
+			stamp_height INT NOT NULL,
+			stamp_width INT NOT NULL,
+			wcs TEXT NOT NULL
+		);""")
+		conn.commit()
+
+		# Load the existing index into memory:
+		cursor.execute("SELECT * FROM tpf_headers;")
+		cached = {row['path']: dict(row) for row in cursor.fetchall()}
+
+		# Find the files which are not already indexed, or have changed since:
+		entries = {}
+		to_scan = []
+		for fname in tpf_files:
+			relpath = os.path.relpath(fname, input_folder).replace('\\', '/')
+			st = os.stat(fname)
+			row = cached.get(relpath)
+			if row is not None and row['filesize'] == st.st_size and row['mtime'] == st.st_mtime:
+				entries[fname] = row
+			else:
+				to_scan.append(fname)
+
+		logger.info("TPF headers found in index: %d", len(entries))
+		logger.info("TPF headers to be read: %d", len(to_scan))
+
+		# Remove files which have been deleted since they were indexed:
+		indexed = set(os.path.relpath(fname, input_folder).replace('\\', '/') for fname in tpf_files)
+		removed = [(path, ) for path in cached if path not in indexed and not os.path.exists(os.path.join(input_folder, path))]
+		if removed:
+			logger.info("TPF headers removed from index: %d", len(removed))
+			cursor.executemany("DELETE FROM tpf_headers WHERE path=?;", removed)
+			conn.commit()
+
+		if to_scan:
+			threads = min(threads, len(to_scan))
+			if threads > 1:
+				pool = multiprocessing.Pool(threads)
+				m = pool.imap_unordered
+			else:
+				m = map
+
+			tic = default_timer()
+			for fname, info in m(_tpf_header_info_wrapper, to_scan):
+				st = os.stat(fname)
+				info['path'] = os.path.relpath(fname, input_folder).replace('\\', '/')
+				info['filesize'] = st.st_size
+				info['mtime'] = st.st_mtime
+				cursor.execute("INSERT OR REPLACE INTO tpf_headers (path,filesize,mtime,starid,sector,camera,ccd,stamp_height,stamp_width,wcs) VALUES (:path,:filesize,:mtime,:starid,:sector,:camera,:ccd,:stamp_height,:stamp_width,:wcs);", info)
+				entries[fname] = info
+
+			if threads > 1:
+				pool.close()
+				pool.join()
+
+			conn.commit()
+			toc = default_timer()
+			logger.info("Reading TPF headers: %f seconds (%f per file)", toc-tic, (toc-tic)/len(to_scan))
+
+		cursor.close()
+
+	return [entries[fname] for fname in tpf_files]
+
+#------------------------------------------------------------------------------
+def _tpf_todo_wrapper(args):
+	return _tpf_todo(*args)
+
+def _tpf_todo(entries, input_folder=None, find_secondary_targets=True, exclude=[]):
+	"""
+	Create TODO-list entries for a set of Target Pixel Files which are all on the same CCD.
+
+	Parameters:
+		entries (list): List of dictionaries from the TPF file index (see :py:func:`tpf_file_index`),
+			all from the same sector, camera and CCD.
+		input_folder (string): Input folder where the catalog files are found.
+		find_secondary_targets (boolean, optional): Also add other targets falling within each stamp.
+		exclude (set, optional): Set of (starid, sector, datasource) tuples to exclude.
+
+	Returns:
+		:py:class:`astropy.table.Table`: Table of targets.
+	"""
 
 	logger = logging.getLogger(__name__)
 
@@ -139,91 +284,99 @@ def _tpf_todo(fname, input_folder=None, cameras=None, ccds=None, find_secondary_
 		dtype=('int64', 'int32', 'int32', 'int32', 'S256', 'float32', 'int32')
 	)
 
-	logger.debug("Processing TPF file: '%s'", fname)
-	with fits.open(fname, memmap=True, mode='readonly') as hdu:
-		starid = hdu[0].header['TICID']
-		sector = hdu[0].header['SECTOR']
-		camera = hdu[0].header['CAMERA']
-		ccd = hdu[0].header['CCD']
+	# Remove the targets which should be excluded:
+	entries = [e for e in entries if (e['starid'], e['sector'], 'tpf') not in exclude and (e['starid'], e['sector'], 'all') not in exclude]
+	if not entries:
+		return empty_table
 
-		if (starid, sector, 'tpf') in exclude or (starid, sector, 'all') in exclude:
-			logger.debug("Target excluded: STARID=%d, SECTOR=%d, DATASOURCE=tpf", starid, sector)
-			return empty_table
+	sector = entries[0]['sector']
+	camera = entries[0]['camera']
+	ccd = entries[0]['ccd']
+	logger.debug("Processing %d TPF files: SECTOR=%d, CAMERA=%d, CCD=%d", len(entries), sector, camera, ccd)
 
-		if camera in cameras and ccd in ccds:
-			# Load the corresponding catalog:
-			catalog_file = find_catalog_files(input_folder, sector=sector, camera=camera, ccd=ccd)
-			if len(catalog_file) != 1:
-				raise IOError("Catalog file not found: SECTOR=%s, CAMERA=%s, CCD=%s" % (sector, camera, ccd))
-
-			with contextlib.closing(sqlite3.connect(catalog_file[0])) as conn:
-				conn.row_factory = sqlite3.Row
-				cursor = conn.cursor()
-
-				cursor.execute("SELECT * FROM settings WHERE camera=? AND ccd=? LIMIT 1;", (camera, ccd))
-				settings = cursor.fetchone()
-				if settings is None:
-					logger.error("Settings could not be loaded for camera=%d, ccd=%d.", camera, ccd)
-					raise ValueError("Settings could not be loaded for camera=%d, ccd=%d." % (camera, ccd))
-
-				# Get information about star:
-				cursor.execute("SELECT * FROM catalog WHERE starid=? LIMIT 1;", (starid, ))
-				row = cursor.fetchone()
-				if row is None:
-					logger.error("Starid %d was not found in catalog (camera=%d, ccd=%d).", starid, camera, ccd)
-					return empty_table
-
-				# Calculate CBV area that target falls in:
-				cbv_area = calc_cbv_area(row, settings)
-
-				# Add the main target to the list:
-				cat_tmp.append({
-					'starid': starid,
-					'sector': sector,
-					'camera': camera,
-					'ccd': ccd,
-					'datasource': 'tpf',
-					'tmag': row['tmag'],
-					'cbv_area': cbv_area
-				})
-
-				if find_secondary_targets:
-					# Load all other targets in this stamp:
-					# Use the WCS of the stamp to find all stars that fall within
-					# the footprint of the stamp.
-					image_shape = hdu[2].shape
-					wcs = WCS(header=hdu[2].header)
-					footprint = wcs.calc_footprint(center=False)
-					radec_min = np.min(footprint, axis=0)
-					radec_max = np.max(footprint, axis=0)
-					# TODO: This can fail to find all targets e.g. if the footprint is across the ra=0 line
-					cursor.execute("SELECT * FROM catalog WHERE ra BETWEEN ? AND ? AND decl BETWEEN ? AND ? AND starid != ? AND tmag < 15;", (radec_min[0], radec_max[0], radec_min[1], radec_max[1], starid))
-					for row in cursor.fetchall():
-						# Calculate the position of this star on the CCD using the WCS:
-						ra_dec = np.atleast_2d([row['ra'], row['decl']])
-						x, y = wcs.all_world2pix(ra_dec, 0)[0]
-
-						# If the target falls outside silicon, do not add it to the todo list:
-						# The reason for the strange 0.5's is that pixel centers are at integers.
-						if x < -0.5 or y < -0.5 or x > image_shape[1]-0.5 or y > image_shape[0]-0.5:
-							continue
-
-						# Add this secondary target to the list:
-						# Note that we are storing the starid of the target
-						# in which target pixel file the target can be found.
-						logger.debug("Adding extra target: TIC %d", row['starid'])
-						cat_tmp.append({
-							'starid': row['starid'],
-							'sector': sector,
-							'camera': camera,
-							'ccd': ccd,
-							'datasource': 'tpf:' + str(starid),
-							'tmag': row['tmag'],
-							'cbv_area': cbv_area
-						})
-
-				# Close the connection to the catalog SQLite database:
-				cursor.close()
+	# Load the corresponding catalog:
+	catalog_file = find_catalog_files(input_folder, sector=sector, camera=camera, ccd=ccd)
+	if len(catalog_file) != 1:
+		raise IOError("Catalog file not found: SECTOR=%s, CAMERA=%s, CCD=%s" % (sector, camera, ccd))
+
+	with contextlib.closing(sqlite3.connect(catalog_file[0])) as conn:
+		conn.row_factory = sqlite3.Row
+		cursor = conn.cursor()
+
+		cursor.execute("SELECT * FROM settings WHERE camera=? AND ccd=? LIMIT 1;", (camera, ccd))
+		settings = cursor.fetchone()
+		if settings is None:
+			logger.error("Settings could not be loaded for camera=%d, ccd=%d.", camera, ccd)
+			raise ValueError("Settings could not be loaded for camera=%d, ccd=%d." % (camera, ccd))
+
+		# Get information about all the main targets in one go.
+		# The lookup is done in chunks to stay below the SQLite limit on number of variables:
+		catalog_rows = {}
+		starids = list(set([e['starid'] for e in entries]))
+		for k in range(0, len(starids), 500):
+			chunk = starids[k:k+500]
+			cursor.execute("SELECT * FROM catalog WHERE starid IN (" + ','.join(['?']*len(chunk)) + ");", chunk)
+			for row in cursor.fetchall():
+				catalog_rows[row['starid']] = row
+
+		for entry in entries:
+			starid = entry['starid']
+			row = catalog_rows.get(starid)
+			if row is None:
+				logger.error("Starid %d was not found in catalog (camera=%d, ccd=%d).", starid, camera, ccd)
+				continue
+
+			# Calculate CBV area that target falls in:
+			cbv_area = calc_cbv_area(row, settings)
+
+			# Add the main target to the list:
+			cat_tmp.append({
+				'starid': starid,
+				'sector': sector,
+				'camera': camera,
+				'ccd': ccd,
+				'datasource': 'tpf',
+				'tmag': row['tmag'],
+				'cbv_area': cbv_area
+			})
+
+			if find_secondary_targets:
+				# Load all other targets in this stamp:
+				# Use the WCS of the stamp to find all stars that fall within
+				# the footprint of the stamp.
+				image_shape = (entry['stamp_height'], entry['stamp_width'])
+				wcs = WCS(header=fits.Header.fromstring(entry['wcs']), relax=True)
+				footprint = wcs.calc_footprint(axes=(image_shape[1], image_shape[0]), center=False)
+				radec_min = np.min(footprint, axis=0)
+				radec_max = np.max(footprint, axis=0)
+				# TODO: This can fail to find all targets e.g. if the footprint is across the ra=0 line
+				cursor.execute("SELECT * FROM catalog WHERE ra BETWEEN ? AND ? AND decl BETWEEN ? AND ? AND starid != ? AND tmag < 15;", (radec_min[0], radec_max[0], radec_min[1], radec_max[1], starid))
+				for row in cursor.fetchall():
+					# Calculate the position of this star on the CCD using the WCS:
+					ra_dec = np.atleast_2d([row['ra'], row['decl']])
+					x, y = wcs.all_world2pix(ra_dec, 0)[0]
+
+					# If the target falls outside silicon, do not add it to the todo list:
+					# The reason for the strange 0.5's is that pixel centers are at integers.
+					if x < -0.5 or y < -0.5 or x > image_shape[1]-0.5 or y > image_shape[0]-0.5:
+						continue
+
+					# Add this secondary target to the list:
+					# Note that we are storing the starid of the target
+					# in which target pixel file the target can be found.
+					logger.debug("Adding extra target: TIC %d", row['starid'])
+					cat_tmp.append({
+						'starid': row['starid'],
+						'sector': sector,
+						'camera': camera,
+						'ccd': ccd,
+						'datasource': 'tpf:' + str(starid),
+						'tmag': row['tmag'],
+						'cbv_area': cbv_area
+					})
+
+		# Close the connection to the catalog SQLite database:
+		cursor.close()
 
 	# TODO: Could we avoid fixed-size strings in datasource column?
 	return Table(
@@ -232,6 +385,135 @@ def _tpf_todo(fname, input_folder=None, cameras=None, ccds=None, find_secondary_
 		dtype=('int64', 'int32', 'int32', 'int32', 'S256', 'float32', 'int32')
 	)
 
+#------------------------------------------------------------------------------
+def predicted_aperture_radius(tmag, radius_ref=2.0, tmag_ref=10.0, radius_min=1.5):
+	"""
+	Rough prediction of the radius of the aperture of a star of a given magnitude.
+
+	The aperture is found by thresholding the image, so its size is set by where the
+	wings of the PSF of the star drop below the threshold. Assuming the wings of the
+	PSF fall off as :math:`r^{-3}`, the radius scales with the flux as :math:`F^{1/3}`.
+
+	Parameters:
+		tmag (float or ndarray): Magnitude in TESS band.
+		radius_ref (float, optional): Radius in pixels of a star of magnitude ``tmag_ref``. Default=2.
+		tmag_ref (float, optional): Reference magnitude. Default=10.
+		radius_min (float, optional): Minimum radius in pixels. Default=1.5.
+
+	Returns:
+		float or ndarray: Radius of aperture in pixels.
+	"""
+	radius = radius_ref * 10**(-0.4*(np.asarray(tmag) - tmag_ref)/3)
+	return np.maximum(radius, radius_min)
+
+#------------------------------------------------------------------------------
+def predict_skipped_targets(todo_file, input_folder=None, radius_scale=1.0, min_dmag=0.0):
+	"""
+	Predict which targets are going to be marked as SKIPPED.
+
+	A target is marked as SKIPPED when it falls within the aperture of a brighter
+	target (see :py:meth:`photometry.TaskManager.save_result`). For each sector, camera,
+	CCD and datasource in the TODO-file, the targets are gone through from the brightest
+	to the faintest, and fainter targets within the predicted aperture radius (see
+	:py:func:`predicted_aperture_radius`) of a target which is not itself predicted to be
+	skipped, are predicted to be skipped by that target.
+
+	The predictions are stored in the table ``skip_predictions`` in the TODO-file, which is
+	used by the :py:class:`photometry.TaskManager` to either defer or skip these targets
+	up front. Secondary targets in Target Pixel Files are not considered.
+
+	Parameters:
+		todo_file (string): Path to the TODO-file.
+		input_folder (string, optional): Input folder where the catalog files are found.
+			If ``None``, the folder of the TODO-file is used.
+		radius_scale (float, optional): Scaling of the predicted aperture radius. Default=1.
+		min_dmag (float, optional): Minimum difference in magnitude between the two targets. Default=0.
+
+	Returns:
+		int: Number of targets predicted to be skipped.
+	"""
+
+	logger = logging.getLogger(__name__)
+
+	if input_folder is None:
+		input_folder = os.path.dirname(os.path.abspath(todo_file))
+
+	# Size of TESS pixels in degrees:
+	pixel_scale = 21.0/3600.0
+
+	with contextlib.closing(sqlite3.connect(todo_file)) as conn:
+		conn.row_factory = sqlite3.Row
+		cursor = conn.cursor()
+
+		predictions = []
+		cursor.execute("SELECT DISTINCT sector,camera,ccd,datasource FROM todolist WHERE datasource NOT LIKE 'tpf:%';")
+		for group in cursor.fetchall():
+			sector, camera, ccd, datasource = tuple(group)
+			cursor.execute("SELECT priority,starid,tmag FROM todolist WHERE sector=? AND camera=? AND ccd=? AND datasource=? ORDER BY tmag;", (sector, camera, ccd, datasource))
+			targets = cursor.fetchall()
+			if len(targets) < 2:
+				continue
+
+			catalog_file = find_catalog_files(input_folder, sector=sector, camera=camera, ccd=ccd)
+			if len(catalog_file) != 1:
+				logger.warning("Catalog file not found: SECTOR=%s, CAMERA=%s, CCD=%s", sector, camera, ccd)
+				continue
+
+			# Load the positions of the targets from the catalog,
+			# in chunks to stay below the SQLite limit on number of variables:
+			positions = {}
+			with contextlib.closing(sqlite3.connect(catalog_file[0])) as catconn:
+				catcursor = catconn.cursor()
+				starids = list(set([row['starid'] for row in targets]))
+				for k in range(0, len(starids), 500):
+					chunk = starids[k:k+500]
+					catcursor.execute("SELECT starid,ra,decl FROM catalog WHERE starid IN (" + ','.join(['?']*len(chunk)) + ");", chunk)
+					for starid, ra, dec in catcursor.fetchall():
+						positions[starid] = (ra, dec)
+				catcursor.close()
+
+			targets = [row for row in targets if row['starid'] in positions]
+			if len(targets) < 2:
+				continue
+
+			# Positions as unit vectors, so distances can be found using a KD-tree:
+			radec = np.radians([positions[row['starid']] for row in targets])
+			xyz = np.column_stack((
+				np.cos(radec[:,1]) * np.cos(radec[:,0]),
+				np.cos(radec[:,1]) * np.sin(radec[:,0]),
+				np.sin(radec[:,1])
+			))
+			tree = cKDTree(xyz)
+			tmag = np.array([row['tmag'] for row in targets])
+			radius = np.radians(radius_scale * predicted_aperture_radius(tmag) * pixel_scale)
+			chord = 2*np.sin(radius/2)
+
+			# Go through the targets from the brightest to the faintest:
+			skipped = np.zeros(len(targets), dtype='bool')
+			for k in range(len(targets)):
+				if skipped[k]:
+					continue
+				for j in tree.query_ball_point(xyz[k], chord[k]):
+					if not skipped[j] and tmag[j] - tmag[k] > min_dmag:
+						skipped[j] = True
+						predictions.append((targets[j]['priority'], targets[k]['priority']))
+
+		cursor.execute("DROP TABLE IF EXISTS skip_predictions;")
+		cursor.execute("""CREATE TABLE skip_predictions (
+			priority INT NOT NULL,
+			skipped_by INT NOT NULL,
+			FOREIGN KEY (priority) REFERENCES todolist(priority) ON DELETE CASCADE ON UPDATE CASCADE,
+			FOREIGN KEY (skipped_by) REFERENCES todolist(priority) ON DELETE CASCADE ON UPDATE CASCADE
+		);""")
+		cursor.executemany("INSERT INTO skip_predictions (priority,skipped_by) VALUES (?,?);", predictions)
+		cursor.execute("CREATE UNIQUE INDEX skip_predictions_priority_idx ON skip_predictions (priority);")
+		cursor.execute("CREATE INDEX skip_predictions_skipped_by_idx ON skip_predictions (skipped_by);")
+		conn.commit()
+		cursor.close()
+
+	logger.info("Number of targets predicted to be skipped: %d", len(predictions))
+	return len(predictions)
+
 #------------------------------------------------------------------------------
 def make_todo(input_folder=None, cameras=None, ccds=None, overwrite=False):
 	"""
@@ -295,9 +577,21 @@ def make_todo(input_folder=None, cameras=None, ccds=None, overwrite=False):
 	logger.info("Number of TPF files: %d", len(tpf_files))
 
 	if len(tpf_files) > 0:
+		# Read the headers of all the TPF files, using the cached file index
+		# for the files that have already been seen before:
+		index = tpf_file_index(input_folder, tpf_files, threads=threads_max)
+
+		# Group the TPF files by sector, camera and CCD, so each catalog
+		# only has to be opened once:
+		groups = {}
+		for entry in index:
+			if entry['camera'] in cameras and entry['ccd'] in ccds:
+				groups.setdefault((entry['sector'], entry['camera'], entry['ccd']), []).append(entry)
+		inputs = [(entries, input_folder, False, exclude) for entries in groups.values()]
+
 		# Open a pool of workers:
 		logger.info("Starting pool of workers for TPFs...")
-		threads = min(threads_max, len(tpf_files)) # No reason to use more than the number of jobs in total
+		threads = min(threads_max, len(inputs)) # No reason to use more than the number of jobs in total
 		logger.info("Using %d processes.", threads)
 
 		if threads > 1:
@@ -308,8 +602,7 @@ def make_todo(input_folder=None, cameras=None, ccds=None, overwrite=False):
 
 		# Run the TPF files in parallel:
 		tic = default_timer()
-		_tpf_todo_wrapper = functools.partial(_tpf_todo, input_folder=input_folder, cameras=cameras, ccds=ccds, find_secondary_targets=False, exclude=exclude)
-		for cat2 in m(_tpf_todo_wrapper, tpf_files):
+		for cat2 in m(_tpf_todo_wrapper, inputs):
 			cat = vstack([cat, cat2], join_type='exact')
 
 		if threads > 1:
@@ -459,4 +752,7 @@ def make_todo(input_folder=None, cameras=None, ccds=None, overwrite=False):
 		# Close connection:
 		cursor.close()
 
+	# Predict which targets are going to be skipped because of brighter neighbours:
+	predict_skipped_targets(todo_file, input_folder)
+
 	logger.info("TODO done.")
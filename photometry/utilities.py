@@ -17,10 +17,12 @@ from scipy.special import erf
 from scipy.stats import binned_statistic
 import json
 import os.path
+import gzip
 import fnmatch
 import glob
 import itertools
 import warnings
+import multiprocessing
 
 # Filter out annoying warnings:
 warnings.filterwarnings('ignore', module='scipy', category=FutureWarning, message='Using a non-tuple sequence for multidimensional indexing is deprecated;', lineno=607)
@@ -28,6 +30,9 @@ warnings.filterwarnings('ignore', module='scipy', category=FutureWarning, messag
 # Constants:
 mad_to_sigma = 1.482602218505602 # Constant is 1/norm.ppf(3/4)
 
+# Function and arguments being run by fork_map, inherited by the forked processes:
+_fork_tasks = None
+
 #------------------------------------------------------------------------------
 def load_settings(sector=None):
 
@@ -227,6 +232,66 @@ def load_ffi_fits(path, return_header=False, return_uncert=False):
 	else:
 		return img
 
+#------------------------------------------------------------------------------
+def read_fits_headers(path, extensions=(0,)):
+	"""
+	Read headers from a FITS file without loading any of the data.
+
+	Only the 2880-byte header blocks are parsed. The data sections of the
+	extensions are skipped by seeking past them, so this is much faster than
+	opening the file with :py:func:`astropy.io.fits.open`, in particular for
+	GZIP compressed files where the data would otherwise have to be decompressed
+	and kept in memory.
+
+	Parameters:
+		path (string): Path to FITS file. May be GZIP compressed (``.fits.gz``).
+		extensions (iterable of integers, optional): Indicies of the HDUs to return headers for.
+			Default is to only return the primary header.
+
+	Returns:
+		list: List of :py:class:`astropy.io.fits.Header` objects, one for each of the requested extensions.
+
+	Raises:
+		IOError: If the file ended before all the requested headers could be read.
+	"""
+
+	wanted = set(extensions)
+	last_extension = max(wanted)
+	headers = {}
+
+	opener = gzip.open if path.endswith('.gz') else open
+	with opener(path, 'rb') as fid:
+		for ext in range(last_extension+1):
+			# Read blocks until we reach the block containing the END card:
+			blocks = []
+			found_end = False
+			while not found_end:
+				block = fid.read(2880)
+				if len(block) < 2880:
+					raise IOError("Unexpected end of FITS file: '%s'" % path)
+				blocks.append(block)
+				for k in range(0, 2880, 80):
+					if block[k:k+8] == b'END     ':
+						found_end = True
+						break
+
+			header = fits.Header.fromstring(b''.join(blocks).decode('ascii'))
+			if ext in wanted:
+				headers[ext] = header
+
+			# Skip the data section of this HDU:
+			if ext < last_extension:
+				naxis = header.get('NAXIS', 0)
+				if naxis > 0:
+					datasize = 1
+					for n in range(1, naxis+1):
+						datasize *= header['NAXIS%d' % n]
+					datasize = abs(header['BITPIX'])//8 * header.get('GCOUNT', 1) * (header.get('PCOUNT', 0) + datasize)
+					datasize = 2880 * ((datasize + 2879) // 2880)
+					fid.seek(datasize, 1)
+
+	return [headers[ext] for ext in extensions]
+
 #------------------------------------------------------------------------------
 def _move_median_central_1d(x, width_points):
 	y = move_median(x, width_points, min_count=1)
@@ -325,6 +390,50 @@ def mag2flux(mag):
 	"""
 	return 10**(-0.4*(mag - 20.60654144))
 
+#------------------------------------------------------------------------------
+def default_stamp_size(tmag):
+	"""
+	Default size of stamp around a star of a given magnitude.
+
+	Based on lookup tables as a function of TESS magnitude,
+	which are used to select the default stamp for FFIs.
+
+	Parameters:
+		tmag (float or ndarray): Magnitude in TESS band.
+
+	Returns:
+		float or ndarray: Number of rows.
+		float or ndarray: Number of columns.
+
+	See Also:
+		:py:func:`photometry.BasePhotometry.default_stamp`
+	"""
+	# Decide how many pixels to use based on lookup tables as a function of Tmag:
+	tmag_table = np.array([0.0, 0.52631579, 1.05263158, 1.57894737, 2.10526316,
+		2.63157895, 3.15789474, 3.68421053, 4.21052632, 4.73684211,
+		5.26315789, 5.78947368, 6.31578947, 6.84210526, 7.36842105,
+		7.89473684, 8.42105263, 8.94736842, 9.47368421, 10.0, 13.0])
+
+	height = np.array([831.98319063, 533.58494422, 344.0840884, 223.73963332,
+		147.31365728, 98.77856016, 67.95585074, 48.38157414,
+		35.95072974, 28.05639497, 23.043017, 19.85922009,
+		17.83731732, 16.5532873, 15.73785092, 15.21999971,
+		14.89113301, 14.68228285, 14.54965042, 14.46542084, 14.0])
+
+	width = np.array([157.71602062, 125.1238281, 99.99440209, 80.61896267,
+		65.6799962, 54.16166547, 45.28073365, 38.4333048,
+		33.15375951, 28.05639497, 23.043017, 19.85922009,
+		17.83731732, 16.5532873, 15.73785092, 15.21999971,
+		14.89113301, 14.68228285, 14.54965042, 14.46542084, 14.0])
+
+	Ncolumns = np.interp(tmag, tmag_table, width)
+	Nrows = np.interp(tmag, tmag_table, height)
+
+	# Round off and make sure we have minimum 15 pixels:
+	Nrows = np.maximum(np.ceil(Nrows), 15)
+	Ncolumns = np.maximum(np.ceil(Ncolumns), 15)
+	return Nrows, Ncolumns
+
 #------------------------------------------------------------------------------
 def sphere_distance(ra1, dec1, ra2, dec2):
 	"""
@@ -425,4 +534,72 @@ def rms_timescale(time, flux, timescale=3600/86400):
 	flux_bin, _, _ = binned_statistic(time[indx], flux[indx], nanmean, bins=bins)
 
 	# Compute robust RMS value (MAD scaled to RMS)
-	return mad_to_sigma * nanmedian(np.abs(flux_bin - nanmedian(flux_bin)))
\ No newline at end of file
+	return mad_to_sigma * nanmedian(np.abs(flux_bin - nanmedian(flux_bin)))
+
+#------------------------------------------------------------------------------
+def cadence_chunks(Ntimes, chunk_size):
+	"""
+	Split the indices of a timeseries into chunks of consecutive cadences.
+
+	The chunks only depend on the length of the timeseries, and not on the number of
+	processes used to run them, so results computed chunk by chunk are reproducible.
+
+	Parameters:
+		Ntimes (integer): Number of cadences in the timeseries.
+		chunk_size (integer): Number of cadences in each chunk. The last chunk may be shorter.
+
+	Returns:
+		list: Arrays with the indices of the cadences in each chunk.
+	"""
+	chunk_size = max(int(chunk_size), 1)
+	return [np.arange(start, min(start + chunk_size, Ntimes)) for start in range(0, Ntimes, chunk_size)]
+
+#------------------------------------------------------------------------------
+def _run_fork_task(k):
+	func, args = _fork_tasks
+	return func(*args[k])
+
+#------------------------------------------------------------------------------
+def fork_map(func, args, processes=1):
+	"""
+	Call a function with each set of arguments, using several forked processes.
+
+	The function and its arguments are inherited by the forked processes, so only the
+	results have to be pickled. This allows for instance a bound method of a photometry
+	object to be run in parallel on parts of its data, without copying the data.
+
+	Parameters:
+		func (callable): Function to call.
+		args (list): List of tuples of arguments to call the function with.
+		processes (integer, optional): Number of processes to use. Default is to run everything in this process.
+
+	Returns:
+		list: Results of calling the function with each set of arguments, in the same order as ``args``.
+
+	Note:
+		The function is called in this process instead if forking is not possible,
+		for instance on Windows or in daemonic processes, which can not have children.
+	"""
+	global _fork_tasks
+	args = list(args)
+
+	if processes <= 1 or len(args) <= 1 or multiprocessing.current_process().daemon:
+		return [func(*a) for a in args]
+	try:
+		ctx = multiprocessing.get_context('fork')
+	except (AttributeError, ValueError):
+		return [func(*a) for a in args]
+
+	_fork_tasks = (func, args)
+	try:
+		pool = ctx.Pool(min(processes, len(args)))
+		try:
+			results = pool.map(_run_fork_task, range(len(args)), chunksize=1)
+		except:
+			pool.terminate()
+			raise
+		pool.close()
+		pool.join()
+		return results
+	finally:
+		_fork_tasks = None
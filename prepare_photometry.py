@@ -5,6 +5,7 @@ This program will prepare the photometry on individual stars by doing all the op
 * Estimating sky background for all images.
 * Estimating spacecraft jitter.
 * Creating average image.
+* Segmenting the average image into masks of the stars.
 * Restructuring data into HDF5 files for efficient I/O operations.
 
 The program can simply be run like the following, which will create a number of HDF5 files (`\*.hdf5`) in the ``TESSPHOT_INPUT`` directory.
@@ -31,6 +32,7 @@ if __name__ == '__main__':
 	parser.add_argument('-q', '--quiet', help='Only report warnings and errors.', action='store_true')
 	parser.add_argument('--camera', type=int, choices=(1,2,3,4), default=None, help='TESS Camera. Default is to run all cameras.')
 	parser.add_argument('--ccd', type=int, choices=(1,2,3,4), default=None, help='TESS CCD. Default is to run all CCDs.')
+	parser.add_argument('--no-segmentation', help='Do not segment the sum-image into masks.', action='store_true')
 	parser.add_argument('input_folder', type=str, help='TESSPhot input directory to create HDF5 files in.', nargs='?', default=None)
 	args = parser.parse_args()
 
@@ -56,4 +58,4 @@ if __name__ == '__main__':
 		parser.error("The given path does not exist or is not a directory")
 
 	# Run the program for the selected camera/ccd combinations:
-	create_hdf5(args.input_folder, args.camera, args.ccd)
+	create_hdf5(args.input_folder, cameras=args.camera, ccds=args.ccd, segmentation=not args.no_segmentation)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Task server handing out the tasks in a TODO-file to workers connecting over the network.
+
+This is an alternative to :py:func:`mpi_scheduler` for when the number of workers
+changes during the run. Workers (see ``run_worker.py``) can connect and disconnect
+at any time. If a worker disappears, or has not been heard from within the heartbeat
+timeout, the tasks it was working on are given to other workers.
+
+Example:
+	To start the server on port 5555, and a few workers on other nodes:
+
+	>>> python run_taskserver.py --address=0.0.0.0:5555
+	>>> python run_worker.py --server=node01:5555
+
+Example:
+	On a single machine, a Unix socket can be used instead:
+
+	>>> python run_taskserver.py --address=/tmp/tessphot.sock
+	>>> python run_worker.py --server=/tmp/tessphot.sock
+
+Note:
+	There is no authentication of the workers, so the server should only
+	listen on networks where all hosts are trusted.
+"""
+
+from __future__ import with_statement, print_function
+import os
+import argparse
+import logging
+from photometry.taskserver import TaskServer
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+	# Parse command line arguments:
+	parser = argparse.ArgumentParser(description='Hand out tasks from TODO-file to workers connecting over the network.')
+	parser.add_argument('-d', '--debug', help='Print debug messages.', action='store_true')
+	parser.add_argument('-q', '--quiet', help='Only report warnings and errors.', action='store_true')
+	parser.add_argument('-o', '--overwrite', help='Overwrite existing results.', action='store_true')
+	parser.add_argument('--address', type=str, help='Address to listen on. Either "host:port" or the path to a Unix socket.', default='localhost:5555')
+	parser.add_argument('--heartbeat-timeout', type=float, help='Time in seconds without hearing from a worker before its tasks are given to other workers.', default=60.0)
+	parser.add_argument('--keep-running', help='Keep running when all tasks are done.', action='store_true')
+	parser.add_argument('--write-behind', help='Commit results to the TODO-file in batches instead of after every task.', action='store_true')
+	parser.add_argument('--order', help='Order in which to process tasks. "cost" runs the tasks expected to take the longest first.', choices=('priority', 'cost'), default='priority')
+	parser.add_argument('--predicted-skips', help='How to handle targets predicted to be skipped because of a brighter target.', choices=('defer', 'skip'), default=None)
+	parser.add_argument('input_folder', type=str, help='Input directory containing the TODO-file.', nargs='?', default=None)
+	args = parser.parse_args()
+
+	# Set logging level:
+	logging_level = logging.INFO
+	if args.quiet:
+		logging_level = logging.WARNING
+	elif args.debug:
+		logging_level = logging.DEBUG
+
+	# Setup logging:
+	formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+	console = logging.StreamHandler()
+	console.setFormatter(formatter)
+	logger_parent = logging.getLogger('photometry')
+	logger_parent.addHandler(console)
+	logger_parent.setLevel(logging_level)
+
+	# Get input and output folder from environment variables:
+	input_folder = args.input_folder
+	if input_folder is None:
+		input_folder = os.environ.get('TESSPHOT_INPUT', os.path.abspath(os.path.join(os.path.dirname(__file__), 'tests', 'input')))
+	output_folder = os.environ.get('TESSPHOT_OUTPUT', os.path.join(input_folder, 'lightcurves'))
+
+	# Run the server:
+	with TaskServer(input_folder, args.address,
+		heartbeat_timeout=args.heartbeat_timeout,
+		keep_running=args.keep_running,
+		cleanup=True,
+		overwrite=args.overwrite,
+		summary=os.path.join(output_folder, 'summary.json'),
+		write_behind=args.write_behind,
+		order=args.order,
+		predicted_skips=args.predicted_skips) as server:
+		server.run()
@@ -20,8 +20,13 @@ Example:
 
 	>>> python run_tessphot.py --source=tpf --method=psf --plot --starid=182092046
 
+Example:
+	To run all stars in the TODO list using 8 processes on the local machine:
+
+	>>> python run_tessphot.py --all --workers=8
+
 Note:
-	run_tessphot is only meant for small tests and running single stars.
+	run_tessphot is only meant for small tests, running single stars and runs on a single machine.
 	For large scale calculation with many stars, you should use m:py:func:`mpi_scheduler`.
 
 .. codeauthor:: Rasmus Handberg <rasmush@phys.au.dk>
@@ -29,11 +34,166 @@ Note:
 
 from __future__ import with_statement, print_function
 import os
+import sys
 import argparse
 import logging
 import functools
+import signal
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from six.moves import queue
 from timeit import default_timer
-from photometry import tessphot, TaskManager
+from photometry import tessphot, STATUS
+from photometry.shards import open_task_manager
+try:
+	from concurrent.futures.process import BrokenProcessPool
+except ImportError: # pragma: no cover
+	# The backport of concurrent.futures for Python 2 does not detect lost worker processes:
+	BrokenProcessPool = ()
+
+#------------------------------------------------------------------------------
+def _process(task, kwargs):
+	"""Run photometry on a single task in a worker process, and return the result."""
+	# Interrupts are handled by the parent process, which terminates the workers:
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+	result = task.copy()
+	task = dict(task)
+	del task['priority'], task['tmag']
+
+	t1 = default_timer()
+	try:
+		pho = tessphot(**dict(task, **kwargs))
+		status, details = pho.status, pho._details
+	except:
+		# The result must always be sent back, or the parent would wait for it forever:
+		status, details = STATUS.ERROR, {'errors': [traceback.format_exc().strip()]}
+	t2 = default_timer()
+
+	# Construct result message:
+	result.update({
+		'status': status,
+		'time': t2 - t1,
+		'details': details
+	})
+	return result
+
+#------------------------------------------------------------------------------
+def _create_pool(workers):
+	"""Start pool of worker processes, using fork where available so the workers share the already imported modules."""
+	try:
+		return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+	except (TypeError, AttributeError, ValueError):
+		return ProcessPoolExecutor(max_workers=workers)
+
+def _terminate_pool(pool):
+	"""Stop the worker processes of the pool straight away, without waiting for the running tasks."""
+	processes = getattr(pool, '_processes', None) or {}
+	if isinstance(processes, dict):
+		processes = processes.values()
+	processes = list(processes)
+	for p in processes:
+		p.terminate()
+	pool.shutdown(wait=False)
+	for p in processes:
+		p.join()
+
+#------------------------------------------------------------------------------
+def run_parallel(tm, next_task, workers, max_inflight=None, **kwargs):
+	"""
+	Run tasks in a pool of processes on the local machine.
+
+	The TaskManager is only used from the calling process, which hands out tasks to
+	the pool and saves the results as they come back. At most ``max_inflight``
+	tasks are handed to the pool at any time, so targets can still be marked as
+	SKIPPED before they are started. If interrupted (e.g. by Ctrl-C), the pool is
+	terminated and the tasks still running are marked as ABORT in the TODO-file.
+
+	If a worker process is lost, for instance because it was killed by the system for
+	using too much memory, the tasks in the pool at the time are marked as ERROR,
+	and the remaining tasks are run in a new pool.
+
+	Parameters:
+		tm (:py:class:`photometry.TaskManager`): TaskManager of the TODO-file.
+		next_task (callable): Function returning the next task to run, or ``None`` if there are no more tasks.
+		workers (integer): Number of worker processes.
+		max_inflight (integer, optional): Maximum number of tasks handed to the pool at once. Default is twice the number of workers.
+		**kwargs: Keyword-arguments passed on to :py:func:`photometry.tessphot`.
+
+	Returns:
+		integer: Number of tasks processed.
+	"""
+	logger = logging.getLogger(__name__)
+	if max_inflight is None:
+		max_inflight = 2*workers
+
+	done = queue.Queue()
+	inflight = {}
+	numtasks = 0
+	pool = _create_pool(workers)
+	try:
+		while True:
+			# Keep the pool fed with tasks:
+			while len(inflight) < max_inflight:
+				task = next_task()
+				if task is None: break
+				tm.start_task(task['priority'])
+				future = pool.submit(_process, task, kwargs)
+				inflight[task['priority']] = (task, default_timer())
+				future.priority = task['priority']
+				future.pool = pool
+				future.add_done_callback(done.put)
+
+			if not inflight:
+				break
+
+			# Wait for a result to come back (polling to allow interrupts in Python 2):
+			try:
+				future = done.get(timeout=1.0)
+			except queue.Empty:
+				continue
+			task, t1 = inflight.pop(future.priority)
+			try:
+				result = future.result()
+			except Exception as e:
+				# The result never came back, because the worker process running it was
+				# lost or the result could not be sent back to this process:
+				logger.error("Task %d failed in the pool: %r", task['priority'], e)
+				result = task.copy()
+				result.update({
+					'status': STATUS.ERROR,
+					'time': default_timer() - t1,
+					'details': {'errors': ["Task failed in the pool of worker processes: %r" % e]}
+				})
+
+				# A pool which has lost a worker can not be used any more, so start a new one.
+				# The other tasks in the broken pool will all come back with the same error:
+				if isinstance(e, BrokenProcessPool) and future.pool is pool:
+					logger.warning("Worker process was lost. Starting new pool.")
+					pool.shutdown(wait=False)
+					pool = _create_pool(workers)
+
+			tm.save_result(result)
+			numtasks += 1
+
+	except KeyboardInterrupt:
+		logger.warning("Interrupted. Stopping %d running tasks.", len(inflight))
+		_terminate_pool(pool)
+		for task, t1 in inflight.values():
+			result = task.copy()
+			result.update({
+				'status': STATUS.ABORT,
+				'time': default_timer() - t1,
+				'details': {}
+			})
+			tm.save_result(result)
+		raise
+
+	finally:
+		_terminate_pool(pool)
+
+	return numtasks
 
 #------------------------------------------------------------------------------
 if __name__ == '__main__':
@@ -49,6 +209,9 @@ if __name__ == '__main__':
 	parser.add_argument('-r', '--random', help='Run on random target from TODO-list.', action='store_true')
 	parser.add_argument('-t', '--test', help='Use test data and ignore TESSPHOT_INPUT environment variable.', action='store_true')
 	parser.add_argument('--all', help='Run all stars, one by one. Please consider using the MPI program instead.', action='store_true')
+	parser.add_argument('--workers', type=int, help='Number of processes to run in parallel on this machine when running all stars.', default=1)
+	parser.add_argument('--predicted-skips', help='How to handle targets predicted to be skipped because of a brighter target.', choices=('defer', 'skip'), default=None)
+	parser.add_argument('--secondary-targets', help='Also extract lightcurves of the other targets in the stamp of each target using aperture photometry.', action='store_true')
 	parser.add_argument('--starid', type=int, help='TIC identifier of target.', nargs='?', default=None)
 	parser.add_argument('input_folder', type=str, help='Directory to create catalog files in.', nargs='?', default=None)
 	args = parser.parse_args()
@@ -56,6 +219,10 @@ if __name__ == '__main__':
 	# Make sure at least one setting is given:
 	if not args.all and args.starid is None and not args.random:
 		parser.error("Please select either a specific STARID or RANDOM.")
+	if args.workers < 1:
+		parser.error("The number of WORKERS must be at least one.")
+	if args.workers > 1 and not args.all:
+		parser.error("Multiple WORKERS can only be used together with ALL.")
 
 	# Set logging level:
 	logging_level = logging.INFO
@@ -90,43 +257,58 @@ if __name__ == '__main__':
 	logger.info("Putting output data in '%s'", output_folder)
 
 	# Create partial function of tessphot, setting the common keywords:
-	f = functools.partial(tessphot, input_folder=input_folder, output_folder=output_folder, plot=args.plot)
+	f = functools.partial(tessphot, input_folder=input_folder, output_folder=output_folder, plot=args.plot, secondary_targets=args.secondary_targets)
 
 	# Run the program:
-	with TaskManager(input_folder, overwrite=args.overwrite) as tm:
-		while True:
-			if args.all and args.random:
-				task = tm.get_random_task()
-				if task is None: break
-				if args.method: task['method'] = args.method
-				if args.source: task['datasource'] = args.source
-			elif args.all:
-				task = tm.get_task()
-				if task is None: break
-				if args.method: task['method'] = args.method
-				if args.source: task['datasource'] = args.source
-			elif args.starid is not None:
-				task = tm.get_task(starid=args.starid)
-				if task is None: parser.error("The STARID '%d' was not found in TODOLIST." % args.starid)
-				if args.method: task['method'] = args.method
-				if args.source: task['datasource'] = args.source
-			elif args.random:
-				task = tm.get_random_task()
+	with open_task_manager(input_folder, overwrite=args.overwrite, predicted_skips=args.predicted_skips) as tm:
+		if args.workers > 1:
+			def next_task():
+				task = tm.get_random_task() if args.random else tm.get_task()
+				if task is not None:
+					if args.method: task['method'] = args.method
+					if args.source: task['datasource'] = args.source
+				return task
 
-			result = task.copy()
-			del task['priority'], task['tmag']
+			try:
+				numtasks = run_parallel(tm, next_task, args.workers, input_folder=input_folder, output_folder=output_folder, plot=args.plot, secondary_targets=args.secondary_targets)
+			except KeyboardInterrupt:
+				sys.exit(130)
+			logger.info("Processed %d tasks using %d workers", numtasks, args.workers)
 
-			t1 = default_timer()
-			pho = f(**task)
-			t2 = default_timer()
+		else:
+			while True:
+				if args.all and args.random:
+					task = tm.get_random_task()
+					if task is None: break
+					if args.method: task['method'] = args.method
+					if args.source: task['datasource'] = args.source
+				elif args.all:
+					task = tm.get_task()
+					if task is None: break
+					if args.method: task['method'] = args.method
+					if args.source: task['datasource'] = args.source
+				elif args.starid is not None:
+					task = tm.get_task(starid=args.starid)
+					if task is None: parser.error("The STARID '%d' was not found in TODOLIST." % args.starid)
+					if args.method: task['method'] = args.method
+					if args.source: task['datasource'] = args.source
+				elif args.random:
+					task = tm.get_random_task()
 
-			# Construct result message:
-			result.update({
-				'status': pho.status,
-				'time': t2 - t1,
-				'details': pho._details
-			})
-			tm.save_result(result)
+				result = task.copy()
+				del task['priority'], task['tmag']
 
-			if not args.all:
-				break
+				t1 = default_timer()
+				pho = f(**task)
+				t2 = default_timer()
+
+				# Construct result message:
+				result.update({
+					'status': pho.status,
+					'time': t2 - t1,
+					'details': pho._details
+				})
+				tm.save_result(result)
+
+				if not args.all:
+					break
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Worker which claims tasks directly from the TODO-file, or from a task server, and processes them.
+
+Any number of workers can be started, at any time and independently of each other,
+on the same TODO-file. Each worker atomically claims the next task from the TODO-file,
+processes it and records the result itself, so no master process or MPI is needed.
+This makes it possible to use idle cores for a run, and to stop and restart workers
+without restarting the whole run.
+
+Claims on tasks expire after a while (see ``--lease``), after which other workers may
+take over the task. This ensures that tasks claimed by workers which were killed
+are eventually processed. While a task is running, the worker renews its claim in the
+background (see ``--renew-interval``), so tasks taking longer than the lease are not
+processed twice. A worker restarted with the same ``--worker-id``
+will immediately release the tasks claimed by its previous incarnation.
+
+Example:
+	To start four workers in the background on the TODO-file in the directory
+	defined in the ``TESSPHOT_INPUT`` environment variable:
+
+	>>> for i in 1 2 3 4; do python run_worker.py --worker-id=worker$i & done
+
+Example:
+	Instead of working on the TODO-file directly, workers can get their tasks from a
+	task server (see ``run_taskserver.py``), which works across nodes without shared
+	file locking. Workers can connect to the server at any time:
+
+	>>> python run_worker.py --server=node01:5555
+
+Note:
+	The TODO-file must be on a filesystem with working file locking,
+	since the workers rely on SQLite for coordinating the access to it.
+	This does not apply when using a task server.
+"""
+
+from __future__ import with_statement, print_function
+import os
+import argparse
+import logging
+import threading
+from timeit import default_timer
+from photometry import tessphot, STATUS
+from photometry.shards import open_task_manager
+from photometry.taskserver import TaskClient
+
+#------------------------------------------------------------------------------
+def renew_claim(tasks, priority, lease, interval, stop):
+	"""
+	Renew the claim on a task every ``interval`` seconds, until ``stop`` is set.
+
+	Parameters:
+		tasks (:py:class:`photometry.TaskManager`): TaskManager holding the claim.
+		priority (int): Priority of the task.
+		lease (float): Number of seconds the claim is extended by every time.
+		interval (float): Number of seconds between renewals.
+		stop (:py:class:`threading.Event`): Event signalling that the task is done.
+	"""
+	logger = logging.getLogger(__name__)
+	while not stop.wait(interval):
+		try:
+			if not tasks.renew_claim(priority, lease=lease):
+				logger.warning("Claim on task %d was taken over by another worker", priority)
+				break
+		except:
+			logger.exception("Could not renew claim on task %d", priority)
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+	# Parse command line arguments:
+	parser = argparse.ArgumentParser(description='Run TESS Photometry by claiming tasks directly from the TODO-file.')
+	parser.add_argument('-d', '--debug', help='Print debug messages.', action='store_true')
+	parser.add_argument('-q', '--quiet', help='Only report warnings and errors.', action='store_true')
+	parser.add_argument('-p', '--plot', help='Save plots when running.', action='store_true')
+	parser.add_argument('--worker-id', type=str, help='Identifier of the worker. Default is the hostname and process ID.', default=None)
+	parser.add_argument('--lease', type=float, help='Time in seconds before a claim on a task expires, and the task may be taken over by another worker.', default=3600.0)
+	parser.add_argument('--renew-interval', type=float, help='Time in seconds between renewals of the claim on the running task. Default is a quarter of the lease.', default=None)
+	parser.add_argument('--max-tasks', type=int, help='Stop after processing this number of tasks.', default=None)
+	parser.add_argument('--server', type=str, help='Get tasks from the task server at this address ("host:port" or path to Unix socket) instead of from the TODO-file.', default=None)
+	parser.add_argument('--heartbeat-interval', type=float, help='Time in seconds between heartbeats sent to the task server.', default=20.0)
+	parser.add_argument('--secondary-targets', help='Also extract lightcurves of the other targets in the stamp of each target using aperture photometry.', action='store_true')
+	parser.add_argument('--predicted-skips', help='How to handle targets predicted to be skipped because of a brighter target.', choices=('defer', 'skip'), default=None)
+	parser.add_argument('input_folder', type=str, help='Input directory containing the TODO-file.', nargs='?', default=None)
+	args = parser.parse_args()
+
+	# Set logging level:
+	logging_level = logging.INFO
+	if args.quiet:
+		logging_level = logging.WARNING
+	elif args.debug:
+		logging_level = logging.DEBUG
+
+	# Setup logging:
+	formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+	console = logging.StreamHandler()
+	console.setFormatter(formatter)
+	logger = logging.getLogger(__name__)
+	logger.addHandler(console)
+	logger.setLevel(logging_level)
+	logger_parent = logging.getLogger('photometry')
+	logger_parent.addHandler(console)
+	logger_parent.setLevel(logging_level)
+
+	# Get input and output folder from environment variables:
+	input_folder = args.input_folder
+	if input_folder is None:
+		input_folder = os.environ.get('TESSPHOT_INPUT', os.path.abspath(os.path.join(os.path.dirname(__file__), 'tests', 'input')))
+	output_folder = os.environ.get('TESSPHOT_OUTPUT', os.path.join(input_folder, 'lightcurves'))
+
+	# Run the program:
+	numtasks = 0
+	renew_interval = args.renew_interval if args.renew_interval else args.lease/4
+	if args.server:
+		tasks = TaskClient(args.server, heartbeat_interval=args.heartbeat_interval)
+		logger.info("Worker connected to task server %s", args.server)
+		get_task = tasks.get_task
+	else:
+		tasks = open_task_manager(input_folder, shared=True, worker_id=args.worker_id, predicted_skips=args.predicted_skips)
+		logger.info("Worker %s starting", tasks.worker_id)
+		get_task = lambda: tasks.claim_task(lease=args.lease)
+
+	with tasks:
+		while args.max_tasks is None or numtasks < args.max_tasks:
+			task = get_task()
+			if task is None:
+				break
+
+			result = task.copy()
+			del task['priority'], task['tmag']
+
+			# Keep the claim on the task while it is running.
+			# The task server is kept informed by the heartbeats of the client instead:
+			stop_renewing = threading.Event()
+			renewer = None
+			if not args.server:
+				renewer = threading.Thread(target=renew_claim, args=(tasks, result['priority'], args.lease, renew_interval, stop_renewing))
+				renewer.daemon = True
+				renewer.start()
+
+			t1 = default_timer()
+			try:
+				pho = tessphot(input_folder=input_folder, output_folder=output_folder, plot=args.plot, secondary_targets=args.secondary_targets, **task)
+			except:
+				# Give the task back so it can be claimed again straight away.
+				# The task server does this by itself when the connection is closed.
+				if renewer is not None:
+					stop_renewing.set()
+					renewer.join()
+					tasks.requeue_task(result['priority'])
+				raise
+			t2 = default_timer()
+
+			# Stop renewing before using the TaskManager from this thread again:
+			if renewer is not None:
+				stop_renewing.set()
+				renewer.join()
+
+			# Construct result message:
+			result.update({
+				'status': pho.status,
+				'time': t2 - t1,
+				'details': pho._details
+			})
+			if not tasks.save_result(result):
+				logger.warning("Result of task %d was discarded, since the task was taken over by another worker", result['priority'])
+			numtasks += 1
+
+			# The photometry was stopped by the user or the system:
+			if pho.status == STATUS.ABORT:
+				break
+
+	logger.info("Worker processed %d tasks", numtasks)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helper functions shared between the tests of the TODO-files and task managers.
+"""
+
+from __future__ import division, print_function, with_statement, absolute_import
+import os.path
+import sqlite3
+import contextlib
+from photometry import STATUS
+
+#----------------------------------------------------------------------
+def make_todo_file(folder, targets):
+	"""
+	Create small TODO-file in folder, with the given targets.
+
+	Parameters:
+		folder (string): Folder to create ``todo.sqlite`` in.
+		targets (list): List of tuples with (priority, starid, datasource, camera, ccd, tmag).
+
+	Returns:
+		string: Path to the created TODO-file.
+	"""
+	todo_file = os.path.join(folder, 'todo.sqlite')
+	with contextlib.closing(sqlite3.connect(todo_file)) as conn:
+		cursor = conn.cursor()
+		cursor.execute("""CREATE TABLE todolist (
+			priority BIGINT NOT NULL,
+			starid BIGINT NOT NULL,
+			sector INT NOT NULL,
+			datasource TEXT NOT NULL DEFAULT 'ffi',
+			camera INT NOT NULL,
+			ccd INT NOT NULL,
+			method TEXT DEFAULT NULL,
+			tmag REAL,
+			status INT DEFAULT NULL,
+			cbv_area INT NOT NULL
+		);""")
+		for priority, starid, datasource, camera, ccd, tmag in targets:
+			cursor.execute("INSERT INTO todolist (priority,starid,sector,datasource,camera,ccd,tmag,cbv_area) VALUES (?,?,1,?,?,?,?,?);", (
+				priority, starid, datasource, camera, ccd, tmag, camera*100 + ccd*10 + 1
+			))
+		conn.commit()
+		cursor.close()
+	return todo_file
+
+#----------------------------------------------------------------------
+def make_result(task, status=STATUS.OK, **details):
+	"""Construct result of a task, as returned by the workers."""
+	result = task.copy()
+	result.update({
+		'status': status,
+		'time': 1.0,
+		'details': details
+	})
+	return result
+
+#----------------------------------------------------------------------
+def add_skip_predictions(todo_file, pairs):
+	"""Add predictions of skipped targets, as (priority, skipped_by) tuples, to TODO-file."""
+	with contextlib.closing(sqlite3.connect(todo_file)) as conn:
+		cursor = conn.cursor()
+		cursor.execute("CREATE TABLE skip_predictions (priority INT NOT NULL, skipped_by INT NOT NULL);")
+		cursor.executemany("INSERT INTO skip_predictions (priority,skipped_by) VALUES (?,?);", pairs)
+		conn.commit()
+		cursor.close()
+
+#----------------------------------------------------------------------
+def count_status(todo_file, status):
+	"""Count targets with given status, as seen by an independent connection."""
+	with contextlib.closing(sqlite3.connect(todo_file)) as conn:
+		cursor = conn.cursor()
+		cursor.execute("SELECT COUNT(*) FROM todolist WHERE status=?;", (status.value, ))
+		return cursor.fetchone()[0]
@@ -17,6 +17,9 @@ except ImportError:
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from photometry import AperturePhotometry, STATUS
 from photometry.plots import plot_image, plt
+from photometry.AperturePhotometry.photometry import extract_lightcurve, predict_stamp_size, segment_sumimage, default_k2p2_settings
+from bottleneck import allnan
+from astropy.table import Table
 
 INPUT_DIR = os.path.join(os.path.dirname(__file__), 'input')
 DUMMY_TARGET = 260795451
@@ -69,6 +72,193 @@ def test_aperturephotometry_plots():
 		np.testing.assert_allclose(pho_noplot.lightcurve['flux'], pho_plot.lightcurve['flux'], equal_nan=True)
 
 
+def _extract_lightcurve_loop(images, images_err, backgrounds, mask, members):
+	# Extraction of the lightcurve one image at a time, as it was done before
+	# it was vectorised, to compare against:
+	N = images.shape[2]
+	flux = np.empty(N)
+	flux_err = np.empty(N)
+	flux_background = np.empty(N)
+	pos_centroid = np.empty((N, 2))
+	for k in range(N):
+		img = images[:, :, k]
+		imgerr = images_err[:, :, k]
+		bck = backgrounds[:, :, k]
+		flux_in_cluster = img[mask]
+		if allnan(flux_in_cluster) or np.all(flux_in_cluster == 0):
+			flux[k] = np.nan
+			flux_err[k] = np.nan
+			pos_centroid[k, :] = np.nan
+		else:
+			flux[k] = np.sum(flux_in_cluster)
+			flux_err[k] = np.sqrt(np.sum(imgerr[mask]**2))
+			finite_vals = (flux_in_cluster > 0)
+			if np.any(finite_vals):
+				pos_centroid[k, :] = np.average(members[finite_vals], weights=flux_in_cluster[finite_vals], axis=0)
+			else:
+				pos_centroid[k, :] = np.nan
+		if allnan(bck[mask]):
+			flux_background[k] = np.nan
+		else:
+			flux_background[k] = np.nansum(bck[mask])
+	return flux, flux_err, flux_background, pos_centroid
+
+def test_extract_lightcurve():
+
+	np.random.seed(42)
+	images = np.random.normal(100, 50, size=(15, 12, 40)).astype('float32')
+	images_err = np.abs(np.random.normal(5, 1, size=images.shape)).astype('float32')
+	backgrounds = np.random.normal(10, 2, size=images.shape).astype('float32')
+
+	# Special cases in the pixels of the mask:
+	mask = np.zeros((15, 12), dtype='bool')
+	mask[4:9, 3:7] = True
+	images[mask, 1] = np.nan # All NaN
+	images[mask, 2] = 0 # All zero
+	images[mask, 3] = -10 # All negative
+	images[6, 4, 4] = np.nan # Single NaN
+	images[mask, 5] = 0 # Zero apart from a single pixel
+	images[5, 5, 5] = 42
+	images_err[7, 5, 6] = np.nan # NaN uncertainty
+	backgrounds[mask, 7] = np.nan # All NaN background
+	backgrounds[4, 4, 8] = np.nan # Single NaN in background
+
+	cols, rows = np.meshgrid(np.arange(12), np.arange(15))
+	members = np.column_stack((cols[mask], rows[mask]))
+
+	for msk in (mask, np.zeros_like(mask)):
+		mem = members if msk is mask else np.zeros((0, 2))
+		expected = _extract_lightcurve_loop(images, images_err, backgrounds, msk, mem)
+		result = extract_lightcurve(images, images_err, backgrounds, msk, mem)
+		for r, e in zip(result, expected):
+			assert r.shape == e.shape
+			np.testing.assert_array_equal(np.isnan(r), np.isnan(e))
+			np.testing.assert_allclose(r, e, rtol=1e-7, equal_nan=True)
+
+	# The special cases should give what we expect:
+	flux, flux_err, flux_background, pos_centroid = extract_lightcurve(images, images_err, backgrounds, mask, members)
+	assert np.all(np.isnan(flux[[1, 2, 4]]))
+	assert flux[3] == -10*np.sum(mask)
+	assert np.all(np.isnan(pos_centroid[[1, 2, 3], :]))
+	assert np.all(np.isfinite(pos_centroid[4, :]))
+	np.testing.assert_allclose(pos_centroid[5, :], [5, 5])
+	assert np.isnan(flux_err[6]) and np.isfinite(flux[6])
+	assert np.isnan(flux_background[7]) and np.isfinite(flux_background[8])
+
+#----------------------------------------------------------------------
+def test_predict_stamp_size():
+	rng = np.random.RandomState(42)
+	sumimage = np.abs(rng.normal(10, 1, size=(200, 300)))
+	rows, cols = np.mgrid[:200, :300]
+
+	# A faint star should keep the default stamp:
+	img = sumimage + 5*np.exp(-0.5*((rows - 100)**2 + (cols - 150)**2))
+	assert predict_stamp_size(img, 100, 150, 15, 15) == (15, 15)
+
+	# A bright star with a long bleed column should get a stamp containing all of it:
+	img = sumimage + 1e5*np.exp(-0.5*((rows - 100)**2/20**2 + (cols - 150)**2/2**2))
+	above = (img > 15)
+	Nrows, Ncolumns = predict_stamp_size(img, 100.3, 149.8, 15, 15, grow=100)
+	assert Nrows//2 > np.max(np.abs(rows[above] - 100))
+	assert Ncolumns//2 > np.max(np.abs(cols[above] - 150))
+	assert Ncolumns < 40 < Nrows
+
+	# But the stamp is only allowed to grow so far:
+	assert predict_stamp_size(img, 100, 150, 15, 15, grow=10)[0] == 2*(7+10+1)+1
+
+	# Target near the edge of the image, and a sum-image without any flux:
+	assert predict_stamp_size(img, 0, 0, 15, 15) == (15, 15)
+	assert predict_stamp_size(np.full((200, 300), np.nan), 100, 150, 15, 15) == (15, 15)
+
+#----------------------------------------------------------------------
+def test_segment_sumimage():
+	rng = np.random.RandomState(42)
+	sumimage = rng.normal(100, 5, size=(150, 200))
+	rows, cols = np.mgrid[:150, :200]
+
+	# Stars on a grid, including some right on the borders between tiles:
+	positions = [(r + rng.uniform(-1, 1), c + rng.uniform(-1, 1)) for r in (10, 32, 64, 95, 128) for c in (12, 40, 64, 100, 128, 170)]
+	for r, c in positions:
+		sumimage += 1e4*np.exp(-0.5*((rows - r)**2 + (cols - c)**2)/1.2**2)
+	starids = np.arange(1, len(positions)+1)
+	catalog = np.array([(c, r, 10) for r, c in positions])
+
+	# Watershed segmentation is not needed for stars this far apart, and a higher
+	# threshold avoids masks of pure noise:
+	k2p2_settings = dict(default_k2p2_settings, segmentation=False, thresh=3)
+	labels, star_table, bbox = segment_sumimage(sumimage, starids, catalog, tile_size=64, overlap=16, k2p2_settings=k2p2_settings)
+
+	# Every star should have its own mask, also stars across the borders between tiles:
+	assert labels.shape == sumimage.shape
+	np.testing.assert_array_equal(np.sort(star_table[:, 0]), starids)
+	assert len(np.unique(star_table[:, 1])) == len(positions)
+	assert np.max(labels) == len(bbox)
+	for starid, label in star_table:
+		r, c = positions[starid-1]
+		mask = (labels == label)
+		assert mask[int(np.round(r)), int(np.round(c))]
+		assert np.sum(mask) >= 9
+		assert np.max(np.hypot(rows[mask] - r, cols[mask] - c)) < 8
+
+		# The bounding box should contain the mask:
+		r1, r2, c1, c2 = bbox[label-1]
+		assert np.sum(mask[r1:r2, c1:c2]) == np.sum(mask)
+		assert np.any(mask[r1, :]) and np.any(mask[r2-1, :]) and np.any(mask[:, c1]) and np.any(mask[:, c2-1])
+
+	# Running in parallel should give the same result:
+	labels2, star_table2, bbox2 = segment_sumimage(sumimage, starids, catalog, tile_size=64, overlap=16, threads=2, k2p2_settings=k2p2_settings)
+	np.testing.assert_array_equal(labels2, labels)
+	np.testing.assert_array_equal(star_table2, star_table)
+	np.testing.assert_array_equal(bbox2, bbox)
+
+#----------------------------------------------------------------------
+def test_targets_in_mask():
+	# Photometry object with only the stamp and catalog set, which is all that is needed:
+	pho = AperturePhotometry.__new__(AperturePhotometry)
+	pho._stamp = (100, 130, 200, 225)
+	cols, rows = pho.get_pixel_grid()
+
+	# L-shaped mask:
+	mask = np.zeros((30, 25), dtype='bool')
+	mask[5:15, 3] = True
+	mask[14, 3:13] = True
+
+	pho._catalog = Table({
+		'starid': [1, 2, 3, 4],
+		'row': [110.2, 114.1, 105.0, 120.0],
+		'column': [203.3, 211.8, 212.0, 203.0]
+	})
+
+	# The third star has both its row and column in the mask, but its own pixel is outside it:
+	assert np.any(rows[mask] == 105+1) and np.any(cols[mask] == 212+1)
+	assert not mask[5, 12]
+	assert pho._targets_in_mask(mask) == [0, 1]
+
+	# Targets on and just outside the edges of the stamp. The stamp grid is 1-based,
+	# while the catalog positions are 0-based:
+	pho._catalog = Table({
+		'starid': np.arange(1, 9),
+		'row': [99.6, 99.4, 129.4, 129.6, 115.0, 115.0, 115.0, 115.0],
+		'column': [212.0, 212.0, 212.0, 212.0, 199.6, 199.4, 224.4, 224.6]
+	})
+	mask = np.ones((30, 25), dtype='bool')
+	indx = pho._targets_in_mask(mask)
+	assert indx == [0, 2, 4, 6]
+	for k in indx:
+		target = pho.catalog[k]
+		assert np.any((rows[mask] == np.round(target['row'])+1) & (cols[mask] == np.round(target['column'])+1))
+
+	# Only pixels in the first and last rows of the stamp:
+	mask = np.zeros((30, 25), dtype='bool')
+	mask[0, 12] = True
+	mask[29, 12] = True
+	assert pho._targets_in_mask(mask) == [0, 2]
+	assert pho._targets_in_mask(np.zeros((30, 25), dtype='bool')) == []
+
 if __name__ == '__main__':
 	test_aperturephotometry()
 	test_aperturephotometry_plots()
+	test_extract_lightcurve()
+	test_predict_stamp_size()
+	test_segment_sumimage()
+	test_targets_in_mask()
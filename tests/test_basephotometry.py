@@ -60,6 +60,41 @@ def test_stamp():
 			assert(rows.shape == (22, 20))
 			assert(cols.shape == (22, 20))
 
+#----------------------------------------------------------------------
+def test_stamp_resize():
+	with TemporaryDirectory() as OUTPUT_DIR:
+		with BasePhotometry(DUMMY_TARGET, INPUT_DIR, OUTPUT_DIR, datasource='ffi', **DUMMY_KWARG) as pho:
+			pho._stamp = (50, 60, 50, 70)
+			pho._set_stamp()
+			pho.images_cube
+			pho.images_err_cube
+			pho.backgrounds_cube
+			pho.catalog
+
+			# Grow the stamp in all directions, keeping the data already loaded:
+			assert pho.resize_stamp(up=12, left=3)
+			assert pho.resize_stamp(down=5, right=10)
+			assert pho.stamp == (45, 72, 47, 80)
+
+			# Data loaded from scratch for the same stamp should be the same:
+			with BasePhotometry(DUMMY_TARGET, INPUT_DIR, OUTPUT_DIR, datasource='ffi', **DUMMY_KWARG) as pho2:
+				pho2._stamp = pho.stamp
+				pho2._set_stamp()
+				np.testing.assert_array_equal(pho.images_cube, pho2.images_cube)
+				np.testing.assert_array_equal(pho.images_err_cube, pho2.images_err_cube)
+				np.testing.assert_array_equal(pho.backgrounds_cube, pho2.backgrounds_cube)
+				np.testing.assert_array_equal(pho.sumimage, pho2.sumimage)
+
+				# All stars in the stamp should be found, and only once:
+				assert len(np.unique(pho.catalog['starid'])) == len(pho.catalog)
+				for cat in (pho.catalog, pho2.catalog):
+					cat.sort('starid')
+				indx = np.in1d(pho2.catalog['starid'], pho.catalog['starid'])
+				assert np.all(indx[(pho2.catalog['row_stamp'] >= 0) & (pho2.catalog['row_stamp'] < 27) & (pho2.catalog['column_stamp'] >= 0) & (pho2.catalog['column_stamp'] < 33)])
+				indx1 = np.in1d(pho.catalog['starid'], pho2.catalog['starid'])
+				np.testing.assert_allclose(pho.catalog[indx1]['row_stamp'], pho2.catalog[indx]['row_stamp'], atol=1e-4)
+				np.testing.assert_allclose(pho.catalog[indx1]['column_stamp'], pho2.catalog[indx]['column_stamp'], atol=1e-4)
+
 #----------------------------------------------------------------------
 def test_images():
 	with TemporaryDirectory() as OUTPUT_DIR:
@@ -242,6 +277,7 @@ def test_tpf_with_other_target():
 #----------------------------------------------------------------------
 if __name__ == '__main__':
 	test_stamp()
+	test_stamp_resize()
 	test_images()
 	test_backgrounds()
 	test_catalog()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the model of expected run time of photometry tasks.
+"""
+
+from __future__ import division, print_function, with_statement, absolute_import
+import sys
+import os.path
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from photometry.costmodel import CostModel, CADENCES, MEMORY_OVERHEAD, task_pixels, estimate_memory
+from photometry.utilities import default_stamp_size
+
+#----------------------------------------------------------------------
+def test_default_stamp_size():
+	# Bright stars get much larger stamps than faint ones:
+	rows_bright, cols_bright = default_stamp_size(2.0)
+	rows_faint, cols_faint = default_stamp_size(12.0)
+	assert rows_bright > rows_faint and cols_bright > cols_faint
+
+	# Never smaller than 15 pixels:
+	rows, cols = default_stamp_size(16.0)
+	assert rows == 15 and cols == 15
+
+	# Works on arrays:
+	rows, cols = default_stamp_size(np.array([2.0, 12.0]))
+	np.testing.assert_allclose(rows, [rows_bright, rows_faint])
+	np.testing.assert_allclose(cols, [cols_bright, cols_faint])
+
+#----------------------------------------------------------------------
+def test_costmodel_prior():
+	model = CostModel()
+
+	task = {'priority': 1, 'starid': 1, 'method': None, 'datasource': 'ffi', 'tmag': 12.0}
+	faint = model.predict(task)
+	assert faint > 0
+
+	# Brighter targets have larger stamps, so should be more expensive:
+	assert model.predict(dict(task, tmag=3.0)) > faint
+
+	# Target pixel files have many more cadences:
+	assert model.predict(dict(task, datasource='tpf')) > faint
+	assert model.predict(dict(task, datasource='tpf:1234')) == model.predict(dict(task, datasource='tpf'))
+
+	# PSF photometry is slower than aperture photometry:
+	assert model.predict(dict(task, method='psf')) > model.predict(dict(task, method='aperture'))
+	assert model.predict(dict(task, method='aperture')) == faint
+
+#----------------------------------------------------------------------
+def test_costmodel_fit():
+	# Create synthetic history of run times following a power law,
+	# with some scatter:
+	rng = np.random.RandomState(42)
+	rows = []
+	for k in range(200):
+		width = rng.randint(15, 60)
+		height = rng.randint(15, 200)
+		size = width * height * CADENCES['ffi']
+		rows.append({
+			'method': None,
+			'datasource': 'ffi',
+			'tmag': 10.0,
+			'stamp_width': width,
+			'stamp_height': height,
+			'elaptime': 1e-4 * size**0.8 * np.exp(0.05*rng.randn())
+		})
+
+	# Add a few targets from another method,
+	# which is not enough to fit the method:
+	for k in range(5):
+		rows.append({'method': 'psf', 'datasource': 'ffi', 'tmag': 10.0, 'stamp_width': 15, 'stamp_height': 15, 'elaptime': 100.0})
+
+	model = CostModel(min_samples=20).fit(rows)
+	assert ('aperture', 'ffi') in model.coefficients
+	assert ('psf', 'ffi') not in model.coefficients
+	np.testing.assert_allclose(model.coefficients[('aperture', 'ffi')][1], 0.8, atol=0.05)
+
+	# Predicting the run time of new targets from their stamp size:
+	task = {'method': 'aperture', 'datasource': 'ffi', 'tmag': 10.0, 'stamp_width': 30, 'stamp_height': 30}
+	expected = 1e-4 * (30*30*CADENCES['ffi'])**0.8
+	np.testing.assert_allclose(model.predict(task), expected, rtol=0.05)
+
+	# Without stamp size, it is estimated from the magnitude:
+	task = {'method': 'aperture', 'datasource': 'ffi', 'tmag': 10.0}
+	assert task_pixels(task) == np.prod(default_stamp_size(10.0))
+	assert model.predict(task) > 0
+
+	# Methods without enough history use the prior,
+	# scaled to match the history that is available:
+	assert model.scale != 1.0
+	task = {'method': 'psf', 'datasource': 'ffi', 'tmag': 10.0}
+	np.testing.assert_allclose(model.predict(task), model.scale * CostModel().predict(task))
+
+#----------------------------------------------------------------------
+def test_estimate_memory():
+	task = {'priority': 1, 'starid': 1, 'method': None, 'datasource': 'ffi', 'tmag': 12.0}
+	faint = estimate_memory(task)
+	assert faint > MEMORY_OVERHEAD
+
+	# Bright targets, target pixel files and halo photometry need more memory:
+	assert estimate_memory(dict(task, tmag=3.0)) > faint
+	assert estimate_memory(dict(task, datasource='tpf')) > faint
+	assert estimate_memory(dict(task, method='halo')) > estimate_memory(dict(task, method='aperture'))
+	assert estimate_memory(dict(task, method='aperture')) == faint
+
+#----------------------------------------------------------------------
+if __name__ == '__main__':
+	test_default_stamp_size()
+	test_costmodel_prior()
+	test_costmodel_fit()
+	test_estimate_memory()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of K2P2 mask creation.
+"""
+
+from __future__ import division, print_function, with_statement, absolute_import
+import numpy as np
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from photometry.AperturePhotometry.k2p2v2 import run_DBSCAN, run_label, k2p2_saturated, k2p2_background, k2p2FixFromSum
+
+#----------------------------------------------------------------------
+def test_run_label():
+	"""Connected-component clustering should give the same clusters as DBSCAN"""
+	rng = np.random.RandomState(42)
+	for k in range(50):
+		NY, NX = rng.randint(1, 40, size=2)
+		img = rng.rand(NY, NX) < rng.uniform(0.05, 0.9)
+		Y, X = np.mgrid[:NY, :NX]
+		if not np.any(img): continue
+
+		for cluster_radius in (1, np.sqrt(2), np.sqrt(2) + np.finfo(np.float64).eps):
+			for min_for_cluster in (1, 3, 4, 6):
+				XX1, labels1, core1 = run_DBSCAN(X[img], Y[img], cluster_radius, min_for_cluster)
+				XX2, labels2, core2 = run_label(X[img], Y[img], cluster_radius, min_for_cluster)
+				np.testing.assert_array_equal(XX1, XX2)
+				np.testing.assert_array_equal(labels1, labels2)
+				np.testing.assert_array_equal(core1, core2)
+
+	# The pixels are not required to start at zero:
+	XX, labels, core = run_label(np.array([10, 11, 10, 11, 20]), np.array([5, 5, 6, 6, 5]), np.sqrt(2), 4)
+	np.testing.assert_array_equal(labels, [0, 0, 0, 0, -1])
+	np.testing.assert_array_equal(core, [True, True, True, True, False])
+
+	# Larger radius is not supported:
+	try:
+		run_label(X[img], Y[img], 2, 4)
+		assert False, "Radius of 2 was accepted"
+	except ValueError:
+		pass
+
+#----------------------------------------------------------------------
+def test_saturated():
+	"""Saturated columns should only extend masks along connected pixels"""
+	SumImage = np.full((12, 5), 10.0)
+	SumImage[2:10, 2] = 1e6
+	SumImage[5, 3] = 500.0
+	idx = (SumImage > 100)
+	idx[10, 2] = True # Connected to the saturated pixels
+	idx[0, 2] = True # Not connected to the saturated pixels
+
+	MASKS = np.zeros((2, 12, 5), dtype='bool')
+	MASKS[0, 4:7, 2] = True
+	MASKS[0, 5, 3] = True
+	MASKS[1, 0, 0] = True
+
+	saturated_mask, pixels_added = k2p2_saturated(SumImage, MASKS, idx)
+
+	expected = np.zeros_like(MASKS)
+	expected[0, 2:11, 2] = True
+	np.testing.assert_array_equal(saturated_mask, expected)
+	assert pixels_added == 6
+
+#----------------------------------------------------------------------
+def test_background():
+	"""The histogram and KDE estimates of the background should agree"""
+	rng = np.random.RandomState(42)
+	SumImage = rng.normal(1000, 30, size=(100, 80))
+	SumImage[40:50, 30:40] += 1e5
+	SumImage[0, :] = np.nan
+
+	bkg_kde = k2p2_background(SumImage, method='kde')
+	bkg_hist = k2p2_background(SumImage, method='histogram')
+
+	for bkg in (bkg_kde, bkg_hist):
+		np.testing.assert_allclose(bkg['mode'], 1000, atol=5)
+		np.testing.assert_allclose(bkg['mad'], 30, rtol=0.1)
+		assert bkg['bandwidth'] == bkg_kde['bandwidth']
+		assert len(bkg['support']) == len(bkg['density'])
+
+	np.testing.assert_allclose(bkg_hist['mode'], bkg_kde['mode'], atol=0.05*bkg_kde['bandwidth'])
+	np.testing.assert_allclose(bkg_hist['mad'], bkg_kde['mad'], rtol=0.01)
+
+	# Giving the background to K2P2 should give the same as estimating it again:
+	masks1, bandwidth1 = k2p2FixFromSum(SumImage, show_plot=False, segmentation=False)
+	masks2, bandwidth2 = k2p2FixFromSum(SumImage, show_plot=False, segmentation=False, background=bkg_kde)
+	np.testing.assert_array_equal(masks1, masks2)
+	assert bandwidth1 == bandwidth2
+
+	# Invalid method:
+	try:
+		k2p2_background(SumImage, method='nonsense')
+		assert False, "Invalid method was accepted"
+	except ValueError:
+		pass
+
+#----------------------------------------------------------------------
+if __name__ == '__main__':
+	test_run_label()
+	test_saturated()
+	test_background()
@@ -8,8 +8,22 @@ from __future__ import division, print_function, with_statement, absolute_import
 import sys
 import os.path
 import numpy as np
+from scipy.interpolate import RectBivariateSpline, bisplev
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from photometry.psf import PSF
+from photometry.psf import PSF, integral_spline
+
+def _integrate_to_image_loop(psf, params, cutoff_radius=5):
+	# Integration of the PSF one pixel at a time, as it was done before
+	# it was vectorised, to compare against:
+	img = np.zeros(psf.shape, dtype='float64')
+	for i in range(psf.shape[0]):
+		for j in range(psf.shape[1]):
+			for star in params:
+				if np.sqrt((j-star[1])**2 + (i-star[0])**2) < cutoff_radius:
+					column_cen = j - star[1]
+					row_cen = i - star[0]
+					img[i,j] += star[2] * psf.splineInterpolation.integral(column_cen-0.5, column_cen+0.5, row_cen-0.5, row_cen+0.5)
+	return img
 
 def test_psf():
 
@@ -32,7 +46,45 @@ def test_psf():
 			assert img.shape == (stamp[1]-stamp[0], stamp[3]-stamp[2]), "not the right size"
 			assert img.shape == psf.shape, "Not the right size either"
 
+			# Compare to integrating the spline one pixel at a time, with several
+			# stars, including some partly outside the stamp:
+			stars = np.array([
+				[4.3, 7.8, 1000],
+				[6.1, 9.2, 500],
+				[-2.5, 3.3, 200],
+				[8.7, 21.4, 300]
+			])
+			for cutoff_radius in (3, 5, 20):
+				img = psf.integrate_to_image(stars, cutoff_radius=cutoff_radius)
+				img_loop = _integrate_to_image_loop(psf, stars, cutoff_radius=cutoff_radius)
+				np.testing.assert_allclose(img, img_loop, rtol=0, atol=1e-9*np.max(stars[:,2]))
+
 			#psf.plot()
 
+def test_integral_spline():
+
+	# Spline of a skewed, double-peaked PSF-like shape on a grid like the PRF files:
+	rng = np.random.RandomState(42)
+	x = np.linspace(-6, 6, 61)
+	y = np.linspace(-7, 7, 71)
+	X, Y = np.meshgrid(x, y, indexing='ij')
+	z = np.exp(-0.5*((X-0.2)**2/1.1**2 + (Y+0.1)**2/0.8**2)) + 0.1*np.exp(-0.5*((X+1)**2 + (Y-1.5)**2)/0.5**2) + 1e-3*rng.rand(len(x), len(y))
+	spline = RectBivariateSpline(x, y, z)
+	tck = integral_spline(spline)
+
+	# The integral over rectangles, including rectangles partly outside
+	# the domain of the spline, should be the same as the integral of the spline:
+	for k in range(200):
+		x1, x2 = np.sort(rng.uniform(-8, 8, 2))
+		y1, y2 = np.sort(rng.uniform(-9, 9, 2))
+		integral = bisplev([x1, x2], [y1, y2], tck)
+		integral = integral[1,1] - integral[0,1] - integral[1,0] + integral[0,0]
+		np.testing.assert_allclose(integral, spline.integral(x1, x2, y1, y2), rtol=0, atol=1e-12)
+
+	# The integral over the full domain:
+	integral = bisplev([-6, 6], [-7, 7], tck)
+	np.testing.assert_allclose(integral[1,1], spline.integral(-6, 6, -7, 7), rtol=1e-12)
+
 if __name__ == '__main__':
 	test_psf()
+	test_integral_spline()
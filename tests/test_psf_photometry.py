@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of PSF photometry run on several cores.
+"""
+
+from __future__ import division, print_function, with_statement, absolute_import
+import sys
+import os.path
+import numpy as np
+from astropy.table import Table
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from photometry.psf_photometry import PSFPhotometry
+from photometry.utilities import integratedGaussian, mag2flux, cadence_chunks
+
+#----------------------------------------------------------------------
+class _GaussianPSF(object):
+	"""Stand-in for the PSF, using a Gaussian instead of the PRF models."""
+	def __init__(self, shape):
+		self.shape = shape
+		self._rows, self._cols = np.mgrid[:shape[0], :shape[1]]
+
+	def integrate_to_image(self, params, cutoff_radius=5):
+		img = np.zeros(self.shape, dtype='float64')
+		for row, col, flux in params:
+			img += integratedGaussian(self._cols, self._rows, flux, col, row, sigma=1.2)
+		return img
+
+def _dummy_photometry(cores):
+	"""PSFPhotometry object with simulated images of two stars, without loading any data."""
+	shape = (11, 11)
+	Ntimes = 10
+	rng = np.random.RandomState(42)
+	psf = _GaussianPSF(shape)
+
+	pho = PSFPhotometry.__new__(PSFPhotometry)
+	pho.cores = cores
+	pho.cadences_per_chunk = 4
+	pho.plot = False
+	pho.psf = psf
+	pho.n_readout = 1
+	pho.readnoise = 10
+	pho.gain = 100
+	pho.Ntimes = Ntimes
+	pho.target_pos_row_stamp = 5.2
+	pho.target_pos_column_stamp = 4.9
+	pho.target_tmag = 10
+	pho._catalog = Table({
+		'starid': [1, 2],
+		'tmag': [10, 11],
+		'row_stamp': [5.2, 7.0],
+		'column_stamp': [4.9, 7.5]
+	})
+
+	images = np.empty(shape + (Ntimes,), dtype='float64')
+	for k in range(Ntimes):
+		stars = [[5.0 + 0.05*k, 5.0, mag2flux(10)*(1 + 0.01*k)], [7.1, 7.4, mag2flux(11)]]
+		images[:, :, k] = psf.integrate_to_image(stars) + rng.normal(0, 10, size=shape)
+	pho._images_cube = images
+	pho._backgrounds_cube = np.zeros_like(images)
+	pho.lightcurve = {
+		'flux': np.zeros(Ntimes),
+		'pos_centroid': np.zeros((Ntimes, 2)),
+		'quality': np.zeros(Ntimes, dtype='int32')
+	}
+	return pho
+
+#----------------------------------------------------------------------
+def test_cadence_chunks():
+	chunks = cadence_chunks(10, 4)
+	assert [list(c) for c in chunks] == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+	assert cadence_chunks(0, 4) == []
+
+#----------------------------------------------------------------------
+def test_psf_photometry_cores():
+	# The lightcurve should not depend on the number of cores used:
+	lightcurves = []
+	for cores in (1, 3):
+		pho = _dummy_photometry(cores)
+		pho.do_photometry()
+		lightcurves.append(pho.lightcurve)
+
+	assert np.all(np.isfinite(lightcurves[0]['flux']))
+	np.testing.assert_array_equal(lightcurves[0]['flux'], lightcurves[1]['flux'])
+	np.testing.assert_array_equal(lightcurves[0]['pos_centroid'], lightcurves[1]['pos_centroid'])
+	np.testing.assert_array_equal(lightcurves[0]['quality'], lightcurves[1]['quality'])
+
+#----------------------------------------------------------------------
+if __name__ == '__main__':
+	test_cadence_chunks()
+	test_psf_photometry_cores()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of running tasks in parallel on the local machine with run_tessphot.py.
+"""
+
+from __future__ import division, print_function, with_statement, absolute_import
+import sys
+import os.path
+import signal
+import threading
+import time
+import sqlite3
+import contextlib
+import pytest
+try:
+	from tempfile import TemporaryDirectory
+except ImportError:
+	from backports.tempfile import TemporaryDirectory
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from photometry import TaskManager, STATUS
+from tests.helpers import make_todo_file, count_status
+import run_tessphot
+
+TARGETS = [
+	(1, 1001, 'ffi', 1, 1, 8.0),
+	(2, 1002, 'ffi', 1, 1, 9.0),
+	(3, 1003, 'ffi', 1, 1, 10.0),
+	(4, 1004, 'ffi', 1, 2, 11.0),
+]
+
+#----------------------------------------------------------------------
+class _DummyPhotometry(object):
+	def __init__(self, starid):
+		self.status = STATUS.OK
+		self._details = {'mean_flux': float(starid)}
+
+def _tessphot_stub(starid=None, crash=None, sleep=0, **kwargs):
+	"""Stand-in for tessphot, which can simulate a worker being killed or a long-running task."""
+	if starid == crash:
+		os._exit(1)
+	time.sleep(sleep)
+	return _DummyPhotometry(starid)
+
+def _run(todo_file, workers, max_inflight=None, **kwargs):
+	"""Run all tasks in the TODO-file with the stub of tessphot."""
+	tessphot = run_tessphot.tessphot
+	run_tessphot.tessphot = _tessphot_stub
+	try:
+		with TaskManager(todo_file) as tm:
+			return run_tessphot.run_parallel(tm, tm.get_task, workers, max_inflight=max_inflight, **kwargs)
+	finally:
+		run_tessphot.tessphot = tessphot
+
+def _errors(todo_file):
+	"""Priorities and errors of the tasks with errors."""
+	with contextlib.closing(sqlite3.connect(todo_file)) as conn:
+		cursor = conn.cursor()
+		cursor.execute("SELECT todolist.priority,diagnostics.errors FROM todolist INNER JOIN diagnostics ON diagnostics.priority=todolist.priority WHERE todolist.status=?;", (STATUS.ERROR.value, ))
+		return cursor.fetchall()
+
+#----------------------------------------------------------------------
+def test_run_parallel():
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, TARGETS)
+		assert _run(todo_file, 2) == 4
+		assert count_status(todo_file, STATUS.OK) == 4
+
+		with contextlib.closing(sqlite3.connect(todo_file)) as conn:
+			cursor = conn.cursor()
+			cursor.execute("SELECT priority,starid,mean_flux FROM diagnostics ORDER BY priority;")
+			assert cursor.fetchall() == [(t[0], t[1], float(t[1])) for t in TARGETS]
+
+#----------------------------------------------------------------------
+def test_run_parallel_lost_worker():
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, TARGETS)
+
+		# The worker running the second task dies. That task is marked as ERROR,
+		# and the rest are processed in a new pool:
+		assert _run(todo_file, 1, max_inflight=1, crash=1002) == 4
+		assert count_status(todo_file, STATUS.OK) == 3
+		assert count_status(todo_file, STATUS.STARTED) == 0
+		errors = _errors(todo_file)
+		assert len(errors) == 1
+		assert errors[0][0] == 2
+		assert 'BrokenProcessPool' in errors[0][1]
+
+#----------------------------------------------------------------------
+def test_run_parallel_interrupt():
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, TARGETS)
+
+		# Press Ctrl-C while the first tasks are running:
+		timer = threading.Timer(1.0, os.kill, (os.getpid(), signal.SIGINT))
+		timer.start()
+		t1 = time.time()
+		try:
+			with pytest.raises(KeyboardInterrupt):
+				_run(todo_file, 2, max_inflight=2, sleep=60)
+		finally:
+			timer.cancel()
+
+		# The running tasks are stopped straight away and marked as ABORT,
+		# while the others are left alone:
+		assert time.time() - t1 < 30
+		assert count_status(todo_file, STATUS.ABORT) == 2
+		assert count_status(todo_file, STATUS.STARTED) == 0
+		with TaskManager(todo_file) as tm:
+			assert tm.get_number_tasks() == 4
+
+#----------------------------------------------------------------------
+if __name__ == '__main__':
+	test_run_parallel()
+	test_run_parallel_lost_worker()
+	test_run_parallel_interrupt()
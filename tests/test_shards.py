@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of TODO-files split into shards.
+"""
+
+from __future__ import division, print_function, with_statement, absolute_import
+import sys
+import os.path
+import sqlite3
+import contextlib
+import json
+try:
+	from tempfile import TemporaryDirectory
+except ImportError:
+	from backports.tempfile import TemporaryDirectory
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from photometry import TaskManager, STATUS
+from photometry.shards import split_todo_file, merge_todo_files, find_shards, open_task_manager, ShardedTaskManager
+from tests.helpers import make_todo_file, make_result, add_skip_predictions
+
+TARGETS = [
+	(1, 1001, 'ffi', 1, 1, 8.0),
+	(2, 1002, 'ffi', 1, 2, 9.0),
+	(3, 1003, 'ffi', 1, 1, 12.0),
+	(4, 1004, 'ffi', 1, 2, 11.0),
+	(5, 1001, 'tpf', 1, 1, 8.0),
+	(6, 1006, 'ffi', 2, 3, 10.0),
+]
+
+#----------------------------------------------------------------------
+def dump_tables(todo_file):
+	"""Contents of the tables of TODO-file, for comparing TODO-files."""
+	tables = {}
+	with contextlib.closing(sqlite3.connect(todo_file)) as conn:
+		cursor = conn.cursor()
+		for table in ('todolist', 'diagnostics', 'photometry_skipped', 'skip_predictions'):
+			cursor.execute("SELECT * FROM " + table + " ORDER BY priority;")
+			tables[table] = cursor.fetchall()
+	return tables
+
+#----------------------------------------------------------------------
+def test_split_merge():
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, TARGETS)
+		add_skip_predictions(todo_file, [(3, 1)])
+		with TaskManager(todo_file) as tm:
+			for starid, status, details in ((1001, STATUS.OK, {'skip_targets': [1003]}), (1006, STATUS.ERROR, {'errors': ['Oops']})):
+				task = tm.get_task(starid=starid)
+				tm.start_task(task['priority'])
+				tm.save_result(make_result(task, status=status, **details))
+
+		os.mkdir(os.path.join(tmpdir, 'shards'))
+		shard_files = split_todo_file(todo_file, os.path.join(tmpdir, 'shards'))
+		assert [os.path.basename(f) for f in shard_files] == [
+			'todo_sector001_camera1_ccd1.sqlite',
+			'todo_sector001_camera1_ccd2.sqlite',
+			'todo_sector001_camera2_ccd3.sqlite'
+		]
+		assert find_shards(os.path.join(tmpdir, 'shards')) == shard_files
+
+		with contextlib.closing(sqlite3.connect(shard_files[0])) as conn:
+			cursor = conn.cursor()
+			cursor.execute("SELECT priority FROM todolist ORDER BY priority;")
+			assert cursor.fetchall() == [(1, ), (3, ), (5, )]
+			cursor.execute("SELECT priority,skipped_by FROM photometry_skipped;")
+			assert cursor.fetchall() == [(3, 1)]
+
+		# Splitting again without overwrite is not allowed:
+		try:
+			split_todo_file(todo_file, os.path.join(tmpdir, 'shards'))
+			assert False, "Existing shards were overwritten"
+		except IOError:
+			pass
+
+		# Merging the shards should give back the original tables:
+		merged_file = os.path.join(tmpdir, 'merged.sqlite')
+		merge_todo_files(shard_files, merged_file)
+		assert dump_tables(merged_file) == dump_tables(todo_file)
+
+		# Tasks found in several shards can not be merged:
+		try:
+			merge_todo_files(shard_files + shard_files[:1], merged_file, overwrite=True)
+			assert False, "Duplicate tasks were merged"
+		except ValueError:
+			pass
+
+#----------------------------------------------------------------------
+def test_sharded_taskmanager():
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, TARGETS)
+		shard_files = split_todo_file(todo_file)
+
+		# The TODO-file takes precedence over the shards:
+		with open_task_manager(tmpdir) as tm:
+			assert not isinstance(tm, ShardedTaskManager)
+		os.remove(todo_file)
+
+		for in_memory_queue in (False, True):
+			summary_file = os.path.join(tmpdir, 'summary.json')
+			with open_task_manager(tmpdir, in_memory_queue=in_memory_queue, overwrite=True, summary=summary_file) as tm:
+				assert isinstance(tm, ShardedTaskManager)
+				assert tm.get_number_tasks() == 6
+				assert tm.summary['numtasks'] == 6
+
+				task = tm.get_task()
+				assert task['priority'] == 1
+				tm.start_task(task['priority'])
+				tm.save_result(make_result(task, skip_targets=[1003]))
+				assert tm.get_number_tasks() == 4
+
+				# Put a task back after starting it:
+				task = tm.get_task()
+				assert task['priority'] == 2
+				tm.start_task(task['priority'])
+				tm.requeue_task(task['priority'])
+
+				priorities = []
+				while True:
+					task = tm.get_task()
+					if task is None: break
+					tm.start_task(task['priority'])
+					tm.save_result(make_result(task))
+					priorities.append(task['priority'])
+				assert priorities == [2, 4, 5, 6]
+
+				assert tm.summary['tasks_run'] == 5
+				assert tm.summary['OK'] == 5
+				assert tm.summary['SKIPPED'] == 1
+				assert tm.summary['STARTED'] == 0
+
+			merge_todo_files(shard_files, os.path.join(tmpdir, 'merged.sqlite'), overwrite=True)
+			with contextlib.closing(sqlite3.connect(os.path.join(tmpdir, 'merged.sqlite'))) as conn:
+				cursor = conn.cursor()
+				cursor.execute("SELECT priority,status FROM todolist ORDER BY priority;")
+				assert cursor.fetchall() == [(1, 1), (2, 1), (3, 5), (4, 1), (5, 1), (6, 1)]
+				cursor.execute("SELECT COUNT(*) FROM diagnostics;")
+				assert cursor.fetchone()[0] == 5
+
+#----------------------------------------------------------------------
+def test_sharded_taskmanager_shared():
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, TARGETS)
+		shard_files = split_todo_file(todo_file)
+		os.remove(todo_file)
+
+		# Two workers claiming tasks from the same shards never get the same task:
+		with ShardedTaskManager(shard_files, shared=True, worker_id='w1') as tm1, ShardedTaskManager(shard_files, shared=True, worker_id='w2') as tm2:
+			claimed = []
+			for tm in (tm1, tm2, tm1, tm2, tm1, tm2):
+				task = tm.claim_task()
+				claimed.append(task['priority'])
+				assert tm.renew_claim(task['priority'])
+				assert tm.save_result(make_result(task))
+			assert tm1.claim_task() is None
+			assert sorted(claimed) == [1, 2, 3, 4, 5, 6]
+			assert tm1.summary['OK'] + tm2.summary['OK'] == 6
+
+#----------------------------------------------------------------------
+def test_sharded_taskmanager_summary_secondary():
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, [
+			(1, 1001, 'ffi', 1, 1, 8.0),
+			(2, 1002, 'ffi', 1, 1, 9.0),
+			(3, 1003, 'ffi', 1, 1, 10.0),
+			(4, 1004, 'ffi', 1, 2, 11.0),
+		])
+		shard_files = split_todo_file(todo_file)
+		os.remove(todo_file)
+
+		summary_file = os.path.join(tmpdir, 'summary.json')
+		with ShardedTaskManager(shard_files, summary=summary_file, summary_interval=2) as tm:
+			for k, secondary in enumerate(([], [{'starid': 1003, 'status': STATUS.OK, 'time': 0.5, 'details': {}}])):
+				task = tm.get_task()
+				tm.start_task(task['priority'])
+				tm.save_result(make_result(task, secondary=secondary))
+
+				# The summary is written once the interval is passed, even if the
+				# number of tasks run jumps past it because of the secondary target:
+				with open(summary_file, 'r') as fid:
+					summary = json.load(fid)
+				assert summary['tasks_run'] == (0 if k == 0 else 3)
+
+#----------------------------------------------------------------------
+if __name__ == '__main__':
+	test_split_merge()
+	test_sharded_taskmanager()
+	test_sharded_taskmanager_shared()
+	test_sharded_taskmanager_summary_secondary()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of staging of input files onto local storage.
+"""
+
+from __future__ import division, print_function, with_statement, absolute_import
+import sys
+import os.path
+try:
+	from tempfile import TemporaryDirectory
+except ImportError:
+	from backports.tempfile import TemporaryDirectory
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from photometry.staging import staging_folder, stage_files, evict_files
+
+#----------------------------------------------------------------------
+def test_staging_folder():
+	old_value = os.environ.get('TESSPHOT_TEST_SCRATCH')
+	os.environ['TESSPHOT_TEST_SCRATCH'] = '/scratch/node1'
+	try:
+		assert staging_folder('$TESSPHOT_TEST_SCRATCH/tessphot') == os.path.abspath('/scratch/node1/tessphot')
+		assert staging_folder(None) is None
+	finally:
+		# Restore the environment for the tests that follow:
+		if old_value is None:
+			del os.environ['TESSPHOT_TEST_SCRATCH']
+		else:
+			os.environ['TESSPHOT_TEST_SCRATCH'] = old_value
+
+#----------------------------------------------------------------------
+def test_stage_files():
+	with TemporaryDirectory() as tmpdir:
+		input_folder = os.path.join(tmpdir, 'input')
+		stage_folder = os.path.join(tmpdir, 'stage')
+		os.mkdir(input_folder)
+		for fname in ('sector001_camera1_ccd1.hdf5', 'catalog_sector001_camera1_ccd1.sqlite',
+			'sector001_camera1_ccd2.hdf5', 'catalog_sector001_camera1_ccd2.sqlite'):
+			with open(os.path.join(input_folder, fname), 'w') as fid:
+				fid.write(fname)
+
+		# Only the files of the given CCD are copied:
+		staged = stage_files(input_folder, stage_folder, 1, 1, 1)
+		assert sorted(os.path.basename(f) for f in staged) == ['catalog_sector001_camera1_ccd1.sqlite', 'sector001_camera1_ccd1.hdf5']
+		for fpath in staged:
+			with open(fpath, 'r') as fid:
+				assert fid.read() == os.path.basename(fpath)
+
+		# Files already staged are not copied again, unless they have changed:
+		inode = os.stat(staged[0]).st_ino
+		changed = os.path.join(input_folder, os.path.basename(staged[1]))
+		mtime = os.path.getmtime(changed)
+		with open(changed, 'w') as fid:
+			fid.write('changed')
+		os.utime(changed, (mtime + 100, mtime + 100))
+		assert stage_files(input_folder, stage_folder, 1, 1, 1) == staged
+		assert os.stat(staged[0]).st_ino == inode
+		with open(staged[1], 'r') as fid:
+			assert fid.read() == 'changed'
+
+		stage_files(input_folder, stage_folder, 1, 1, 2)
+
+		# Evicting removes the files of this CCD only:
+		assert sorted(evict_files(stage_folder, 1, 1, 1)) == sorted(staged)
+		assert sorted(f for f in os.listdir(stage_folder) if not f.startswith('.')) == ['catalog_sector001_camera1_ccd2.sqlite', 'sector001_camera1_ccd2.hdf5']
+		assert len(os.listdir(input_folder)) == 4
+		assert evict_files(stage_folder, 1, 1, 1) == []
+
+#----------------------------------------------------------------------
+if __name__ == '__main__':
+	test_staging_folder()
+	test_stage_files()
@@ -7,8 +7,19 @@
 from __future__ import division, print_function, with_statement, absolute_import
 import sys
 import os.path
+import signal
+import multiprocessing
+import pytest
+try:
+	from tempfile import TemporaryDirectory
+except ImportError:
+	from backports.tempfile import TemporaryDirectory
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from photometry import TaskManager, STATUS
+from photometry.taskmanager import TaskQueue
+from tests.helpers import make_todo_file, make_result, add_skip_predictions, count_status
+
+#----------------------------------------------------------------------
 
 def test_taskmanager():
 	"""Test of background estimator"""
@@ -57,5 +68,568 @@ def test_taskmanager():
 
 		assert(task1_status == STATUS.STARTED.value)
 
+#----------------------------------------------------------------------
+def test_taskmanager_write_behind():
+	"""Test that results are committed in batches in write-behind mode"""
+
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, [(k, 1000+k, 'ffi', 1, 1, 10.0) for k in range(1, 11)])
+
+		with TaskManager(todo_file, write_behind=True, commit_interval=3, commit_timeout=1e6) as tm:
+			# The database should have been put in WAL mode:
+			tm.cursor.execute("PRAGMA journal_mode;")
+			assert tm.cursor.fetchone()[0] == 'wal'
+
+			for k in range(2):
+				task = tm.get_task()
+				tm.start_task(task['priority'])
+				tm.save_result(make_result(task))
+
+			# The TaskManager itself sees the changes, but they are not yet committed:
+			assert tm.get_number_tasks() == 8
+			assert count_status(todo_file, STATUS.OK) == 0
+
+			# The third result should trigger a commit:
+			task = tm.get_task()
+			tm.start_task(task['priority'])
+			tm.save_result(make_result(task))
+			assert count_status(todo_file, STATUS.OK) == 3
+
+			# Results not committed are written when calling flush:
+			task = tm.get_task()
+			tm.start_task(task['priority'])
+			tm.save_result(make_result(task))
+			assert count_status(todo_file, STATUS.OK) == 3
+			tm.flush()
+			assert count_status(todo_file, STATUS.OK) == 4
+
+			task = tm.get_task()
+			tm.start_task(task['priority'])
+			tm.save_result(make_result(task))
+
+		# Closing the TaskManager should write everything:
+		assert count_status(todo_file, STATUS.OK) == 5
+
+#----------------------------------------------------------------------
+def test_taskmanager_write_behind_signal():
+	"""Test that buffered results are written when receiving SIGTERM"""
+
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, [(k, 1000+k, 'ffi', 1, 1, 10.0) for k in range(1, 11)])
+
+		old_handler = signal.getsignal(signal.SIGTERM)
+		with pytest.raises(SystemExit):
+			with TaskManager(todo_file, write_behind=True, commit_interval=100, commit_timeout=1e6) as tm:
+				task = tm.get_task()
+				tm.start_task(task['priority'])
+				tm.save_result(make_result(task))
+				assert count_status(todo_file, STATUS.OK) == 0
+				os.kill(os.getpid(), signal.SIGTERM)
+
+		assert count_status(todo_file, STATUS.OK) == 1
+
+		# The original signal handler should be restored:
+		assert signal.getsignal(signal.SIGTERM) == old_handler
+
+#----------------------------------------------------------------------
+def test_taskmanager_write_behind_signal_after_error():
+	"""Test that SIGTERM is still handled after saving a result failed"""
+
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, [(k, 1000+k, 'ffi', 1, 1, 10.0) for k in range(1, 11)])
+
+		with pytest.raises(SystemExit):
+			with TaskManager(todo_file, write_behind=True, commit_interval=100, commit_timeout=1e6) as tm:
+				task = tm.get_task()
+				tm.start_task(task['priority'])
+				result = make_result(task)
+				del result['status']
+				with pytest.raises(KeyError):
+					tm.save_result(result)
+				assert not tm._busy
+				os.kill(os.getpid(), signal.SIGTERM)
+
+#----------------------------------------------------------------------
+def test_taskqueue():
+	"""Test of in-memory queue of tasks"""
+
+	tasks = [
+		{'priority': 3, 'starid': 103, 'method': None, 'sector': 1, 'camera': 1, 'ccd': 2, 'datasource': 'ffi', 'tmag': 10.0},
+		{'priority': 1, 'starid': 101, 'method': None, 'sector': 1, 'camera': 1, 'ccd': 1, 'datasource': 'ffi', 'tmag': 10.0},
+		{'priority': 4, 'starid': 104, 'method': None, 'sector': 1, 'camera': 1, 'ccd': 1, 'datasource': 'ffi', 'tmag': 10.0},
+		{'priority': 2, 'starid': 102, 'method': None, 'sector': 1, 'camera': 1, 'ccd': 2, 'datasource': 'ffi', 'tmag': 10.0},
+	]
+	queue = TaskQueue(tasks)
+	assert len(queue) == 4
+	assert sorted(queue.partitions()) == [(1, 1, 1), (1, 1, 2)]
+
+	# Peeking does not remove the task:
+	assert queue.peek() == tasks[1]
+	assert queue.peek()['priority'] == 1
+	assert queue.peek(partition=(1, 1, 2))['priority'] == 2
+
+	# Removing tasks, also ones which are not at the front of the queue:
+	queue.remove(2)
+	queue.remove(4)
+	queue.remove(42)
+	assert len(queue) == 2
+	assert 2 not in queue
+	assert queue.peek(partition=(1, 1, 2))['priority'] == 3
+	assert queue.pop()['priority'] == 1
+	assert queue.partitions() == [(1, 1, 2)]
+	assert queue.peek(partition=(1, 1, 1)) is None
+	assert queue.pop()['priority'] == 3
+	assert queue.pop() is None
+	assert len(queue) == 0
+
+	# Tasks can be put back in the queue:
+	queue.push(tasks[3])
+	queue.push(tasks[1])
+	assert len(queue) == 2
+	assert queue.peek()['priority'] == 1
+
+	# Finding waiting tasks for given targets:
+	assert queue.find([102, 103], 'ffi', 1) == [tasks[3]]
+	assert queue.find([102], 'tpf', 1) == []
+	assert queue.find([102], 'ffi', 2) == []
+	queue.remove(2)
+	assert queue.find([102], 'ffi', 1) == []
+
+#----------------------------------------------------------------------
+def test_taskqueue_accept():
+	"""Test of taking tasks from the in-memory queue subject to a condition"""
+
+	tasks = [
+		{'priority': 1, 'starid': 101, 'method': None, 'sector': 1, 'camera': 1, 'ccd': 1, 'datasource': 'ffi', 'tmag': 2.0},
+		{'priority': 2, 'starid': 102, 'method': None, 'sector': 1, 'camera': 1, 'ccd': 1, 'datasource': 'ffi', 'tmag': 3.0},
+		{'priority': 3, 'starid': 103, 'method': None, 'sector': 1, 'camera': 1, 'ccd': 1, 'datasource': 'ffi', 'tmag': 12.0},
+		{'priority': 4, 'starid': 104, 'method': None, 'sector': 1, 'camera': 1, 'ccd': 1, 'datasource': 'ffi', 'tmag': 13.0},
+	]
+	queue = TaskQueue(tasks, cost=lambda task: task['tmag'])
+	total_cost = queue.total_cost
+
+	# The first accepted task is returned, and the rejected ones are kept in order:
+	task = queue.pop(accept=lambda task: task['tmag'] > 10)
+	assert task['priority'] == 3
+	assert len(queue) == 3
+	assert queue.total_cost == total_cost - 12.0
+	assert queue.peek()['priority'] == 1
+
+	# Only the front of the queue is searched:
+	assert queue.pop(accept=lambda task: task['tmag'] > 10, search=2) is None
+	assert len(queue) == 3
+	assert queue.pop(accept=lambda task: task['tmag'] > 10, search=3)['priority'] == 4
+
+	# Nothing accepted:
+	assert queue.pop(accept=lambda task: False) is None
+	assert [queue.pop()['priority'] for k in range(2)] == [1, 2]
+	assert queue.total_cost == 0
+
+#----------------------------------------------------------------------
+def test_taskmanager_in_memory_queue():
+	"""Test that the in-memory queue gives the same tasks as the TODO-file"""
+
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, [
+			(1, 1001, 'ffi', 1, 1, 8.0),
+			(2, 1002, 'ffi', 1, 2, 9.0),
+			(3, 1003, 'ffi', 1, 1, 12.0),
+			(4, 1004, 'ffi', 1, 2, 11.0),
+			(5, 1001, 'tpf', 1, 1, 8.0),
+		])
+
+		with TaskManager(todo_file, in_memory_queue=True) as tm:
+			assert tm.get_number_tasks() == 5
+			task = tm.get_task()
+			assert task == {'priority': 1, 'starid': 1001, 'method': None, 'sector': 1, 'camera': 1, 'ccd': 1, 'datasource': 'ffi', 'tmag': 8.0}
+			tm.start_task(task['priority'])
+			assert tm.get_number_tasks() == 4
+
+			# Target 1003 is fainter and in the mask of 1001, so will be marked as SKIPPED
+			# and should never be handed out:
+			tm.save_result(make_result(task, skip_targets=[1003]))
+			assert tm.get_number_tasks() == 3
+
+			priorities = []
+			while True:
+				task = tm.get_task()
+				if task is None: break
+				tm.start_task(task['priority'])
+				tm.save_result(make_result(task))
+				priorities.append(task['priority'])
+			assert priorities == [2, 4, 5]
+
+			tm.cursor.execute("SELECT status FROM todolist WHERE priority=3;")
+			assert tm.cursor.fetchone()['status'] == STATUS.SKIPPED.value
+
+#----------------------------------------------------------------------
+def test_taskmanager_requeue_task():
+	"""Test putting tasks from an unfinished batch back into the queue"""
+
+	for in_memory_queue in (False, True):
+		with TemporaryDirectory() as tmpdir:
+			todo_file = make_todo_file(tmpdir, [
+				(1, 1001, 'ffi', 1, 1, 8.0),
+				(2, 1002, 'ffi', 1, 1, 12.0),
+				(3, 1003, 'ffi', 1, 1, 11.0),
+			])
+
+			with TaskManager(todo_file, in_memory_queue=in_memory_queue) as tm:
+				# Hand out all three tasks as one batch:
+				batch = []
+				for k in range(3):
+					task = tm.get_task()
+					tm.start_task(task['priority'])
+					batch.append(task)
+				assert tm.get_task() is None
+				assert tm.summary['STARTED'] == 3
+
+				# The first target flags the second, so the worker stops
+				# and returns the remaining two tasks unprocessed:
+				tm.save_result(make_result(batch[0], skip_targets=[1002]))
+				tm.requeue_task(batch[1]['priority'])
+				tm.requeue_task(batch[2]['priority'])
+				assert tm.summary['STARTED'] == 0
+
+				# Only the target which was not SKIPPED should be processed again:
+				assert tm.get_number_tasks() == 1
+				task = tm.get_task()
+				assert task['priority'] == 3
+
+				tm.cursor.execute("SELECT status FROM todolist WHERE priority=2;")
+				assert tm.cursor.fetchone()['status'] == STATUS.SKIPPED.value
+
+#----------------------------------------------------------------------
+def test_taskmanager_secondary_results():
+	"""Test saving results of targets processed along with another task"""
+
+	for in_memory_queue in (False, True):
+		with TemporaryDirectory() as tmpdir:
+			todo_file = make_todo_file(tmpdir, [
+				(1, 1001, 'ffi', 1, 1, 8.0),
+				(2, 1002, 'ffi', 1, 1, 9.0),
+				(3, 1003, 'ffi', 1, 1, 10.0),
+				(4, 1004, 'ffi', 1, 2, 11.0),
+				(5, 1005, 'ffi', 1, 1, 12.0),
+			])
+
+			with TaskManager(todo_file, in_memory_queue=in_memory_queue) as tm:
+				task1 = tm.get_task()
+				tm.start_task(task1['priority'])
+				task2 = tm.get_task()
+				tm.start_task(task2['priority'])
+				assert task2['priority'] == 2
+
+				# Targets 1002 (already started) and 1004 (on another CCD) should be left alone:
+				secondary = [
+					{'starid': 1002, 'status': STATUS.OK, 'time': 0.5, 'details': {}},
+					{'starid': 1003, 'status': STATUS.OK, 'time': 0.5, 'details': {'filepath_lightcurve': 'tess1003.fits.gz', 'skip_targets': [1005]}},
+					{'starid': 1004, 'status': STATUS.OK, 'time': 0.5, 'details': {}},
+				]
+				tm.save_result(make_result(task1, secondary=secondary))
+
+				assert tm.summary['tasks_run'] == 2
+				assert tm.summary['OK'] == 2
+				assert tm.summary['SKIPPED'] == 1
+				assert tm.summary['STARTED'] == 1
+
+				tm.cursor.execute("SELECT priority,status FROM todolist ORDER BY priority;")
+				assert [tuple(row) for row in tm.cursor.fetchall()] == [
+					(1, STATUS.OK.value),
+					(2, STATUS.STARTED.value),
+					(3, STATUS.OK.value),
+					(4, None),
+					(5, STATUS.SKIPPED.value)
+				]
+				tm.cursor.execute("SELECT lightcurve,elaptime FROM diagnostics WHERE priority=3;")
+				assert tuple(tm.cursor.fetchone()) == ('tess1003.fits.gz', 0.5)
+
+				# Only the target on the other CCD is left:
+				assert tm.get_number_tasks() == 1
+				assert tm.get_task()['priority'] == 4
+
+#----------------------------------------------------------------------
+def test_taskmanager_order_cost():
+	"""Test handing out the most expensive tasks first"""
+
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, [
+			(1, 1001, 'ffi', 1, 1, 12.0),
+			(2, 1002, 'ffi', 1, 2, 4.0),
+			(3, 1003, 'tpf', 1, 1, 12.0),
+			(4, 1004, 'ffi', 1, 1, 8.0),
+		])
+
+		# Ordering by cost is only possible with the in-memory queue:
+		with pytest.raises(ValueError):
+			TaskManager(todo_file, order='cost')
+
+		with TaskManager(todo_file, in_memory_queue=True, order='cost') as tm:
+			assert tm.summary['eta'] is None
+			priorities = []
+			while True:
+				task = tm.get_task()
+				if task is None: break
+				tm.start_task(task['priority'])
+				tm.save_result(make_result(task))
+				priorities.append(task['priority'])
+
+				# Once results are coming in, there is an estimate of the remaining time:
+				assert tm.summary['eta'] is not None
+
+			# Bright stars have large stamps and TPFs have many cadences,
+			# so they should be run first:
+			assert priorities == [3, 2, 4, 1]
+			assert tm.summary['eta'] == 0
+
+#----------------------------------------------------------------------
+def test_taskmanager_predicted_skips_defer():
+	"""Test deferring targets predicted to be skipped by a brighter target"""
+
+	for in_memory_queue in (False, True):
+		with TemporaryDirectory() as tmpdir:
+			todo_file = make_todo_file(tmpdir, [
+				(1, 1001, 'ffi', 1, 1, 6.0),
+				(2, 1002, 'ffi', 1, 1, 12.0),
+				(3, 1003, 'ffi', 1, 1, 13.0),
+				(4, 1004, 'ffi', 1, 1, 13.5),
+			])
+			add_skip_predictions(todo_file, [(2, 1), (4, 3)])
+
+			with pytest.raises(ValueError):
+				TaskManager(todo_file, predicted_skips='invalid')
+
+			with TaskManager(todo_file, in_memory_queue=in_memory_queue, predicted_skips='defer') as tm:
+				assert tm.get_number_tasks() == 4
+
+				# While the bright targets are running, the fainter ones are held back:
+				task1 = tm.get_task()
+				assert task1['priority'] == 1
+				tm.start_task(1)
+				task3 = tm.get_task()
+				assert task3['priority'] == 3
+				tm.start_task(3)
+				assert tm.get_task() is None
+
+				# The first target does not skip its neighbour after all,
+				# so it is handed out once the first is done:
+				tm.save_result(make_result(task1))
+				assert tm.get_task()['priority'] == 2
+
+				# The other target skips its neighbour as predicted:
+				tm.save_result(make_result(task3, skip_targets=[1004]))
+				tm.start_task(2)
+				assert tm.get_task() is None
+				assert tm.get_number_tasks() == 0
+				assert count_status(todo_file, STATUS.SKIPPED) == 1
+
+#----------------------------------------------------------------------
+def test_taskmanager_eta_deferred():
+	"""Test that the ETA includes deferred and running tasks"""
+
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, [
+			(1, 1001, 'ffi', 1, 1, 6.0),
+			(2, 1002, 'ffi', 1, 1, 12.0),
+			(3, 1003, 'ffi', 1, 1, 13.0),
+			(4, 1004, 'ffi', 1, 1, 13.5),
+			(5, 1005, 'ffi', 1, 1, 14.0),
+		])
+		add_skip_predictions(todo_file, [(2, 1), (4, 1), (5, 1)])
+
+		with TaskManager(todo_file, in_memory_queue=True, predicted_skips='defer') as tm:
+			task1 = tm.get_task()
+			assert task1['priority'] == 1
+			tm.start_task(1)
+			task3 = tm.get_task()
+			assert task3['priority'] == 3
+			tm.start_task(3)
+			assert tm.get_task() is None
+
+			# Only deferred tasks and the running first task are left,
+			# so the estimate should not have dropped to zero:
+			tm.save_result(make_result(task3))
+			assert tm.summary['eta'] > 0
+
+			# The deferred tasks are released into the queue when the first task is done:
+			tm.save_result(make_result(task1))
+			assert tm.summary['eta'] > 0
+			for priority in (2, 4, 5):
+				task = tm.get_task()
+				assert task['priority'] == priority
+				tm.start_task(priority)
+				tm.save_result(make_result(task))
+
+			assert tm.get_number_tasks() == 0
+			assert tm.summary['eta'] == 0
+
+#----------------------------------------------------------------------
+def test_taskmanager_predicted_skips_skip():
+	"""Test skipping targets predicted to be skipped by a brighter target up front"""
+
+	for in_memory_queue in (False, True):
+		with TemporaryDirectory() as tmpdir:
+			todo_file = make_todo_file(tmpdir, [
+				(1, 1001, 'ffi', 1, 1, 6.0),
+				(2, 1002, 'ffi', 1, 1, 12.0),
+				(3, 1003, 'ffi', 1, 1, 13.0),
+				(4, 1004, 'ffi', 1, 1, 13.5),
+			])
+			add_skip_predictions(todo_file, [(2, 1), (4, 3)])
+
+			with TaskManager(todo_file, in_memory_queue=in_memory_queue, predicted_skips='skip') as tm:
+				assert count_status(todo_file, STATUS.SKIPPED) == 2
+				assert tm.get_number_tasks() == 2
+
+				task1 = tm.get_task()
+				assert task1['priority'] == 1
+				tm.start_task(1)
+				task3 = tm.get_task()
+				assert task3['priority'] == 3
+				tm.start_task(3)
+				assert tm.get_task() is None
+
+				# The prediction for the first target was wrong,
+				# so the neighbour is put back to be processed:
+				tm.save_result(make_result(task1))
+				assert tm.get_task()['priority'] == 2
+
+				# The prediction for the other target was right:
+				tm.save_result(make_result(task3, skip_targets=[1004]))
+				tm.cursor.execute("SELECT priority,skipped_by FROM photometry_skipped;")
+				assert [tuple(row) for row in tm.cursor.fetchall()] == [(4, 3)]
+				tm.cursor.execute("SELECT status FROM todolist WHERE priority=2;")
+				assert tm.cursor.fetchone()['status'] is None
+
+#----------------------------------------------------------------------
+def test_taskmanager_shared():
+	"""Test claiming tasks from a TODO-file shared by several TaskManagers"""
+
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, [
+			(1, 1001, 'ffi', 1, 1, 8.0),
+			(2, 1002, 'ffi', 1, 1, 9.0),
+			(3, 1003, 'ffi', 1, 2, 10.0),
+			(4, 1004, 'ffi', 1, 2, 11.0),
+		])
+
+		with pytest.raises(ValueError):
+			TaskManager(todo_file, shared=True, overwrite=True)
+		with TaskManager(todo_file) as tm:
+			with pytest.raises(RuntimeError):
+				tm.claim_task()
+
+		with TaskManager(todo_file, shared=True, worker_id='a') as tm1, TaskManager(todo_file, shared=True, worker_id='b') as tm2:
+			# The two processes never get the same task:
+			task1 = tm1.claim_task()
+			task2 = tm2.claim_task()
+			assert task1['priority'] == 1
+			assert task2['priority'] == 2
+
+			# A new process does not reset the tasks claimed by the others:
+			with TaskManager(todo_file, shared=True, worker_id='c') as tm3:
+				assert count_status(todo_file, STATUS.STARTED) == 2
+
+				# A claim which has expired is taken over by the next process asking for a task:
+				task3 = tm3.claim_task(lease=-1)
+				assert task3['priority'] == 3
+				assert tm1.claim_task()['priority'] == 3
+
+			# Each process records its own results:
+			tm1.save_result(make_result(task1))
+			assert count_status(todo_file, STATUS.OK) == 1
+			tm1.cursor.execute("SELECT priority,worker FROM claims ORDER BY priority;")
+			assert [tuple(row) for row in tm1.cursor.fetchall()] == [(2, 'b'), (3, 'a')]
+
+		# Restarting a process releases the tasks it had claimed:
+		with TaskManager(todo_file, shared=True, worker_id='b') as tm2:
+			tm2.cursor.execute("SELECT status FROM todolist WHERE priority=2;")
+			assert tm2.cursor.fetchone()['status'] is None
+			assert tm2.claim_task()['priority'] == 2
+
+#----------------------------------------------------------------------
+def test_taskmanager_shared_renew_claim():
+	"""Test renewing claims, and discarding results of tasks taken over by another process"""
+
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, [
+			(1, 1001, 'ffi', 1, 1, 8.0),
+			(2, 1002, 'ffi', 1, 1, 9.0),
+		])
+
+		with TaskManager(todo_file) as tm:
+			with pytest.raises(RuntimeError):
+				tm.renew_claim(1)
+
+		with TaskManager(todo_file, shared=True, worker_id='a') as tm1, TaskManager(todo_file, shared=True, worker_id='b') as tm2:
+			# A renewed claim is not taken over:
+			task1 = tm1.claim_task(lease=-1)
+			assert tm1.renew_claim(task1['priority'])
+			assert tm2.claim_task(lease=-1)['priority'] == 2
+
+			# But once it expires it is, and the first process can no longer renew it:
+			assert tm1.renew_claim(task1['priority'], lease=-1)
+			task1_b = tm2.claim_task()
+			assert task1_b['priority'] == 1
+			assert not tm1.renew_claim(task1['priority'])
+
+			# The first process can neither put the task back nor save its result:
+			tm1.requeue_task(task1['priority'])
+			assert count_status(todo_file, STATUS.STARTED) == 2
+			assert not tm1.save_result(make_result(task1))
+			assert count_status(todo_file, STATUS.OK) == 0
+			tm1.cursor.execute("SELECT COUNT(*) FROM diagnostics;")
+			assert tm1.cursor.fetchone()[0] == 0
+
+			# The process now holding the claim saves its result:
+			assert tm2.save_result(make_result(task1_b))
+			assert count_status(todo_file, STATUS.OK) == 1
+			assert tm2.summary['STARTED'] == 1
+
+#----------------------------------------------------------------------
+def _claim_all(todo_file):
+	"""Claim and finish tasks until there are no more."""
+	priorities = []
+	with TaskManager(todo_file, shared=True) as tm:
+		while True:
+			task = tm.claim_task()
+			if task is None: break
+			tm.save_result(make_result(task))
+			priorities.append(task['priority'])
+	return priorities
+
+def test_taskmanager_shared_processes():
+	"""Test that concurrent processes each claim different tasks"""
+
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, [(k, 1000+k, 'ffi', 1, 1, 10.0) for k in range(1, 61)])
+
+		pool = multiprocessing.Pool(4)
+		try:
+			claimed = pool.map(_claim_all, [todo_file]*4)
+		finally:
+			pool.close()
+			pool.join()
+
+		claimed = sum(claimed, [])
+		assert sorted(claimed) == list(range(1, 61))
+		assert count_status(todo_file, STATUS.OK) == 60
+
+#----------------------------------------------------------------------
 if __name__ == '__main__':
 	test_taskmanager()
+	test_taskmanager_write_behind()
+	test_taskmanager_write_behind_signal()
+	test_taskmanager_write_behind_signal_after_error()
+	test_taskqueue()
+	test_taskqueue_accept()
+	test_taskmanager_in_memory_queue()
+	test_taskmanager_requeue_task()
+	test_taskmanager_secondary_results()
+	test_taskmanager_order_cost()
+	test_taskmanager_predicted_skips_defer()
+	test_taskmanager_eta_deferred()
+	test_taskmanager_predicted_skips_skip()
+	test_taskmanager_shared()
+	test_taskmanager_shared_renew_claim()
+	test_taskmanager_shared_processes()
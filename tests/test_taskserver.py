@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the task server.
+"""
+
+from __future__ import division, print_function, with_statement, absolute_import
+import sys
+import os.path
+import threading
+import time
+import multiprocessing
+import numpy as np
+try:
+	from tempfile import TemporaryDirectory
+except ImportError:
+	from backports.tempfile import TemporaryDirectory
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from photometry import STATUS
+from photometry.taskserver import TaskServer, TaskClient, parse_address
+from tests.helpers import make_todo_file, make_result, count_status
+
+#----------------------------------------------------------------------
+def _process_all(address):
+	"""Worker processing tasks from the server until there are no more."""
+	numtasks = 0
+	with TaskClient(address, heartbeat_interval=0.1) as client:
+		while True:
+			task = client.get_task(retry=0.1)
+			if task is None:
+				break
+			result = make_result(task, pos_centroid=np.array([1.5, 2.5]), mean_flux=np.float32(1000))
+			if client.save_result(result):
+				numtasks += 1
+	return numtasks
+
+def _crash(address):
+	"""Worker which dies while holding a task."""
+	client = TaskClient(address, heartbeat_interval=None)
+	client.get_task()
+	os._exit(1)
+
+#----------------------------------------------------------------------
+def test_parse_address():
+	assert parse_address('localhost:5555')[1] == ('localhost', 5555)
+	assert parse_address(':5555')[1] == ('localhost', 5555)
+	assert parse_address('/tmp/tessphot.sock')[1] == '/tmp/tessphot.sock'
+
+#----------------------------------------------------------------------
+def test_taskserver():
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, [(k, 100+k, 'ffi', 1, 1, 10.0) for k in range(1, 41)])
+
+		with TaskServer(todo_file, 'localhost:0', heartbeat_timeout=1.0) as server:
+			thread = threading.Thread(target=server.run)
+			thread.start()
+			try:
+				# Worker which stops responding while holding a task:
+				silent = TaskClient(server.address, heartbeat_interval=None)
+				silent_task = silent.get_task()
+				assert silent_task['priority'] == 1
+
+				# Worker which crashes while holding a task:
+				crash = multiprocessing.Process(target=_crash, args=(server.address, ))
+				crash.start()
+				crash.join()
+
+				# The rest of the workers process all tasks, including the ones
+				# held by the workers which disappeared:
+				pool = multiprocessing.Pool(3)
+				try:
+					processed = pool.map(_process_all, [server.address]*3)
+				finally:
+					pool.close()
+					pool.join()
+
+				thread.join(30)
+				assert not thread.is_alive(), "Server did not finish"
+			finally:
+				server.stop()
+				thread.join()
+
+			# Result from the silent worker arriving too late is not accepted:
+			try:
+				assert not silent.save_result(make_result(silent_task))
+			except IOError:
+				pass
+			silent.close()
+
+		assert sum(processed) == 40
+		assert count_status(todo_file, STATUS.OK) == 40
+		assert count_status(todo_file, STATUS.STARTED) == 0
+
+#----------------------------------------------------------------------
+def test_taskserver_heartbeat():
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, [(1, 101, 'ffi', 1, 1, 10.0)])
+		address = os.path.join(tmpdir, 'tessphot.sock')
+
+		with TaskServer(todo_file, address, heartbeat_timeout=0.5) as server:
+			thread = threading.Thread(target=server.run)
+			thread.start()
+			try:
+				# A slow task is not taken away from a worker sending heartbeats:
+				with TaskClient(address, heartbeat_interval=0.1) as client:
+					task = client.get_task()
+					time.sleep(1.5)
+					assert client.save_result(make_result(task))
+					assert client.get_task() is None
+
+				thread.join(30)
+				assert not thread.is_alive(), "Server did not finish"
+			finally:
+				server.stop()
+				thread.join()
+
+		assert not os.path.exists(address)
+		assert count_status(todo_file, STATUS.OK) == 1
+
+#----------------------------------------------------------------------
+if __name__ == '__main__':
+	test_parse_address()
+	test_taskserver()
+	test_taskserver_heartbeat()
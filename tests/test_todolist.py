@@ -9,8 +9,16 @@ import os
 import numpy as np
 import sys
 import itertools
+import sqlite3
+import contextlib
+from astropy.io import fits
+try:
+	from tempfile import TemporaryDirectory
+except ImportError:
+	from backports.tempfile import TemporaryDirectory
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from photometry import todolist
+from tests.helpers import make_todo_file
 
 #----------------------------------------------------------------------
 def test_methods_file():
@@ -62,8 +70,118 @@ def test_exclude_file():
 #		print(cbv_area)
 #		assert(cbv_area == 131)
 
+#----------------------------------------------------------------------
+def test_predict_skipped_targets():
+
+	# Bright stars have much larger apertures than faint ones:
+	radius = todolist.predicted_aperture_radius([4.0, 10.0, 16.0])
+	assert radius[0] > radius[1] > radius[2]
+	assert radius[2] == 1.5
+
+	# Targets and their offset in arcsec from a common point:
+	targets = [
+		# priority, starid, tmag, dra, ddec
+		(1, 1001, 6.0, 0, 0),
+		(2, 1002, 11.0, 300, 0), # Far from the bright target
+		(3, 1003, 12.0, 10, 0), # Inside aperture of the bright target
+		(4, 1004, 12.0, 0, 30), # Inside aperture of the bright target
+		(5, 1005, 13.0, 320, 0), # Inside aperture of target 2
+		(6, 1006, 13.0, 3600, 0), # Isolated
+	]
+
+	with TemporaryDirectory() as tmpdir:
+		todo_file = make_todo_file(tmpdir, [(t[0], t[1], 'ffi', 1, 1, t[2]) for t in targets])
+
+		# Catalog with the positions of the targets:
+		catalog_file = os.path.join(tmpdir, 'catalog_sector001_camera1_ccd1.sqlite')
+		with contextlib.closing(sqlite3.connect(catalog_file)) as conn:
+			cursor = conn.cursor()
+			cursor.execute("CREATE TABLE catalog (starid BIGINT NOT NULL, ra DOUBLE PRECISION NOT NULL, decl DOUBLE PRECISION NOT NULL, tmag REAL NOT NULL);")
+			for priority, starid, tmag, dra, ddec in targets:
+				cursor.execute("INSERT INTO catalog (starid,ra,decl,tmag) VALUES (?,?,?,?);", (
+					starid,
+					120.0 + dra/3600/np.cos(np.radians(-40.0)),
+					-40.0 + ddec/3600,
+					tmag
+				))
+			conn.commit()
+			cursor.close()
+
+		assert todolist.predict_skipped_targets(todo_file) == 3
+		with contextlib.closing(sqlite3.connect(todo_file)) as conn:
+			cursor = conn.cursor()
+			cursor.execute("SELECT priority,skipped_by FROM skip_predictions ORDER BY priority;")
+			assert cursor.fetchall() == [(3, 1), (4, 1), (5, 2)]
+
+		# Only neighbours which are much fainter:
+		assert todolist.predict_skipped_targets(todo_file, min_dmag=5.5) == 2
+
+#----------------------------------------------------------------------
+def _write_tpf(fname, starid, Nrows=10):
+	"""Write a small file with the headers of a Target Pixel File."""
+	hdu0 = fits.PrimaryHDU()
+	hdu0.header['TICID'] = starid
+	hdu0.header['SECTOR'] = 1
+	hdu0.header['CAMERA'] = 2
+	hdu0.header['CCD'] = 3
+	hdu1 = fits.BinTableHDU.from_columns([fits.Column(name='TIME', format='D', array=np.arange(Nrows, dtype='float64'))])
+	hdu2 = fits.ImageHDU(data=np.zeros((5, 4), dtype='int32'))
+	fits.HDUList([hdu0, hdu1, hdu2]).writeto(fname, overwrite=True)
+
+def test_tpf_file_index():
+
+	# Count the number of headers actually read:
+	calls = []
+	tpf_header_info = todolist._tpf_header_info
+	def counting_header_info(fname):
+		calls.append(os.path.basename(fname))
+		return tpf_header_info(fname)
+
+	with TemporaryDirectory() as tmpdir:
+		tpf_files = [os.path.join(tmpdir, 'tess_%d_tp.fits' % starid) for starid in (1001, 1002, 1003)]
+		for fname, starid in zip(tpf_files, (1001, 1002, 1003)):
+			_write_tpf(fname, starid)
+
+		todolist._tpf_header_info = counting_header_info
+		try:
+			index = todolist.tpf_file_index(tmpdir, tpf_files)
+			assert len(calls) == 3
+			assert [entry['starid'] for entry in index] == [1001, 1002, 1003]
+			assert all(entry['stamp_height'] == 5 and entry['stamp_width'] == 4 for entry in index)
+
+			# Running again should not read any headers:
+			del calls[:]
+			index2 = todolist.tpf_file_index(tmpdir, tpf_files)
+			assert calls == []
+			assert [dict(entry) for entry in index2] == [dict(entry) for entry in index]
+
+			# Files with a new modification time or size are read again:
+			st = os.stat(tpf_files[0])
+			os.utime(tpf_files[0], (st.st_atime, st.st_mtime + 100))
+			st = os.stat(tpf_files[1])
+			_write_tpf(tpf_files[1], 2002, Nrows=1000)
+			os.utime(tpf_files[1], (st.st_atime, st.st_mtime))
+			assert os.path.getsize(tpf_files[1]) != st.st_size
+			index = todolist.tpf_file_index(tmpdir, tpf_files)
+			assert sorted(calls) == ['tess_1001_tp.fits', 'tess_1002_tp.fits']
+			assert [entry['starid'] for entry in index] == [1001, 2002, 1003]
+
+			# Files which have been deleted are removed from the index:
+			del calls[:]
+			os.remove(tpf_files[2])
+			index = todolist.tpf_file_index(tmpdir, tpf_files[:2])
+			assert calls == []
+			with contextlib.closing(sqlite3.connect(os.path.join(tmpdir, 'fileindex.sqlite'))) as conn:
+				cursor = conn.cursor()
+				cursor.execute("SELECT path FROM tpf_headers ORDER BY path;")
+				assert cursor.fetchall() == [('tess_1001_tp.fits', ), ('tess_1002_tp.fits', )]
+		finally:
+			todolist._tpf_header_info = tpf_header_info
+
 #----------------------------------------------------------------------
 if __name__ == '__main__':
 	test_methods_file()
 	test_exclude_file()
+	test_predict_skipped_targets()
+	test_tpf_file_index()
 	#test_calc_cbv_area()
\ No newline at end of file
@@ -8,10 +8,18 @@ from __future__ import division, print_function, with_statement, absolute_import
 import sys
 import os
 import numpy as np
+import gzip
+import shutil
+from astropy.io import fits
+try:
+	from tempfile import TemporaryDirectory
+except ImportError:
+	from backports.tempfile import TemporaryDirectory
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from photometry.utilities import (move_median_central, find_ffi_files, find_tpf_files,
 								  find_hdf5_files, find_catalog_files, load_ffi_fits,
-								  sphere_distance, radec_to_cartesian, cartesian_to_radec)
+								  sphere_distance, radec_to_cartesian, cartesian_to_radec,
+								  read_fits_headers, fork_map)
 
 INPUT_DIR = os.path.join(os.path.dirname(__file__), 'input')
 
@@ -128,6 +136,64 @@ def test_coordtransforms():
 	# Test that we recoved the input:
 	np.testing.assert_allclose(radec2, inp, atol=1e-7)
 
+#----------------------------------------------------------------------
+def test_read_fits_headers():
+
+	# Create a small FITS file with a primary header, a table and an image extension:
+	hdu0 = fits.PrimaryHDU()
+	hdu0.header['TICID'] = 12345
+	hdu0.header['SECTOR'] = 1
+	hdu1 = fits.BinTableHDU.from_columns([
+		fits.Column(name='TIME', format='D', array=np.arange(100, dtype='float64')),
+		fits.Column(name='FLUX', format='120E', dim='(12,10)', array=np.ones((100, 10, 12), dtype='float32'))
+	])
+	hdu2 = fits.ImageHDU(data=np.zeros((10, 12), dtype='int32'))
+	hdu2.header['CRVAL1'] = 123.4
+	hdul = fits.HDUList([hdu0, hdu1, hdu2])
+
+	with TemporaryDirectory() as tmpdir:
+		fname = os.path.join(tmpdir, 'test.fits')
+		hdul.writeto(fname)
+		with open(fname, 'rb') as src, gzip.open(fname + '.gz', 'wb') as dst:
+			shutil.copyfileobj(src, dst)
+
+		for path in (fname, fname + '.gz'):
+			hdr0, hdr2 = read_fits_headers(path, extensions=(0, 2))
+			with fits.open(path) as hdu:
+				assert hdr0 == hdu[0].header
+				assert hdr2 == hdu[2].header
+			assert hdr0['TICID'] == 12345
+			assert hdr2['NAXIS1'] == 12
+			assert hdr2['NAXIS2'] == 10
+
+			# Default is only to read the primary header:
+			headers = read_fits_headers(path)
+			assert len(headers) == 1
+			assert headers[0]['SECTOR'] == 1
+
+#----------------------------------------------------------------------
+def test_fork_map():
+
+	class Summer(object):
+		def __init__(self):
+			self.data = np.arange(100)
+		def chunk_sum(self, start, stop):
+			return os.getpid(), np.sum(self.data[start:stop])
+
+	summer = Summer()
+	args = [(k, k+10) for k in range(0, 100, 10)]
+	expected = [np.sum(summer.data[k:k+10]) for k in range(0, 100, 10)]
+
+	# Run in this process:
+	results = fork_map(summer.chunk_sum, args)
+	assert [r[1] for r in results] == expected
+	assert set(r[0] for r in results) == set([os.getpid()])
+
+	# Run in several processes, with results coming back in the same order:
+	results = fork_map(summer.chunk_sum, args, processes=3)
+	assert [r[1] for r in results] == expected
+	if sys.platform.startswith('linux'):
+		assert os.getpid() not in set(r[0] for r in results)
 
 #----------------------------------------------------------------------
 if __name__ == '__main__':
@@ -139,3 +205,5 @@ if __name__ == '__main__':
 	test_load_ffi_files()
 	test_sphere_distance()
 	test_coordtransforms()
+	test_read_fits_headers()
+	test_fork_map()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Split the TODO-file into shards for each sector, camera and CCD, or merge the shards again.
+
+When the input directory contains shards instead of a ``todo.sqlite``, the shards are
+used by all the programs running the photometry as if they were a single TODO-file.
+
+Example:
+	To split the TODO-file in the directory defined in the ``TESSPHOT_INPUT``
+	environment variable into shards, which are placed in the same directory:
+
+	>>> python todo_shards.py split
+
+	The original TODO-file is left untouched, but must be moved away before the
+	shards are used, since the ``todo.sqlite`` file will otherwise be used.
+
+Example:
+	To merge the shards into a single TODO-file for use downstream:
+
+	>>> python todo_shards.py merge --output=/where/ever/todo.sqlite
+"""
+
+from __future__ import division, with_statement, print_function, absolute_import
+import os
+import argparse
+import logging
+from photometry.shards import split_todo_file, merge_todo_files, find_shards
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+	# Parse command line arguments:
+	parser = argparse.ArgumentParser(description='Split TODO-file into shards, or merge shards into a single TODO-file.')
+	parser.add_argument('-d', '--debug', help='Print debug messages.', action='store_true')
+	parser.add_argument('-q', '--quiet', help='Only report warnings and errors.', action='store_true')
+	parser.add_argument('-o', '--overwrite', help='Overwrite existing files.', action='store_true')
+	parser.add_argument('--output', type=str, help='Output directory when splitting, or output file when merging. Default is the input directory.', default=None)
+	parser.add_argument('action', type=str, help='Split TODO-file into shards, or merge shards into a single TODO-file.', choices=('split', 'merge'))
+	parser.add_argument('input_folder', type=str, help='Directory containing the TODO-file or shards.', nargs='?', default=None)
+	args = parser.parse_args()
+
+	# Set logging level:
+	logging_level = logging.INFO
+	if args.quiet:
+		logging_level = logging.WARNING
+	elif args.debug:
+		logging_level = logging.DEBUG
+
+	# Setup logging:
+	formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+	console = logging.StreamHandler()
+	console.setFormatter(formatter)
+	logger = logging.getLogger(__name__)
+	logger.addHandler(console)
+	logger.setLevel(logging_level)
+	logger_parent = logging.getLogger('photometry')
+	logger_parent.addHandler(console)
+	logger_parent.setLevel(logging_level)
+
+	input_folder = args.input_folder
+	if input_folder is None:
+		input_folder = os.environ.get('TESSPHOT_INPUT', os.path.abspath(os.path.join(os.path.dirname(__file__), 'tests', 'input')))
+
+	if args.action == 'split':
+		shard_files = split_todo_file(os.path.join(input_folder, 'todo.sqlite'), output_folder=args.output, overwrite=args.overwrite)
+		logger.info("Created %d shards", len(shard_files))
+	else:
+		shard_files = find_shards(input_folder)
+		if not shard_files:
+			parser.error("No shards found in '%s'" % input_folder)
+		output_file = args.output if args.output else os.path.join(input_folder, 'todo.sqlite')
+		merge_todo_files(shard_files, output_file, overwrite=args.overwrite)
+		logger.info("Merged %d shards into '%s'", len(shard_files), output_file)